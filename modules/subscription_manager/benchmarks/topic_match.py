@@ -0,0 +1,106 @@
+"""
+Micro-benchmark comparing the topic trie used by Subscriber._on_message with
+the fnmatch scan over all subscriptions it replaced.
+
+    python benchmarks/topic_match.py --subscriptions 50 --messages 200000
+
+Runs from a checkout without installing the package.
+"""
+import argparse
+from fnmatch import fnmatch
+from pathlib import Path
+import random
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from subscription_manager.subscriber.topics import TopicTrie
+
+CENTRES = [f"centre-{idx:03}" for idx in range(200)]
+CATEGORIES = ["surface-based-observations/synop",
+              "surface-based-observations/temp",
+              "surface-based-observations/buoy",
+              "space-based-observations/amv",
+              "prediction/forecast/medium-range/deterministic/global"]
+
+
+def make_subscriptions(count):
+    subs = [
+        "cache/a/wis2/+/data/core/weather/surface-based-observations/synop",
+        "cache/a/wis2/+/+/data/core/weather/surface-based-observations/#",
+    ]
+    for idx in range(count - len(subs)):
+        centre = CENTRES[idx % len(CENTRES)]
+        category = CATEGORIES[idx % len(CATEGORIES)]
+        if idx % 3 == 0:
+            subs.append(f"cache/a/wis2/{centre}/data/core/weather/{category}")
+        elif idx % 3 == 1:
+            subs.append(f"cache/a/wis2/{centre}/data/core/weather/#")
+        else:
+            subs.append(f"cache/a/wis2/+/data/core/weather/{category}/+")
+    return subs
+
+
+def make_topics(count, seed=0):
+    rng = random.Random(seed)
+    topics = []
+    for _ in range(count):
+        centre = rng.choice(CENTRES)
+        category = rng.choice(CATEGORIES)
+        topics.append(f"cache/a/wis2/{centre}/data/core/weather/{category}")
+    return topics
+
+
+def bench_fnmatch(subscriptions, topics):
+    patterns = {topic: topic.replace("+", "*").replace("#", "*")
+                for topic in subscriptions}
+    matched = 0
+    start = time.perf_counter()
+    for topic in topics:
+        if topic in patterns:
+            matched += 1
+            continue
+        for key, pattern in patterns.items():
+            if fnmatch(topic, pattern):
+                matched += 1
+                break
+    return matched, time.perf_counter() - start
+
+
+def bench_trie(subscriptions, topics):
+    trie = TopicTrie()
+    for idx, topic in enumerate(subscriptions):
+        trie.insert(topic, (idx, topic))
+    exact = set(subscriptions)
+    matched = 0
+    start = time.perf_counter()
+    for topic in topics:
+        if topic in exact:
+            matched += 1
+            continue
+        matches = trie.match(topic)
+        if matches:
+            min(matches)
+            matched += 1
+    return matched, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--subscriptions", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+
+    subscriptions = make_subscriptions(args.subscriptions)
+    topics = make_topics(args.messages)
+
+    for name, bench in (("fnmatch", bench_fnmatch), ("trie", bench_trie)):
+        matched, elapsed = bench(subscriptions, topics)
+        print(f"{name:>8}: {len(topics) / elapsed:12,.0f} matches/s "
+              f"({matched} of {len(topics)} matched, "
+              f"{len(subscriptions)} subscriptions)")
+
+
+if __name__ == "__main__":
+    main()
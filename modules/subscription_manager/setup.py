@@ -92,7 +92,8 @@ setup(
     include_package_data=True,
     entry_points={
         'console_scripts': [
-            'subscription_manager=subscription_manager.app:main'
+            'subscription_manager=subscription_manager.app:main',
+            'subscription_replay=subscription_manager.subscriber.replay:main'
         ]
     },
     classifiers=[
@@ -1,12 +1,18 @@
 import logging
 import os
-import threading
 
-from flask import Flask, request
+from flask import Flask, Response, request
 
+from task_manager.caches import CacheStats
+from task_manager.deadletter import DeadLetterQueue, replay_job
+from task_manager.retention import last_report
 from task_manager.worker import app as celery_app
 
 from subscription_manager.subscriber import Subscriber
+from subscription_manager.subscriber.backpressure import DEFAULT_PRIORITY
+from subscription_manager.subscriber.filters import FILTER_KEYS
+from subscription_manager.subscriber.process import (
+    SUBSCRIBER_PROCESS, start_subscriber_process)
 
 LOG_LEVEL = os.getenv("LOG_LEVEL","DEBUG").upper()
 
@@ -16,11 +22,14 @@ LOGGER = logging.getLogger(__name__)
 
 def create_app(test_config=None):
 
-    # create subscriber
-    subscriber = Subscriber()
-    # start as thread
-    mqtt_thread = threading.Thread(target=subscriber.client.loop_forever,
-                                   daemon=True).start()
+    # create subscriber, each broker connection runs in its own thread,
+    # either here or in a separate process so that the HTTP handlers do not
+    # compete with message processing for the GIL
+    if SUBSCRIBER_PROCESS:
+        _, subscriber = start_subscriber_process()
+    else:
+        subscriber = Subscriber()
+        subscriber.start()
 
     # Load and start subscriptions
     #with open("subscriptions.json") as fh:
@@ -60,17 +69,81 @@ def create_app(test_config=None):
 
     @app.route('/wis2/subscriptions/list')
     def list_subscriptions():
-        return subscriber.active_subscriptions
+        return subscriber.subscriptions()
+
+    @app.route('/wis2/subscriptions/stats')
+    def subscription_stats():
+        return subscriber.statistics()
+
+    @app.route('/wis2/subscriptions/metrics')
+    def subscription_metrics():
+        return Response(subscriber.metrics(),
+                        mimetype="text/plain; version=0.0.4")
+
+    @app.route('/wis2/subscriptions/backpressure')
+    def backpressure_status():
+        return subscriber.backpressure_status()
+
+    @app.route('/wis2/subscriptions/pipeline')
+    def pipeline_status():
+        return subscriber.pipeline_status()
+
+    @app.route('/wis2/brokers')
+    def broker_health():
+        return subscriber.health()
+
+    @app.route('/wis2/subscriptions/dedup')
+    def dedup_stats():
+        return subscriber.dedup_stats()
+
+    @app.route('/wis2/caches')
+    def cache_stats():
+        return CacheStats().summary()
+
+    @app.route('/wis2/retention')
+    def retention_report():
+        return last_report()
+
+    @app.route('/wis2/deadletter/list')
+    def deadletter_list():
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', 100, type=int)
+        queue = DeadLetterQueue()
+        return {"size": queue.size(), "entries": queue.list(offset, limit)}
+
+    @app.route('/wis2/deadletter/replay')
+    def deadletter_replay():
+        # e.g. ?id=<id>&id=<id> or ?limit=100, all entries if neither given
+        ids = request.args.getlist('id') or None
+        limit = request.args.get('limit', None, type=int)
+        return {"replayed": DeadLetterQueue().replay(replay_job, ids, limit)}
+
+    @app.route('/wis2/deadletter/purge')
+    def deadletter_purge():
+        ids = request.args.getlist('id') or None
+        return {"purged": DeadLetterQueue().purge(ids)}
 
     @app.route('/wis2/subscriptions/add')
     def add_subscription():
         topic = request.args.get('topic', None)
         target = request.args.get('target', '')
+        priority = request.args.get('priority', DEFAULT_PRIORITY, type=int)
+        # e.g. &centre_id=de-dwd-gts-to-wis2&wsi=0-20000-0-10384&max_age=3600
+        filters = {}
+        for key in FILTER_KEYS:
+            values = request.args.getlist(key)
+            if key in ('data_id_regex', 'max_age'):
+                filters[key] = values[0] if values else None
+            else:
+                filters[key] = ",".join(values)
         if topic==None:
             return "No topic passed"
-        subscriber.subscribe(topic, target)
+        try:
+            subscriber.subscribe(topic, target, priority, filters)
+        except ValueError as e:
+            return f"Invalid subscription: {e}"
 
-        return subscriber.active_subscriptions
+        return subscriber.subscriptions()
 
     @app.route('/wis2/subscriptions/delete')
     def delete_subscription():
@@ -78,7 +151,7 @@ def create_app(test_config=None):
         if topic==None:
             return "No topic passed"
         subscriber.unsubscribe(topic)
-        return subscriber.active_subscriptions
+        return subscriber.subscriptions()
 
     return app
 
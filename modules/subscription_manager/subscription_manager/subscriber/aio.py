@@ -0,0 +1,187 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import threading
+
+import paho.mqtt.client as mqtt
+
+from subscription_manager.subscriber.broker import (
+    BROKER_RECONNECT_MIN_DELAY, BROKER_RECONNECT_MAX_DELAY)
+
+LOGGER = logging.getLogger(__name__)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL","DEBUG").upper()
+LOGGER.setLevel(LOG_LEVEL)
+
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("SUBSCRIBER_QUEUE_SIZE", 10000))
+SUBSCRIBER_WORKERS = int(os.getenv("SUBSCRIBER_WORKERS", 1))
+
+
+class _SocketHandler():
+    # Drives a paho client from an asyncio event loop (see paho's
+    # loop_asyncio example) rather than from paho's own network thread.
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self._fd = None
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _call(self, fn, *args):
+        # socket callbacks can fire on the executor thread used to connect
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._fd = sock.fileno()
+        self._call(self.loop.add_reader, self._fd, self._read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        if self._fd is not None:
+            self._call(self.loop.remove_reader, self._fd)
+            self._call(self.loop.remove_writer, self._fd)
+            self._fd = None
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        if self._fd is not None:
+            self._call(self.loop.add_writer, self._fd, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        if self._fd is not None:
+            self._call(self.loop.remove_writer, self._fd)
+
+    def _read(self):
+        rc = self.client.loop_read()
+        # TLS and websocket wrappers can hold decoded bytes that the selector
+        # does not see, drain them before returning to the loop
+        sock = self.client.socket()
+        while rc == mqtt.MQTT_ERR_SUCCESS and sock is not None and \
+                hasattr(sock, "pending") and sock.pending():
+            rc = self.client.loop_read()
+            sock = self.client.socket()
+
+
+class AsyncSubscriberLoop():
+    """
+    Runs the MQTT network I/O for all brokers on one asyncio event loop. The
+    loop only receives bytes: each message is put on a bounded queue and
+    parsing, matching and enqueueing (`process`) happen in a separate worker
+    stage, so receive latency does not depend on downstream enqueueing.
+    Messages arriving while the queue is full are dropped and counted.
+    The worker stage runs on threads of the subscriber's process; to keep
+    processing out of the Flask process as well, run the subscriber in its
+    own process (SUBSCRIBER_PROCESS).
+    """
+
+    def __init__(self, brokers, process,
+                 queue_size: int = SUBSCRIBER_QUEUE_SIZE,
+                 workers: int = SUBSCRIBER_WORKERS):
+        self.brokers = brokers
+        self._process = process
+        self.queue_size = queue_size
+        self.workers = max(1, workers)
+        self.loop = asyncio.new_event_loop()
+        self.queue = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="subscriber-worker")
+        self._handlers = []
+        self._thread = None
+        self.counters = {
+            "received": 0,
+            "dropped": 0,
+            "processed": 0,
+            "errors": 0,
+            "max_queue_depth": 0
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="mqtt-asyncio")
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self.loop.call_soon_threadsafe(self._shutdown)
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=False)
+
+    def _shutdown(self):
+        for broker in self.brokers:
+            broker.client.disconnect()
+        for task in asyncio.all_tasks(self.loop):
+            task.cancel()
+        # runs after the cancellations have been delivered
+        self.loop.call_soon(self.loop.stop)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        for broker in self.brokers:
+            self._handlers.append(_SocketHandler(self.loop, broker.client))
+            self.loop.create_task(self._supervise(broker))
+        for _ in range(self.workers):
+            self.loop.create_task(self._worker())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def submit(self, topic, payload, broker, received):
+        # called from paho's on_message, i.e. on the event loop
+        self.counters["received"] += 1
+        try:
+            self.queue.put_nowait((topic, payload, broker, received))
+        except asyncio.QueueFull:
+            self.counters["dropped"] += 1
+            return
+        depth = self.queue.qsize()
+        if depth > self.counters["max_queue_depth"]:
+            self.counters["max_queue_depth"] = depth
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                await self.loop.run_in_executor(self._executor,
+                                                self._process, *item)
+                self.counters["processed"] += 1
+            except Exception as e:
+                self.counters["errors"] += 1
+                LOGGER.error(f"Error processing message on {item[0]}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _supervise(self, broker):
+        # (re)connect with backoff and service keepalives once a second
+        client = broker.client
+        client.connect_async(broker.host, broker.port)
+        delay = BROKER_RECONNECT_MIN_DELAY
+        while True:
+            if client.socket() is None:
+                try:
+                    # blocking DNS / TCP / TLS, keep it off the event loop
+                    await self.loop.run_in_executor(None, client.reconnect)
+                except Exception as e:
+                    broker.last_error = str(e)
+                    LOGGER.warning(f"Unable to connect to {broker.name} "
+                                   f"({e}), retrying in {delay}s")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, BROKER_RECONNECT_MAX_DELAY)
+                    continue
+                delay = BROKER_RECONNECT_MIN_DELAY
+            client.loop_misc()
+            await asyncio.sleep(1)
+
+    def status(self):
+        return dict(self.counters, mode="asyncio",
+                    queue_depth=self.queue.qsize() if self.queue else 0,
+                    queue_size=self.queue_size, workers=self.workers)
@@ -0,0 +1,267 @@
+from collections import deque
+import logging
+import os
+import threading
+import time
+
+from kombu.transport.redis import Channel
+import redis
+
+from task_manager.worker import app as celery_app
+
+LOGGER = logging.getLogger(__name__)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL","DEBUG").upper()
+LOGGER.setLevel(LOG_LEVEL)
+
+# queue depth (jobs) at which each state is entered
+BACKPRESSURE_THROTTLE = int(os.getenv("BACKPRESSURE_THROTTLE", 5000))
+BACKPRESSURE_SHED = int(os.getenv("BACKPRESSURE_SHED", 20000))
+BACKPRESSURE_PAUSE = int(os.getenv("BACKPRESSURE_PAUSE", 50000))
+# a state is left once the depth falls below HYSTERESIS x its watermark
+BACKPRESSURE_HYSTERESIS = float(os.getenv("BACKPRESSURE_HYSTERESIS", 0.8))
+BACKPRESSURE_INTERVAL = float(os.getenv("BACKPRESSURE_INTERVAL", 2))
+# subscriptions with a priority below this are shed first
+BACKPRESSURE_SHED_PRIORITY = int(os.getenv("BACKPRESSURE_SHED_PRIORITY", 5))
+# lower bound on the admission rate (jobs/s) when throttling
+BACKPRESSURE_MIN_RATE = float(os.getenv("BACKPRESSURE_MIN_RATE", 10))
+BACKPRESSURE_QUEUES = os.getenv("BACKPRESSURE_QUEUES", "celery").split(",")
+# jobs held while paused, the oldest are dropped beyond this
+BACKPRESSURE_HOLD = int(os.getenv("BACKPRESSURE_HOLD", 10000))
+
+DEFAULT_PRIORITY = 5
+
+NORMAL = "normal"
+THROTTLE = "throttle"
+SHED = "shed"
+PAUSE = "pause"
+_STATES = [NORMAL, THROTTLE, SHED, PAUSE]
+ADMIT = "admit"
+
+
+def _queue_keys(queue, options=None):
+    # kombu's redis transport splits each queue into priority lists, named
+    # as its channel does from the broker transport options
+    if options is None:
+        options = celery_app.conf.broker_transport_options or {}
+    prefix = options.get("global_keyprefix", Channel.global_keyprefix)
+    sep = options.get("sep", Channel.sep)
+    steps = options.get("priority_steps", Channel.priority_steps)
+    return [f"{prefix}{queue}{sep}{pri}" if pri else f"{prefix}{queue}"
+            for pri in sorted(set(steps) | {0})]
+
+
+class BackpressureController():
+    """
+    Samples the depth of the Celery queue(s) in Redis and the rate at which
+    workers drain them, and decides whether new jobs are admitted:
+
+    - normal: everything is admitted
+    - throttle: jobs are admitted at (at most) the measured drain rate,
+      the others are held as while paused
+    - shed: as throttle, jobs for low priority subscriptions are dropped
+    - pause: no jobs are admitted, they are held (up to `hold` of them)
+      and handed to `on_release` at the admitted rate once resumed
+
+    Jobs that are dropped from the hold are passed to `on_dropped`.
+    """
+
+    def __init__(self, pending=lambda: 0, queued=lambda: 0,
+                 interval: float = BACKPRESSURE_INTERVAL,
+                 hold: int = BACKPRESSURE_HOLD, on_release=None,
+                 on_dropped=None):
+        self._pending = pending  # jobs buffered but not yet published
+        self._queued = queued  # running count of jobs added to the buffer
+        self.interval = interval
+        self.hold_size = hold
+        self.on_release = on_release
+        self.on_dropped = on_dropped
+        self._held = deque()  # (job, priority)
+        self.watermarks = {
+            THROTTLE: BACKPRESSURE_THROTTLE,
+            SHED: BACKPRESSURE_SHED,
+            PAUSE: BACKPRESSURE_PAUSE
+        }
+        self.state = NORMAL
+        self.depth = 0
+        self.drain_rate = None
+        self.sampled = None
+        self._previous = None  # (time, depth, queued)
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._refilled = time.monotonic()
+        self._redis = None
+        self.counters = {
+            "admitted": 0,
+            "throttled": 0,
+            "shed": 0,
+            "paused": 0,
+            "released": 0,
+            "hold_dropped": 0,
+            "sample_errors": 0
+        }
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="backpressure")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                self.counters["sample_errors"] += 1
+                LOGGER.warning(f"Unable to sample queue depth: {e}")
+            self.release()
+
+    def _queue_depth(self):
+        if self._redis is None:
+            self._redis = redis.Redis.from_url(celery_app.conf.broker_url)
+        pipe = self._redis.pipeline(transaction=False)
+        for queue in BACKPRESSURE_QUEUES:
+            for key in _queue_keys(queue):
+                pipe.llen(key)
+        return sum(pipe.execute())
+
+    def sample(self):
+        now = time.monotonic()
+        depth = self._queue_depth() + self._pending()
+        queued = self._queued()
+        with self._lock:
+            if self._previous is not None:
+                elapsed = now - self._previous[0]
+                drained = self._previous[1] + \
+                    (queued - self._previous[2]) - depth
+                rate = max(drained, 0) / elapsed if elapsed > 0 else 0
+                # smooth, a single sample is noisy
+                if self.drain_rate is None:
+                    self.drain_rate = rate
+                else:
+                    self.drain_rate = 0.7 * self.drain_rate + 0.3 * rate
+            self._previous = (now, depth, queued)
+            self.depth = depth
+            self.sampled = time.time()
+            state = self._next_state(depth)
+            if state != self.state:
+                LOGGER.warning(f"Backpressure state {self.state} -> {state} "
+                               f"(queue depth {depth})")
+                self.state = state
+
+    def _next_state(self, depth):
+        current = _STATES.index(self.state)
+        target = 0
+        for idx, state in enumerate(_STATES[1:], start=1):
+            if depth >= self.watermarks[state]:
+                target = idx
+        # step down only once below the hysteresis band of the current state
+        if target < current and \
+                depth >= self.watermarks[_STATES[current]] * \
+                BACKPRESSURE_HYSTERESIS:
+            target = current
+        return _STATES[target]
+
+    def _take_token(self):
+        now = time.monotonic()
+        rate = max(self.drain_rate or 0, BACKPRESSURE_MIN_RATE)
+        self._tokens = min(self._tokens + (now - self._refilled) * rate, rate)
+        self._refilled = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def _decide(self, priority):
+        # with the lock held
+        if self.state == PAUSE:
+            self.counters["paused"] += 1
+            return PAUSE
+        if self.state == SHED and priority < BACKPRESSURE_SHED_PRIORITY:
+            self.counters["shed"] += 1
+            return SHED
+        if self.state != NORMAL and not self._take_token():
+            self.counters["throttled"] += 1
+            return THROTTLE
+        self.counters["admitted"] += 1
+        return ADMIT
+
+    def decide(self, priority: int = DEFAULT_PRIORITY):
+        """ADMIT, or the state (THROTTLE, SHED, PAUSE) refusing the job"""
+        with self._lock:
+            return self._decide(priority)
+
+    def admit(self, priority: int = DEFAULT_PRIORITY):
+        return self.decide(priority) == ADMIT
+
+    def _drop(self, jobs):
+        if not jobs:
+            return
+        self.counters["hold_dropped"] += len(jobs)
+        if self.on_dropped is not None:
+            try:
+                self.on_dropped(jobs)
+            except Exception as e:
+                LOGGER.warning(f"Dropped job callback failed: {e}")
+
+    def hold(self, job, priority: int = DEFAULT_PRIORITY):
+        """Keep a job refused while paused or throttled until admitted"""
+        with self._lock:
+            self._held.append((job, priority))
+            dropped = []
+            while len(self._held) > self.hold_size:
+                dropped.append(self._held.popleft()[0])
+        if dropped:
+            LOGGER.error(f"Backpressure hold full, {len(dropped)} jobs "
+                         f"dropped")
+        self._drop(dropped)
+
+    def release(self):
+        """Hand held jobs to on_release, in order, as they are admitted"""
+        released = 0
+        while True:
+            with self._lock:
+                if not self._held or self.state == PAUSE:
+                    break
+                job, priority = self._held[0]
+                decision = self._decide(priority)
+                if decision == THROTTLE:
+                    # no tokens left, the rest wait for the next round
+                    break
+                self._held.popleft()
+            if decision == SHED:
+                self._drop([job])
+                continue
+            released += 1
+            self.counters["released"] += 1
+            try:
+                self.on_release(job)
+            except Exception as e:
+                LOGGER.error(f"Unable to release held job: {e}")
+        return released
+
+    def drop_held(self):
+        """Give up the held jobs, e.g. on shutdown"""
+        with self._lock:
+            dropped = [job for job, priority in self._held]
+            self._held.clear()
+        self._drop(dropped)
+        return len(dropped)
+
+    def status(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "queue_depth": self.depth,
+                "drain_rate": self.drain_rate,
+                "sampled": self.sampled,
+                "watermarks": dict(self.watermarks),
+                "hysteresis": BACKPRESSURE_HYSTERESIS,
+                "shed_priority": BACKPRESSURE_SHED_PRIORITY,
+                "held": len(self._held),
+                "hold_size": self.hold_size,
+                "counters": dict(self.counters)
+            }
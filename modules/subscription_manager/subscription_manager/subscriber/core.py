@@ -0,0 +1,237 @@
+from datetime import datetime
+import itertools
+import json
+import logging
+import os
+import time
+
+from task_manager.caches import register_alternates
+
+from subscription_manager.subscriber.aio import AsyncSubscriberLoop
+from subscription_manager.subscriber.backpressure import (
+    ADMIT, BackpressureController, DEFAULT_PRIORITY, PAUSE, THROTTLE)
+from subscription_manager.subscriber.broker import (BrokerConnection,
+                                                    parse_brokers, WIS2_BROKERS)
+from subscription_manager.subscriber.dedup import Deduplicator
+from subscription_manager.subscriber.enqueue import EnqueueBuffer
+from subscription_manager.subscriber.filters import NotificationFilter
+from subscription_manager.subscriber.replay import Recorder, SUBSCRIBER_RECORD
+from subscription_manager.subscriber.stats import SubscriptionStats
+from subscription_manager.subscriber.topics import TopicTrie
+
+LOGGER = logging.getLogger(__name__)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL","DEBUG").upper()
+LOGGER.setLevel(LOG_LEVEL)
+
+# "thread": paho network threads parse, match and enqueue inline
+# "asyncio": network I/O on an event loop, processing in a worker stage
+SUBSCRIBER_MODE = os.getenv("SUBSCRIBER_MODE", "thread")
+# share the links of all notifications, including those of duplicates from
+# other caches, with the download workers
+CACHE_ALTERNATES = os.getenv("CACHE_ALTERNATES", "true").lower() == "true"
+
+class Subscriber():
+    # Subscriptions are attached to every broker in `brokers`, the duplicate
+    # streams are collapsed into a single job flow by the dedup stage.
+    def __init__(self, brokers = WIS2_BROKERS, mode: str = SUBSCRIBER_MODE):
+        self.active_subscriptions = {}
+        self._filters = {}
+        self._topics = TopicTrie()
+        self._sequence = itertools.count()
+        self.dedup = Deduplicator()
+        self.stats = SubscriptionStats()
+        self.enqueue = EnqueueBuffer(on_dropped=self._forget,
+                                     alternates=CACHE_ALTERNATES)
+        self.backpressure = BackpressureController(
+            pending=self.enqueue.pending,
+            queued=lambda: self.enqueue.counters['queued'],
+            on_release=self._release, on_dropped=self._forget)
+        self.brokers = {}
+        for broker in parse_brokers(brokers):
+            self.brokers[broker['name']] = BrokerConnection(
+                **broker, on_message=self._on_message,
+                topics=lambda: list(self.active_subscriptions))
+        self.recorder = Recorder(SUBSCRIBER_RECORD) if SUBSCRIBER_RECORD else None
+        self._aio = None
+        if mode == "asyncio":
+            self._aio = AsyncSubscriberLoop(list(self.brokers.values()),
+                                            self.process)
+        elif mode != "thread":
+            raise ValueError(f"Unknown subscriber mode {mode}")
+
+    def start(self):
+        self.backpressure.start()
+        if self._aio is not None:
+            self._aio.start()
+        else:
+            for broker in self.brokers.values():
+                broker.start()
+
+    def stop(self):
+        if self._aio is not None:
+            self._aio.stop()
+        else:
+            for broker in self.brokers.values():
+                broker.stop()
+        self.backpressure.stop()
+        held = self.backpressure.drop_held()
+        if held:
+            LOGGER.warning(f"{held} jobs held by backpressure dropped")
+        self.enqueue.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    # plain data for the HTTP handlers, also served through the proxy when
+    # the subscriber runs in its own process
+
+    def subscriptions(self):
+        return dict(self.active_subscriptions)
+
+    def statistics(self):
+        return self.stats.as_dict()
+
+    def metrics(self):
+        targets = {topic: value['target'] for topic, value in
+                   list(self.active_subscriptions.items())}
+        return self.stats.prometheus(targets)
+
+    def backpressure_status(self):
+        return self.backpressure.status()
+
+    def dedup_stats(self):
+        return self.dedup.stats()
+
+    def health(self):
+        return {name: broker.health() for name, broker in self.brokers.items()}
+
+    def pipeline_status(self):
+        if self._aio is not None:
+            return self._aio.status()
+        return {"mode": "thread"}
+
+    def _on_message(self, client, userdata, msg):
+        received = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        if self.recorder is not None:
+            self.recorder.record(msg.topic, msg.payload, userdata)
+        if self._aio is not None:
+            self._aio.submit(msg.topic, msg.payload, userdata, received)
+        else:
+            self.process(msg.topic, msg.payload, userdata, received)
+
+    def process(self, topic, payload, broker, received):
+        LOGGER.debug(f"Message received on topic {topic}")
+        start = time.perf_counter()
+        matched = topic
+        subscription = self.active_subscriptions.get(topic)
+        if subscription is None:
+            # We are likely using a wildcard in our subscription, resolve
+            # against the topic trie, earliest subscription wins
+            matches = self._topics.match(topic)
+            if matches:
+                matched = min(matches)[1]
+                subscription = self.active_subscriptions.get(matched)
+        job = {
+            "topic": topic,
+            "payload": json.loads(payload),
+            "target": (subscription or {}).get('target'),
+            "_broker": broker,
+            "_received": received
+        }
+
+        if job['target'] == None:
+            self.stats.record_unmatched(len(payload))
+            LOGGER.warning("Message received but unable to match target")
+            LOGGER.warning(f"Topic: {topic}")
+            LOGGER.warning(f"Payload: {payload}")
+            LOGGER.warning(f"Active subscriptions:\n{json.dumps(self.active_subscriptions, indent=4)}")
+            LOGGER.warning("Message skipped")
+            return
+
+        notification_filter = self._filters.get(matched)
+        rejected = None
+        if notification_filter is not None:
+            rejected = notification_filter.rejected_by(topic,
+                                                       job['payload'])
+        if rejected is not None:
+            LOGGER.debug(f"Notification rejected by {rejected} filter "
+                         f"({topic})")
+            outcome = "filtered"
+        elif self.dedup.is_duplicate(job['payload']):
+            LOGGER.debug(f"Duplicate notification dropped ({topic})")
+            if CACHE_ALTERNATES:
+                self._register_alternates(job['payload'])
+            outcome = "duplicate"
+        else:
+            outcome = self._admit(job, subscription['priority'])
+        self.stats.record(matched, len(payload), outcome,
+                          time.perf_counter() - start)
+
+    def _admit(self, job, priority):
+        # the notification is now recorded by dedup, it is forgotten again
+        # unless it is enqueued or held
+        decision = self.backpressure.decide(priority)
+        if decision in (PAUSE, THROTTLE):
+            self.backpressure.hold(job, priority)
+            return "held"
+        if decision != ADMIT:
+            LOGGER.debug(f"Notification dropped by backpressure "
+                         f"({decision}, {job['topic']})")
+            self.dedup.forget(job['payload'])
+            return "backpressure"
+        # _queued is set when the job is added to the buffer
+        if not self.enqueue.put(job):
+            self.dedup.forget(job['payload'])
+            return "dropped"
+        return "enqueued"
+
+    def _release(self, job):
+        # held while paused, admitted now
+        if not self.enqueue.put(job):
+            self.dedup.forget(job['payload'])
+
+    def _forget(self, jobs):
+        # not published after all, let another copy of the notification in
+        for job in jobs:
+            self.dedup.forget(job['payload'])
+
+    def _register_alternates(self, payload):
+        # the same object from another global cache, the download stage can
+        # use whichever cache is performing best
+        try:
+            register_alternates(payload)
+        except Exception as e:
+            LOGGER.warning(f"Unable to register alternative links: {e}")
+
+    def subscribe(self, topic, target, priority=DEFAULT_PRIORITY,
+                  filters=None):
+        if topic in self.active_subscriptions:
+            LOGGER.warning(f"Topic ({topic}) already subscribed.")
+        else:
+            # compile first so that invalid filters are rejected up front
+            notification_filter = NotificationFilter(filters)
+            self._topics.insert(topic, (next(self._sequence), topic))
+            if notification_filter:
+                self._filters[topic] = notification_filter
+            self.active_subscriptions[topic] = {
+                'target': target,
+                'priority': priority,
+                'filters': notification_filter.spec
+            }
+            for broker in self.brokers.values():
+                broker.subscribe(topic)
+
+        return self.active_subscriptions
+
+    def unsubscribe(self, topic):
+        if topic in self.active_subscriptions:
+            self._topics.remove(topic)
+            del self.active_subscriptions[topic]
+            self._filters.pop(topic, None)
+            self.stats.remove(topic)
+            for broker in self.brokers.values():
+                broker.unsubscribe(topic)
+        else:
+            LOGGER.warning(f"subscription for topic {topic} not found")
+
+        return self.active_subscriptions
\ No newline at end of file
@@ -0,0 +1,138 @@
+from collections import OrderedDict
+import logging
+import os
+import threading
+import time
+
+import redis
+
+LOGGER = logging.getLogger(__name__)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL","DEBUG").upper()
+LOGGER.setLevel(LOG_LEVEL)
+
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", 3600))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", 200000))
+DEDUP_REDIS_URL = os.getenv("DEDUP_REDIS_URL")
+DEDUP_REDIS_PREFIX = "wis2:dedup:"
+
+
+def notification_keys(payload):
+    # A notification is a duplicate if we have seen its message id, or the
+    # same data_id with the same integrity hash (republished by a cache or a
+    # different global broker). Without a hash only the message id is used,
+    # a data_id on its own would also drop genuine updates of the data.
+    keys = []
+    message_id = payload.get('id')
+    if message_id is not None:
+        keys.append(f"id:{message_id}")
+    properties = payload.get('properties', {})
+    data_id = properties.get('data_id')
+    integrity = properties.get('integrity') or {}
+    if data_id is not None and integrity.get('value'):
+        keys.append(f"data:{data_id}|{integrity['value']}")
+    return keys
+
+
+class Deduplicator():
+    """
+    Time windowed duplicate filter for WIS2 notifications, backed by a
+    bounded in-process LRU and, optionally, a set of expiring keys in Redis
+    shared with other subscriber processes. Checking a notification records
+    it; a notification that is then not enqueued (dropped or failed to
+    publish) must be forgotten again so that a later copy is let through.
+    """
+
+    def __init__(self, window: int = DEDUP_WINDOW,
+                 max_entries: int = DEDUP_MAX_ENTRIES,
+                 redis_url: str = DEDUP_REDIS_URL):
+        self.window = window
+        self.max_entries = max_entries
+        self._seen = OrderedDict()  # key -> expiry (monotonic)
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_url:
+            self._redis = redis.Redis.from_url(redis_url)
+        self.counters = {
+            "checked": 0,
+            "duplicates": 0,
+            "local_hits": 0,
+            "shared_hits": 0,
+            "shared_errors": 0,
+            "forgotten": 0
+        }
+
+    def is_duplicate(self, payload):
+        """Return True if seen within the window, otherwise record it"""
+        keys = notification_keys(payload)
+        if not keys:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self.counters["checked"] += 1
+            self._expire(now)
+            duplicate = any(key in self._seen for key in keys)
+            for key in keys:
+                self._seen[key] = now + self.window
+                self._seen.move_to_end(key)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            if duplicate:
+                self.counters["local_hits"] += 1
+                self.counters["duplicates"] += 1
+                return True
+        if self._redis is not None and self._shared_duplicate(keys):
+            with self._lock:
+                self.counters["shared_hits"] += 1
+                self.counters["duplicates"] += 1
+            return True
+        return False
+
+    def forget(self, payload):
+        """Remove the record of a notification that was not enqueued"""
+        keys = notification_keys(payload)
+        if not keys:
+            return
+        with self._lock:
+            self.counters["forgotten"] += 1
+            for key in keys:
+                self._seen.pop(key, None)
+        if self._redis is not None:
+            try:
+                self._redis.delete(*[f"{DEDUP_REDIS_PREFIX}{key}"
+                                     for key in keys])
+            except redis.RedisError as e:
+                with self._lock:
+                    self.counters["shared_errors"] += 1
+                LOGGER.warning(f"Unable to forget shared dedup keys: {e}")
+
+    def _expire(self, now):
+        while self._seen:
+            key, expiry = next(iter(self._seen.items()))
+            if expiry > now:
+                break
+            del self._seen[key]
+
+    def _shared_duplicate(self, keys):
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.set(f"{DEDUP_REDIS_PREFIX}{key}", 1, nx=True,
+                         ex=self.window)
+            # SET NX returns None for keys that already exist
+            return None in pipe.execute()
+        except redis.RedisError as e:
+            with self._lock:
+                self.counters["shared_errors"] += 1
+            LOGGER.warning(f"Shared dedup check failed, using local only: {e}")  # noqa
+            return False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self._seen)
+        checked = stats['checked']
+        stats['hit_rate'] = stats['duplicates'] / checked if checked else 0.0
+        stats['window'] = self.window
+        stats['shared'] = self._redis is not None
+        return stats
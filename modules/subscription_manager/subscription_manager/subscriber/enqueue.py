@@ -0,0 +1,258 @@
+from collections import deque
+from datetime import datetime
+import logging
+import os
+import threading
+import time
+import uuid
+
+import kombu
+from kombu import Producer
+from kombu.utils.json import dumps
+from task_manager.caches import register_alternates_many
+from task_manager.worker import app as celery_app
+from task_manager.workflows import (wis2_batch_download_and_ingest,
+                                    wis2_download_and_ingest,
+                                    wis2_fused_download_and_ingest)
+
+LOGGER = logging.getLogger(__name__)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL","DEBUG").upper()
+LOGGER.setLevel(LOG_LEVEL)
+
+ENQUEUE_BATCH_SIZE = int(os.getenv("ENQUEUE_BATCH_SIZE", 100))
+ENQUEUE_BATCH_WINDOW = float(os.getenv("ENQUEUE_BATCH_WINDOW", 0.25))
+ENQUEUE_MAX_PENDING = int(os.getenv("ENQUEUE_MAX_PENDING", 100000))
+# jobs per download_batch_from_wis2 task, 1 publishes a task per job
+ENQUEUE_DOWNLOAD_BATCH = int(os.getenv("ENQUEUE_DOWNLOAD_BATCH", 1))
+# publish single jobs as one download_and_ingest task rather than a
+# download task linked to an ingest task
+ENQUEUE_FUSED_INGEST = os.getenv("ENQUEUE_FUSED_INGEST",
+                                 "false").lower() == "true"
+# kombu releases the redis message layout below was checked against (see
+# requirements.txt), other releases publish message by message
+KOMBU_TESTED = ((5, 6), (5, 7))
+
+
+class _CapturingChannel():
+    # Stands in for a producer's channel: published messages are collected
+    # rather than sent, everything else (declarations, tables) is passed on
+    def __init__(self, channel):
+        self._channel = channel
+        self.messages = []
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+    def basic_publish(self, message, exchange, routing_key, **kwargs):
+        self.messages.append((message, exchange, routing_key))
+
+
+def _pipelines(producer):
+    # kombu's redis transport issues one LPUSH per message, its messages
+    # are written here in a single MULTI/EXEC instead. Other transports
+    # publish message by message, as do kombu releases the layout was not
+    # checked against.
+    low, high = KOMBU_TESTED
+    return producer.connection.transport.driver_type == "redis" and \
+        low <= tuple(kombu.VERSION[:2]) < high
+
+
+def _redis_queues(channel, exchange, routing_key, tables):
+    # queues a message is delivered to, as routed by the channel
+    if not exchange:
+        return [routing_key]
+    exchange_type = channel.typeof(exchange).type
+    if exchange_type != "direct":
+        # fanout exchanges are sent with PUBLISH rather than to a list
+        raise RuntimeError(f"Unable to pipeline {exchange_type} exchange "
+                           f"{exchange}")
+    if exchange not in tables:
+        tables[exchange] = channel.get_table(exchange)
+    queues = channel.typeof(exchange).lookup(tables[exchange], exchange,
+                                             routing_key, None)
+    if not queues:
+        raise RuntimeError(f"No queue bound to {exchange} ({routing_key})")
+    return queues
+
+
+def _redis_message(channel, message, exchange, routing_key):
+    # as prepared by kombu's redis channel before the LPUSH
+    message["body"], body_encoding = channel.encode_body(
+        message["body"], channel.body_encoding)
+    message["properties"].update(body_encoding=body_encoding,
+                                 delivery_tag=str(uuid.uuid4()))
+    message["properties"]["delivery_info"].update(exchange=exchange,
+                                                  routing_key=routing_key)
+    priority = message["properties"].get("priority") or 0
+    priority = channel.priority(min(max(int(priority), channel.min_priority),
+                                    channel.max_priority))
+    return priority, dumps(message)
+
+
+class EnqueueBuffer():
+    """
+    Collects jobs from the MQTT callback thread and publishes them to Celery
+    from a background thread, either once `batch_size` jobs are waiting or
+    `window` seconds after the oldest job was added. Jobs are published in
+    the order they were added. With `download_batch` > 1 consecutive jobs
+    are grouped into batch download tasks of up to that many jobs.
+    `on_dropped` is called with the jobs that could not be published. With
+    `alternates` the links of every job are shared with the download workers
+    (see task_manager.caches) before the batch is published, so that the
+    first download of an object can already choose between caches.
+    """
+
+    def __init__(self, batch_size: int = ENQUEUE_BATCH_SIZE,
+                 window: float = ENQUEUE_BATCH_WINDOW,
+                 max_pending: int = ENQUEUE_MAX_PENDING,
+                 workflow=wis2_fused_download_and_ingest
+                 if ENQUEUE_FUSED_INGEST else wis2_download_and_ingest,
+                 download_batch: int = ENQUEUE_DOWNLOAD_BATCH,
+                 batch_workflow=wis2_batch_download_and_ingest,
+                 on_dropped=None, alternates: bool = False):
+        self.batch_size = max(1, batch_size)
+        self.window = max(0.0, window)
+        self.max_pending = max_pending
+        self.workflow = workflow
+        self.download_batch = max(1, download_batch)
+        self.batch_workflow = batch_workflow
+        self.on_dropped = on_dropped
+        self.alternates = alternates
+        self._jobs = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self.counters = {
+            "queued": 0,
+            "published": 0,
+            "batches": 0,
+            "failed_batches": 0,
+            "dropped": 0
+        }
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="enqueue-buffer")
+        self._thread.start()
+
+    def put(self, job):
+        with self._cond:
+            if len(self._jobs) >= self.max_pending:
+                self.counters["dropped"] += 1
+                LOGGER.error("Enqueue buffer full, job dropped")
+                return False
+            job['_queued'] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            self._jobs.append((time.monotonic(), job))
+            self.counters["queued"] += 1
+            if len(self._jobs) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def pending(self):
+        return len(self._jobs)
+
+    def stats(self):
+        return dict(self.counters, pending=self.pending(),
+                    batch_size=self.batch_size, window=self.window,
+                    download_batch=self.download_batch)
+
+    def stop(self, timeout: float = None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._jobs and not self._stopped:
+                self._cond.wait()
+            if self._jobs and not self._stopped:
+                deadline = self._jobs[0][0] + self.window
+                while len(self._jobs) < self.batch_size and \
+                        not self._stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            batch = []
+            while self._jobs and len(batch) < self.batch_size:
+                batch.append(self._jobs.popleft()[1])
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._publish(batch)
+            elif self._stopped:
+                break
+
+    def _dropped(self, jobs):
+        self.counters["dropped"] += len(jobs)
+        if self.on_dropped is not None:
+            try:
+                self.on_dropped(jobs)
+            except Exception as e:
+                LOGGER.warning(f"Dropped job callback failed: {e}")
+
+    def _signatures(self, batch):
+        # (signature, jobs) pairs
+        if self.download_batch > 1:
+            return [(self.batch_workflow(batch[idx:idx + self.download_batch]),
+                     batch[idx:idx + self.download_batch])
+                    for idx in range(0, len(batch), self.download_batch)]
+        return [(self.workflow(job), [job]) for job in batch]
+
+    def _publish_pipelined(self, producer, signatures):
+        capture = _CapturingChannel(producer.channel)
+        capturing = Producer(capture)
+        for signature, _ in signatures:
+            signature.apply_async(producer=capturing)
+        channel = producer.channel
+        tables = {}
+        with channel.client.pipeline(transaction=True) as pipe:
+            for message, exchange, routing_key in capture.messages:
+                priority, body = _redis_message(channel, message, exchange,
+                                                routing_key)
+                for queue in _redis_queues(channel, exchange, routing_key,
+                                           tables):
+                    if priority:
+                        queue = f"{queue}{channel.sep}{priority}"
+                    pipe.lpush(queue, body)
+            pipe.execute()
+
+    def _register_alternates(self, batch):
+        try:
+            register_alternates_many([job['payload'] for job in batch])
+        except Exception as e:
+            LOGGER.warning(f"Unable to register alternative links: {e}")
+
+    def _publish(self, batch):
+        if self.alternates:
+            self._register_alternates(batch)
+        signatures = self._signatures(batch)
+        sent = 0
+        try:
+            with celery_app.producer_or_acquire() as producer:
+                if _pipelines(producer):
+                    # all or nothing
+                    self._publish_pipelined(producer, signatures)
+                    sent = len(signatures)
+                else:
+                    for signature, _ in signatures:
+                        signature.apply_async(producer=producer)
+                        sent += 1
+        except Exception as e:
+            self.counters["failed_batches"] += 1
+            LOGGER.error(f"Failed to publish batch of {len(batch)} jobs, "
+                         f"retrying {len(signatures) - sent} tasks "
+                         f"individually: {e}")
+        for signature, jobs in signatures[:sent]:
+            self.counters["published"] += len(jobs)
+        for signature, jobs in signatures[sent:]:
+            try:
+                signature.apply_async()
+            except Exception as e:
+                LOGGER.error(f"Failed to publish job: {e}")
+                self._dropped(jobs)
+            else:
+                self.counters["published"] += len(jobs)
+        self.counters["batches"] += 1
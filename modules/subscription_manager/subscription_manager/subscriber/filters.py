@@ -0,0 +1,121 @@
+from datetime import datetime, timezone
+import re
+
+# position of the centre-id in the WIS2 topic hierarchy, e.g.
+# cache/a/wis2/<centre-id>/data/core/weather/surface-based-observations/synop
+CENTRE_ID_LEVEL = 3
+
+FILTER_KEYS = ("centre_id", "data_id_prefix", "data_id_regex", "wsi",
+               "max_age")
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(",") if item.strip()]
+    return [str(item) for item in value]
+
+
+def _parse_datetime(value):
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+class NotificationFilter():
+    """
+    Declarative filter applied to notifications before a job is created,
+    compiled once from a spec such as:
+
+        {
+            "centre_id": ["de-dwd-gts-to-wis2"],
+            "data_id_prefix": ["de-dwd-gts-to-wis2/data/core/weather"],
+            "data_id_regex": "ISMD\\d\\d",
+            "wsi": ["0-20000-0-10384"],
+            "max_age": 86400
+        }
+
+    All given conditions must hold. `wsi` checks the notification's
+    wigos_station_identifier and falls back to searching the data_id.
+    `max_age` (seconds) applies to properties.datetime, or end_datetime.
+    """
+
+    def __init__(self, spec: dict = None):
+        spec = {key: value for key, value in (spec or {}).items()
+                if value not in (None, "", [])}
+        unknown = set(spec) - set(FILTER_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown filter(s): {', '.join(sorted(unknown))}")  # noqa
+        self.spec = {}
+        self._centres = None
+        self._prefixes = None
+        self._regex = None
+        self._wsi = None
+        self._wsi_search = None
+        self._max_age = None
+        if "centre_id" in spec:
+            self.spec["centre_id"] = _as_list(spec["centre_id"])
+            self._centres = frozenset(self.spec["centre_id"])
+        if "data_id_prefix" in spec:
+            self.spec["data_id_prefix"] = _as_list(spec["data_id_prefix"])
+            self._prefixes = tuple(self.spec["data_id_prefix"])
+        if "data_id_regex" in spec:
+            self.spec["data_id_regex"] = str(spec["data_id_regex"])
+            try:
+                self._regex = re.compile(self.spec["data_id_regex"])
+            except re.error as e:
+                raise ValueError(f"Invalid data_id_regex: {e}")
+        if "wsi" in spec:
+            self.spec["wsi"] = _as_list(spec["wsi"])
+            self._wsi = frozenset(self.spec["wsi"])
+            # whole identifiers only, e.g. "_0-20000-0-1038_" but not
+            # "_0-20000-0-10384_"
+            self._wsi_search = re.compile(
+                "(?<![0-9A-Za-z-])(?:" +
+                "|".join(re.escape(wsi) for wsi in self.spec["wsi"]) +
+                ")(?![0-9A-Za-z-])")
+        if "max_age" in spec:
+            try:
+                self._max_age = float(spec["max_age"])
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid max_age: {spec['max_age']}")
+            self.spec["max_age"] = self._max_age
+
+    def __bool__(self):
+        return bool(self.spec)
+
+    def rejected_by(self, topic, payload):
+        """Name of the first filter the notification fails, None if none"""
+        if self._centres is not None:
+            levels = topic.split("/", CENTRE_ID_LEVEL + 1)
+            if len(levels) <= CENTRE_ID_LEVEL or \
+                    levels[CENTRE_ID_LEVEL] not in self._centres:
+                return "centre_id"
+        properties = payload.get("properties", {})
+        data_id = properties.get("data_id") or ""
+        if self._prefixes is not None and not data_id.startswith(
+                self._prefixes):
+            return "data_id_prefix"
+        if self._regex is not None and self._regex.search(data_id) is None:
+            return "data_id_regex"
+        if self._wsi is not None:
+            wsi = properties.get("wigos_station_identifier")
+            if wsi is not None:
+                if wsi not in self._wsi:
+                    return "wsi"
+            elif self._wsi_search.search(data_id) is None:
+                return "wsi"
+        if self._max_age is not None:
+            value = properties.get("datetime") or \
+                properties.get("end_datetime")
+            observed = _parse_datetime(value) if value else None
+            if observed is not None and (
+                    datetime.now(timezone.utc) - observed
+            ).total_seconds() > self._max_age:
+                return "max_age"
+        return None
@@ -0,0 +1,30 @@
+from multiprocessing.managers import BaseManager
+import os
+
+from subscription_manager.subscriber.core import Subscriber
+
+# run the subscriber (MQTT loops, parsing, matching, dedup and enqueueing)
+# in a child process rather than in the Flask process
+SUBSCRIBER_PROCESS = os.getenv("SUBSCRIBER_PROCESS",
+                               "false").lower() == "true"
+
+
+class SubscriberManager(BaseManager):
+    """
+    Hosts a Subscriber in a separate process. The proxy returned by
+    `manager.Subscriber()` forwards method calls (and their results) over a
+    pipe, so only the public methods of Subscriber can be used through it,
+    not attributes such as `active_subscriptions` or `stats`.
+    """
+
+
+SubscriberManager.register("Subscriber", Subscriber)
+
+
+def start_subscriber_process(**kwargs):
+    """Start a manager process running a Subscriber, returns both"""
+    manager = SubscriberManager()
+    manager.start()
+    subscriber = manager.Subscriber(**kwargs)
+    subscriber.start()
+    return manager, subscriber
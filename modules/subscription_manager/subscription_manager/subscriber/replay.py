@@ -0,0 +1,311 @@
+"""
+Record the raw WIS2 notification stream seen by the subscriber and replay it
+through the same matching / dedup / enqueue path.
+
+Recording is enabled by setting SUBSCRIBER_RECORD to a file path, messages
+are written as gzip compressed JSONL:
+
+    {"received": 1718000000.123, "broker": "globalbroker.meteo.fr",
+     "topic": "cache/a/wis2/...", "payload": "{...}"}
+
+Replay (see `subscription_replay --help`):
+
+    subscription_replay wis2.jsonl.gz --speed 10 --subscribe 'cache/a/wis2/#'
+    subscription_replay wis2.jsonl.gz --speed max --broker mqtt://localhost:1883
+"""
+import argparse
+import base64
+from datetime import datetime, timezone
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+LOGGER = logging.getLogger(__name__)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL","DEBUG").upper()
+LOGGER.setLevel(LOG_LEVEL)
+
+SUBSCRIBER_RECORD = os.getenv("SUBSCRIBER_RECORD")
+SUBSCRIBER_RECORD_FLUSH = float(os.getenv("SUBSCRIBER_RECORD_FLUSH", 5))
+
+
+class Recorder():
+    """Appends (receive time, broker, topic, payload) to a gzip JSONL file"""
+
+    def __init__(self, path: str, flush_interval: float = SUBSCRIBER_RECORD_FLUSH):  # noqa
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # append mode adds a new gzip member, readers handle concatenation
+        self._fh = gzip.open(path, "at", encoding="utf-8")
+        self._flushed = time.monotonic()
+        self.records = 0
+        LOGGER.info(f"Recording WIS2 notifications to {path}")
+
+    def record(self, topic, payload, broker, received: float = None):
+        entry = {
+            "received": received if received is not None else time.time(),
+            "broker": broker,
+            "topic": topic
+        }
+        try:
+            entry["payload"] = payload.decode("utf-8")
+        except UnicodeDecodeError:
+            entry["payload_b64"] = base64.b64encode(payload).decode("ascii")
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._fh is None:
+                return
+            self._fh.write(line)
+            self.records += 1
+            now = time.monotonic()
+            if now - self._flushed >= self.flush_interval:
+                self._fh.flush()
+                self._flushed = now
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+def read_recording(path: str):
+    """Yield (received, broker, topic, payload bytes) from a recording"""
+    with gzip.open(path, "rt", encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a recording cut short by a crash ends in a partial line
+                LOGGER.warning(f"Skipping unreadable line in {path}")
+                continue
+            if "payload_b64" in entry:
+                payload = base64.b64decode(entry["payload_b64"])
+            else:
+                payload = entry["payload"].encode("utf-8")
+            yield entry["received"], entry.get("broker"), entry["topic"], payload  # noqa
+
+
+def percentiles(values, points=(50, 90, 99, 99.9)):
+    if not values:
+        return {f"p{point}": None for point in points}
+    values = sorted(values)
+    result = {}
+    for point in points:
+        idx = min(len(values) - 1, int(round(point / 100 * (len(values) - 1))))  # noqa
+        result[f"p{point}"] = values[idx]
+    return result
+
+
+class Replayer():
+    """
+    Feeds a recording into a Subscriber, either by calling `process` directly
+    (no broker) or by publishing to an MQTT broker the subscriber is
+    connected to. `speed` is a multiple of the recorded rate, None replays as
+    fast as possible. Latency is measured from the scheduled send time to the
+    end of `process` for each message.
+    """
+
+    def __init__(self, subscriber, speed: float = 1.0, broker: dict = None):
+        self.subscriber = subscriber
+        self.speed = speed
+        self.broker = broker
+        self.latencies = []
+        self._sent = {}
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self.sent = 0
+        self.processed = 0
+        self.errors = 0
+        self._last_processed = None
+        self._publisher = None
+        # time every call into process, whichever path it arrives on
+        self._process = subscriber.process
+        subscriber.process = self._timed_process
+        if subscriber._aio is not None:
+            subscriber._aio._process = self._timed_process
+
+    @staticmethod
+    def _key(topic, payload):
+        return topic, hashlib.md5(payload).digest()
+
+    def _timed_process(self, topic, payload, broker, received):
+        try:
+            self._process(topic, payload, broker, received)
+        except Exception as e:
+            self.errors += 1
+            LOGGER.error(f"Error processing replayed message: {e}")
+        finished = time.perf_counter()
+        with self._lock:
+            sent = self._sent.pop(self._key(topic, payload), None)
+            if sent is not None:
+                self.latencies.append(finished - sent)
+            self.processed += 1
+            self._last_processed = finished
+            self._done.notify_all()
+
+    def _dropped(self):
+        aio = self.subscriber._aio
+        return aio.counters["dropped"] if aio is not None else 0
+
+    def _connect(self):
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1,
+                             transport=self.broker["protocol"])
+        if self.broker["tls"]:
+            client.tls_set()
+        client.username_pw_set(self.broker["uid"], self.broker["pwd"])
+        client.connect(self.broker["host"], self.broker["port"])
+        client.loop_start()
+        self._publisher = client
+
+    def _send(self, topic, payload, broker):
+        if self._publisher is not None:
+            self._publisher.publish(topic, payload)
+            return
+        received = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        aio = self.subscriber._aio
+        if aio is not None:
+            # through the bounded queue and worker stage, as _on_message does
+            aio.loop.call_soon_threadsafe(aio.submit, topic, payload,
+                                          broker or "replay", received)
+        else:
+            self.subscriber.process(topic, payload, broker or "replay",
+                                    received)
+
+    def run(self, recording, limit: int = None, drain_timeout: float = 30):
+        if self.broker is not None:
+            self._connect()
+        first = None
+        start = time.perf_counter()
+        for received, broker, topic, payload in recording:
+            if limit is not None and self.sent >= limit:
+                break
+            if first is None:
+                first = received
+            scheduled = start
+            if self.speed:
+                scheduled = start + (received - first) / self.speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                scheduled = time.perf_counter()
+            with self._lock:
+                # identical retransmissions keep the earliest send time
+                self._sent.setdefault(self._key(topic, payload), scheduled)
+            self._send(topic, payload, broker)
+            self.sent += 1
+        sent_done = time.perf_counter()
+        # wait for messages still in flight through the broker / worker stage
+        with self._lock:
+            self._done.wait_for(
+                lambda: self.processed + self._dropped() >= self.sent,
+                timeout=drain_timeout)
+        finished = time.perf_counter()
+        if self._publisher is not None:
+            self._publisher.disconnect()
+            self._publisher.loop_stop()
+        return self.report(start, sent_done, finished)
+
+    def report(self, start, sent_done, finished):
+        # messages the broker never delivers (e.g. topics without a matching
+        # subscription) should not count the drain timeout as work
+        elapsed = (self._last_processed or finished) - start
+        with self._lock:
+            latencies = list(self.latencies)
+        return {
+            "sent": self.sent,
+            "processed": self.processed,
+            "lost": self.sent - self.processed,
+            "errors": self.errors,
+            "speed": self.speed or "max",
+            "send_seconds": round(sent_done - start, 3),
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_per_second": round(self.processed / elapsed, 1) if elapsed > 0 else None,  # noqa
+            "latency_ms": {
+                key: round(value * 1000, 3) if value is not None else None
+                for key, value in percentiles(latencies).items()
+            },
+            "outcomes": _outcome_totals(self.subscriber.stats.as_dict()),
+            "enqueue": self.subscriber.enqueue.stats()
+        }
+
+
+def _outcome_totals(stats):
+    totals = {"unmatched": stats["unmatched"]["messages"]}
+    for values in stats["subscriptions"].values():
+        for outcome, count in values["outcomes"].items():
+            totals[outcome] = totals.get(outcome, 0) + count
+    return totals
+
+
+def _discard(buffer):
+    # batches still go through the buffer, they are just not sent to Celery
+    def publish(batch):
+        buffer.counters["published"] += len(batch)
+        buffer.counters["batches"] += 1
+    return publish
+
+
+def main():
+    from subscription_manager.subscriber import Subscriber
+    from subscription_manager.subscriber.broker import parse_brokers
+
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded WIS2 notification stream through the "
+                    "subscriber matching / enqueue path")
+    parser.add_argument("recording", help="gzip JSONL written by SUBSCRIBER_RECORD")  # noqa
+    parser.add_argument("--speed", default="1",
+                        help="multiple of the recorded rate, or 'max'")
+    parser.add_argument("--broker", default=None,
+                        help="publish via this MQTT broker (e.g. mqtt://localhost:1883), "  # noqa
+                             "default is to call the subscriber directly")
+    parser.add_argument("--subscribe", action="append", default=None,
+                        help="subscription topic (repeatable), default cache/a/wis2/#")  # noqa
+    parser.add_argument("--target", default="replay",
+                        help="download target used for the subscriptions")
+    parser.add_argument("--mode", default="thread", choices=["thread", "asyncio"])  # noqa
+    parser.add_argument("--limit", type=int, default=None,
+                        help="stop after this many messages")
+    parser.add_argument("--drain-timeout", type=float, default=30,
+                        help="seconds to wait for in flight messages")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="count jobs instead of publishing them to Celery")
+    args = parser.parse_args()
+
+    speed = None if args.speed == "max" else float(args.speed)
+    broker = parse_brokers(args.broker)[0] if args.broker else None
+
+    subscriber = Subscriber(brokers=[args.broker] if args.broker else [],
+                            mode=args.mode)
+    if args.dry_run:
+        subscriber.enqueue._publish = _discard(subscriber.enqueue)
+    for topic in args.subscribe or ["cache/a/wis2/#"]:
+        subscriber.subscribe(topic, args.target)
+
+    replayer = Replayer(subscriber, speed=speed, broker=broker)
+    subscriber.start()
+    if broker is not None:
+        # allow the subscriber to connect and subscribe before publishing
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and not all(
+                state["connected"] for state in subscriber.health().values()):
+            time.sleep(0.1)
+        time.sleep(0.5)
+    try:
+        report = replayer.run(read_recording(args.recording), limit=args.limit,
+                              drain_timeout=args.drain_timeout)
+    finally:
+        subscriber.stop()
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
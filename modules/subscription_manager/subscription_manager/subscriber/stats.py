@@ -0,0 +1,163 @@
+import bisect
+import threading
+import time
+
+# upper bounds (seconds) of the match / enqueue latency histogram
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+RATE_WINDOW = 60  # seconds used for the messages per second figure
+
+OUTCOMES = ("enqueued", "held", "filtered", "duplicate", "backpressure",
+            "dropped")
+
+
+class _Counters():
+    __slots__ = ("messages", "bytes", "outcomes", "buckets", "latency_sum",
+                 "window", "created")
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # last is +Inf
+        self.latency_sum = 0.0
+        self.window = [0] * RATE_WINDOW  # per second message counts
+        self.created = time.time()
+
+    def rate(self, now):
+        return sum(self.window) / min(RATE_WINDOW, max(now - self.created, 1))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+class SubscriptionStats():
+    """
+    Per subscription counters (messages, bytes, outcome of each message and
+    a histogram of the time taken to match and enqueue it) plus a count of
+    messages that matched no subscription.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+        self._second = int(time.time())
+        self.unmatched = 0
+        self.unmatched_bytes = 0
+
+    def _roll(self, now):
+        # zero the per second slots that have elapsed since the last call
+        second = int(now)
+        if second == self._second:
+            return
+        for counters in self._subscriptions.values():
+            for offset in range(1, min(second - self._second, RATE_WINDOW) + 1):  # noqa
+                counters.window[(self._second + offset) % RATE_WINDOW] = 0
+        self._second = second
+
+    def record(self, subscription, nbytes, outcome, latency):
+        now = time.time()
+        with self._lock:
+            self._roll(now)
+            counters = self._subscriptions.get(subscription)
+            if counters is None:
+                counters = self._subscriptions[subscription] = _Counters()
+            counters.messages += 1
+            counters.bytes += nbytes
+            counters.outcomes[outcome] = counters.outcomes.get(outcome, 0) + 1
+            counters.window[self._second % RATE_WINDOW] += 1
+            counters.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1  # noqa
+            counters.latency_sum += latency
+
+    def record_unmatched(self, nbytes):
+        with self._lock:
+            self.unmatched += 1
+            self.unmatched_bytes += nbytes
+
+    def remove(self, subscription):
+        with self._lock:
+            self._subscriptions.pop(subscription, None)
+
+    def as_dict(self):
+        now = time.time()
+        with self._lock:
+            self._roll(now)
+            subscriptions = {}
+            for topic, counters in self._subscriptions.items():
+                cumulative = 0
+                histogram = {}
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",),
+                                        counters.buckets):
+                    cumulative += count
+                    histogram[str(bound)] = cumulative
+                subscriptions[topic] = {
+                    "messages": counters.messages,
+                    "messages_per_second": round(counters.rate(now), 3),
+                    "bytes": counters.bytes,
+                    "dedup_drops": counters.outcomes["duplicate"],
+                    "outcomes": dict(counters.outcomes),
+                    "latency_seconds": {
+                        "buckets": histogram,
+                        "sum": counters.latency_sum,
+                        "count": counters.messages
+                    }
+                }
+            return {
+                "subscriptions": subscriptions,
+                "unmatched": {
+                    "messages": self.unmatched,
+                    "bytes": self.unmatched_bytes
+                }
+            }
+
+    def prometheus(self, targets=None):
+        targets = targets or {}
+        stats = self.as_dict()
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def labels(topic, **extra):
+            pairs = {"subscription": topic,
+                     "target": targets.get(topic, "")}
+            pairs.update(extra)
+            return ",".join(f'{key}="{_escape(value)}"'
+                            for key, value in pairs.items())
+
+        subscriptions = stats["subscriptions"]
+        metric("wis2_subscription_messages_total", "counter",
+               "Messages received per subscription")
+        for topic, values in subscriptions.items():
+            lines.append(f"wis2_subscription_messages_total{{{labels(topic)}}} {values['messages']}")  # noqa
+        metric("wis2_subscription_messages_per_second", "gauge",
+               f"Messages per second per subscription ({RATE_WINDOW}s window)")  # noqa
+        for topic, values in subscriptions.items():
+            lines.append(f"wis2_subscription_messages_per_second{{{labels(topic)}}} {values['messages_per_second']}")  # noqa
+        metric("wis2_subscription_bytes_total", "counter",
+               "Payload bytes received per subscription")
+        for topic, values in subscriptions.items():
+            lines.append(f"wis2_subscription_bytes_total{{{labels(topic)}}} {values['bytes']}")  # noqa
+        metric("wis2_subscription_outcomes_total", "counter",
+               "Messages per subscription by outcome")
+        for topic, values in subscriptions.items():
+            for outcome, count in values["outcomes"].items():
+                lines.append(f"wis2_subscription_outcomes_total{{{labels(topic, outcome=outcome)}}} {count}")  # noqa
+        metric("wis2_subscription_latency_seconds", "histogram",
+               "Time taken to match and enqueue a message")
+        for topic, values in subscriptions.items():
+            latency = values["latency_seconds"]
+            for bound, count in latency["buckets"].items():
+                lines.append(f"wis2_subscription_latency_seconds_bucket{{{labels(topic, le=bound)}}} {count}")  # noqa
+            lines.append(f"wis2_subscription_latency_seconds_sum{{{labels(topic)}}} {latency['sum']}")  # noqa
+            lines.append(f"wis2_subscription_latency_seconds_count{{{labels(topic)}}} {latency['count']}")  # noqa
+        metric("wis2_unmatched_messages_total", "counter",
+               "Messages that matched no subscription")
+        lines.append(f"wis2_unmatched_messages_total {stats['unmatched']['messages']}")  # noqa
+        metric("wis2_unmatched_bytes_total", "counter",
+               "Payload bytes of messages that matched no subscription")
+        lines.append(f"wis2_unmatched_bytes_total {stats['unmatched']['bytes']}")  # noqa
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,121 @@
+import threading
+
+
+class _Node():
+    __slots__ = ("children", "value", "multi")
+
+    def __init__(self):
+        self.children = {}  # level -> _Node, including "+" and "#"
+        self.value = None  # value stored for a filter ending at this node
+        self.multi = None  # value stored for a filter ending in "#" here
+
+
+class TopicTrie():
+    """
+    Trie of MQTT topic filters, matched using MQTT wildcard semantics:
+
+    - "+" matches exactly one topic level
+    - "#" matches the parent level and any number of child levels
+    - topics starting with "$" are not matched by a leading wildcard
+
+    Lookups visit at most one wildcard and one literal branch per level, so
+    the cost depends on the topic depth rather than the number of filters.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._lock = threading.Lock()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, topic_filter):
+        node = self._root
+        levels = topic_filter.split("/")
+        for level in levels[:-1]:
+            node = node.children.get(level)
+            if node is None:
+                return False
+        if levels[-1] == "#":
+            return node.multi is not None
+        node = node.children.get(levels[-1])
+        return node is not None and node.value is not None
+
+    def insert(self, topic_filter, value):
+        levels = topic_filter.split("/")
+        for idx, level in enumerate(levels):
+            if level == "#" and idx != len(levels) - 1:
+                raise ValueError(f"'#' must be the last level ({topic_filter})")  # noqa
+            if level not in ("+", "#") and ("+" in level or "#" in level):
+                raise ValueError(f"Invalid wildcard in {topic_filter}")
+        with self._lock:
+            node = self._root
+            for level in levels[:-1]:
+                node = node.children.setdefault(level, _Node())
+            if levels[-1] == "#":
+                added = node.multi is None
+                node.multi = value
+            else:
+                node = node.children.setdefault(levels[-1], _Node())
+                added = node.value is None
+                node.value = value
+            if added:
+                self._size += 1
+
+    def remove(self, topic_filter):
+        levels = topic_filter.split("/")
+        with self._lock:
+            path = [self._root]
+            for level in levels[:-1]:
+                node = path[-1].children.get(level)
+                if node is None:
+                    return False
+                path.append(node)
+            if levels[-1] == "#":
+                if path[-1].multi is None:
+                    return False
+                path[-1].multi = None
+                prune = levels[:-1]
+            else:
+                node = path[-1].children.get(levels[-1])
+                if node is None or node.value is None:
+                    return False
+                node.value = None
+                path.append(node)
+                prune = levels
+            self._size -= 1
+            # remove nodes that no longer lead to any filter
+            for idx in range(len(prune), 0, -1):
+                node = path[idx]
+                if node.children or node.value is not None or \
+                        node.multi is not None:
+                    break
+                del path[idx - 1].children[prune[idx - 1]]
+        return True
+
+    def match(self, topic):
+        """Return the values of all filters matching `topic`"""
+        levels = topic.split("/")
+        matches = []
+        # reads are lock free, writers only ever change single dict entries
+        stack = [(self._root, 0)]
+        depth = len(levels)
+        while stack:
+            node, idx = stack.pop()
+            if node.multi is not None and not (
+                    idx == 0 and levels[0].startswith("$")):
+                matches.append(node.multi)
+            if idx == depth:
+                if node.value is not None:
+                    matches.append(node.value)
+                continue
+            child = node.children.get(levels[idx])
+            if child is not None:
+                stack.append((child, idx + 1))
+            if idx == 0 and levels[0].startswith("$"):
+                continue
+            child = node.children.get("+")
+            if child is not None:
+                stack.append((child, idx + 1))
+        return matches
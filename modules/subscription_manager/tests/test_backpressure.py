@@ -0,0 +1,102 @@
+import pytest
+
+from subscription_manager.subscriber import backpressure
+from subscription_manager.subscriber.backpressure import (
+    ADMIT, BackpressureController, NORMAL, PAUSE, SHED, THROTTLE)
+
+
+@pytest.fixture
+def controller():
+    depth = [0]
+    released, dropped = [], []
+    controller = BackpressureController(hold=3, on_release=released.append,
+                                        on_dropped=dropped.extend)
+    controller._queue_depth = lambda: depth[0]
+    controller.watermarks = {THROTTLE: 10, SHED: 20, PAUSE: 30}
+
+    def sample(value):
+        depth[0] = value
+        controller.sample()
+
+    controller.set_depth = sample
+    controller.released = released
+    controller.dropped = dropped
+    return controller
+
+
+def test_states_follow_depth_with_hysteresis(controller):
+    controller.set_depth(5)
+    assert controller.state == NORMAL
+    controller.set_depth(25)
+    assert controller.state == SHED
+    controller.set_depth(35)
+    assert controller.state == PAUSE
+    # within the hysteresis band of pause
+    controller.set_depth(25)
+    assert controller.state == PAUSE
+    controller.set_depth(15)
+    assert controller.state == THROTTLE
+    controller.set_depth(0)
+    assert controller.state == NORMAL
+
+
+def test_decisions(controller):
+    assert controller.decide() == ADMIT
+    controller.set_depth(25)
+    assert controller.decide(priority=1) == SHED
+    controller.set_depth(35)
+    assert controller.decide() == PAUSE
+    assert not controller.admit()
+
+
+def test_throttle_admits_at_the_minimum_rate(controller, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(backpressure.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(backpressure, "BACKPRESSURE_MIN_RATE", 2)
+    controller._refilled = now[0]
+    controller.set_depth(15)
+    now[0] += 1
+    decisions = [controller.decide() for _ in range(4)]
+    assert decisions == [ADMIT, ADMIT, THROTTLE, THROTTLE]
+
+
+def test_paused_jobs_are_held_and_released(controller):
+    controller.set_depth(35)
+    for job in range(2):
+        assert controller.decide() == PAUSE
+        controller.hold(job)
+    assert controller.release() == 0
+    assert controller.status()["held"] == 2
+    controller.set_depth(0)
+    assert controller.release() == 2
+    assert controller.released == [0, 1]
+    assert controller.dropped == []
+
+
+def test_hold_is_bounded(controller):
+    controller.set_depth(35)
+    for job in range(5):
+        controller.hold(job)
+    assert controller.dropped == [0, 1]
+    assert controller.drop_held() == 3
+    assert controller.dropped == [0, 1, 2, 3, 4]
+
+
+def test_low_priority_held_jobs_are_shed_on_release(controller):
+    controller.set_depth(35)
+    controller.hold("low", priority=1)
+    controller.hold("high", priority=9)
+    controller.set_depth(22)  # below the hysteresis band of pause
+    assert controller.state == SHED
+    controller._take_token = lambda: True
+    controller.release()
+    assert controller.dropped == ["low"]
+    assert controller.released == ["high"]
+
+
+def test_queue_keys_follow_the_transport_options():
+    assert backpressure._queue_keys("celery", {}) == [
+        "celery", "celery\x06\x163", "celery\x06\x166", "celery\x06\x169"]
+    assert backpressure._queue_keys("celery", {
+        "sep": ":", "priority_steps": list(range(10))[::5],
+        "global_keyprefix": "wis2_"}) == ["wis2_celery", "wis2_celery:5"]
@@ -0,0 +1,95 @@
+import fakeredis
+import pytest
+
+from subscription_manager.subscriber.dedup import (Deduplicator,
+                                                   notification_keys)
+
+
+def notification(id, data_id="wis2/obs/0-20000-0-10384/20240101T0000",
+                 hash=None):
+    properties = {"data_id": data_id}
+    if hash is not None:
+        properties["integrity"] = {"method": "sha512", "value": hash}
+    return {"id": id, "properties": properties}
+
+
+def test_keys_with_integrity():
+    assert notification_keys(notification("a", hash="abc")) == [
+        "id:a", "data:wis2/obs/0-20000-0-10384/20240101T0000|abc"]
+
+
+def test_keys_without_integrity_use_message_id_only():
+    assert notification_keys(notification("a")) == ["id:a"]
+    assert notification_keys({"properties": {"data_id": "x"}}) == []
+
+
+@pytest.fixture(params=["local", "shared"])
+def dedup(request):
+    dedup = Deduplicator(window=60, max_entries=100)
+    if request.param == "shared":
+        dedup._redis = fakeredis.FakeRedis()
+    return dedup
+
+
+def test_same_message_id(dedup):
+    assert not dedup.is_duplicate(notification("a", hash="1"))
+    assert dedup.is_duplicate(notification("a", hash="1"))
+
+
+def test_republished_by_another_cache(dedup):
+    assert not dedup.is_duplicate(notification("a", hash="1"))
+    assert dedup.is_duplicate(notification("b", hash="1"))
+
+
+def test_updates_without_integrity_are_kept(dedup):
+    assert not dedup.is_duplicate(notification("a"))
+    assert not dedup.is_duplicate(notification("b"))
+
+
+def test_updated_data_is_kept(dedup):
+    assert not dedup.is_duplicate(notification("a", hash="1"))
+    assert not dedup.is_duplicate(notification("b", hash="2"))
+
+
+def test_forget_lets_the_next_copy_through(dedup):
+    assert not dedup.is_duplicate(notification("a", hash="1"))
+    dedup.forget(notification("a", hash="1"))
+    assert not dedup.is_duplicate(notification("b", hash="1"))
+    assert dedup.stats()["forgotten"] == 1
+
+
+def test_shared_between_processes():
+    client = fakeredis.FakeRedis()
+    first, second = Deduplicator(window=60), Deduplicator(window=60)
+    first._redis = second._redis = client
+    assert not first.is_duplicate(notification("a", hash="1"))
+    assert second.is_duplicate(notification("b", hash="1"))
+    assert second.stats()["shared_hits"] == 1
+
+
+def test_window_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("subscription_manager.subscriber.dedup.time."
+                        "monotonic", lambda: now[0])
+    dedup = Deduplicator(window=60)
+    assert not dedup.is_duplicate(notification("a"))
+    now[0] += 61
+    assert not dedup.is_duplicate(notification("a"))
+
+
+def test_bounded_entries():
+    dedup = Deduplicator(window=60, max_entries=10)
+    for idx in range(20):
+        dedup.is_duplicate(notification(str(idx)))
+    assert dedup.stats()["entries"] == 10
+    assert not dedup.is_duplicate(notification("0"))
+
+
+def test_shared_errors_fall_back_to_local():
+    dedup = Deduplicator(window=60)
+    server = fakeredis.FakeServer()
+    server.connected = False
+    dedup._redis = fakeredis.FakeRedis(server=server)
+    assert not dedup.is_duplicate(notification("a", hash="1"))
+    dedup.forget(notification("a", hash="1"))
+    assert dedup.stats()["shared_errors"] == 2
@@ -0,0 +1,173 @@
+import base64
+import json
+
+from celery import Celery
+import fakeredis
+from kombu.transport import redis as kombu_redis
+import pytest
+
+try:
+    from subscription_manager.subscriber import enqueue
+except (ImportError, KeyError) as e:
+    # the task manager, its dependencies and POSTGRES_* settings
+    pytest.skip(f"task manager unavailable: {e}", allow_module_level=True)
+
+
+@pytest.fixture
+def redis_app(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        kombu_redis.Channel, "_create_client",
+        lambda self, asynchronous=False: fakeredis.FakeStrictRedis(
+            server=server))
+    app = Celery("test", broker="redis://localhost:6379/0")
+    monkeypatch.setattr(enqueue, "celery_app", app)
+
+    @app.task(name="test.echo")
+    def echo(value):
+        return value
+
+    return app, echo, fakeredis.FakeStrictRedis(server=server)
+
+
+class FakeSignature():
+    # fails when published through a producer for the listed jobs
+    def __init__(self, job, calls, fail=()):
+        self.job = job
+        self.calls = calls
+        self.fail = fail
+
+    def apply_async(self, producer=None):
+        if producer is not None and self.job["n"] in self.fail:
+            raise ConnectionError("lost connection")
+        self.calls.append((self.job["n"], producer is not None))
+
+
+def buffer(workflow, **kwargs):
+    # published by hand, the background thread is stopped straight away
+    enqueue_buffer = enqueue.EnqueueBuffer(workflow=workflow, **kwargs)
+    enqueue_buffer.stop()
+    return enqueue_buffer
+
+
+def test_pipelined_messages_match_kombu(redis_app):
+    app, echo, client = redis_app
+    echo.s(0).apply_async()
+    expected = json.loads(client.rpop("celery"))
+
+    enqueue_buffer = buffer(lambda job: echo.s(job["n"]))
+    enqueue_buffer._publish([{"n": n} for n in range(1, 4)])
+    messages = [json.loads(message)
+                for message in reversed(client.lrange("celery", 0, -1))]
+
+    assert enqueue_buffer.counters["published"] == 3
+    for n, message in enumerate(messages, 1):
+        assert message.keys() == expected.keys()
+        assert message["properties"].keys() == expected["properties"].keys()
+        assert message["properties"]["delivery_info"] == \
+            expected["properties"]["delivery_info"]
+        # task protocol 2 body: args, kwargs, embed
+        assert json.loads(base64.b64decode(message["body"]))[0] == [n]
+    assert len({message["properties"]["delivery_tag"]
+                for message in messages}) == 3
+
+
+def test_pipelined_failure_republishes_individually(redis_app):
+    calls = []
+    enqueue_buffer = buffer(lambda job: FakeSignature(job, calls, fail={2}))
+    enqueue_buffer._publish([{"n": n} for n in range(4)])
+    # nothing was sent by the pipeline, each task is published on its own
+    assert calls == [(0, True), (1, True), (0, False), (1, False),
+                     (2, False), (3, False)]
+    assert redis_app[2].llen("celery") == 0
+    assert enqueue_buffer.counters["published"] == 4
+    assert enqueue_buffer.counters["failed_batches"] == 1
+
+
+def test_failure_republishes_only_unsent(monkeypatch):
+    monkeypatch.setattr(enqueue, "celery_app",
+                        Celery("test", broker="memory://"))
+    calls = []
+    enqueue_buffer = buffer(lambda job: FakeSignature(job, calls, fail={2}))
+    enqueue_buffer._publish([{"n": n} for n in range(4)])
+    assert calls == [(0, True), (1, True), (2, False), (3, False)]
+    assert enqueue_buffer.counters["published"] == 4
+
+
+def test_download_batches_count_jobs(monkeypatch):
+    monkeypatch.setattr(enqueue, "celery_app",
+                        Celery("test", broker="memory://"))
+    batches = []
+
+    class BatchSignature(FakeSignature):
+        def apply_async(self, producer=None):
+            batches.append([job["n"] for job in self.job])
+
+    enqueue_buffer = buffer(None, download_batch=2,
+                            batch_workflow=lambda jobs: BatchSignature(
+                                jobs, []))
+    enqueue_buffer._publish([{"n": n} for n in range(5)])
+    assert batches == [[0, 1], [2, 3], [4]]
+    assert enqueue_buffer.counters["published"] == 5
+
+
+def test_unpublished_jobs_are_reported(monkeypatch):
+    monkeypatch.setattr(enqueue, "celery_app",
+                        Celery("test", broker="memory://"))
+    dropped = []
+
+    class Unpublishable(FakeSignature):
+        def apply_async(self, producer=None):
+            if self.job["n"] == 1:
+                raise ConnectionError("lost connection")
+
+    enqueue_buffer = buffer(lambda job: Unpublishable(job, []),
+                            on_dropped=dropped.extend)
+    enqueue_buffer._publish([{"n": n} for n in range(3)])
+    assert dropped == [{"n": 1}]
+    assert enqueue_buffer.counters["published"] == 2
+    assert enqueue_buffer.counters["dropped"] == 1
+
+
+def test_alternates_registered_for_every_job(monkeypatch):
+    from task_manager import shared
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(shared, "_redis", client)
+    monkeypatch.setattr(enqueue, "celery_app",
+                        Celery("test", broker="memory://"))
+    jobs = [{"n": n, "payload": {
+        "properties": {"data_id": f"synop/{n}",
+                       "integrity": {"method": "sha512", "value": "abc"}},
+        "links": [{"rel": "canonical",
+                   "href": f"https://cache-a.example.org/{n}"}]}}
+        for n in range(2)]
+    enqueue_buffer = buffer(lambda job: FakeSignature(job, []),
+                            alternates=True)
+    enqueue_buffer._publish(jobs)
+    assert client.hgetall("wis2:cache:alt:synop/1|abc") == {
+        b"cache-a.example.org": b"https://cache-a.example.org/1"}
+
+
+def test_fanout_exchange_is_not_pipelined(redis_app):
+    from kombu import Exchange, Queue
+    app, echo, client = redis_app
+    queue = Queue("test.fanout.q", Exchange("test.fanout", type="fanout"))
+    with app.connection_for_write() as connection:
+        queue(connection.default_channel).declare()
+    enqueue_buffer = buffer(lambda job: echo.s(job["n"]).set(queue=queue))
+    enqueue_buffer._publish([{"n": n} for n in range(2)])
+    # nothing pushed to a list by the pipeline, both sent on their own
+    assert client.llen("test.fanout.q") == 0
+    assert client.llen("celery") == 0
+    assert enqueue_buffer.counters["failed_batches"] == 1
+    assert enqueue_buffer.counters["published"] == 2
+
+
+def test_untested_kombu_is_not_pipelined(redis_app, monkeypatch):
+    monkeypatch.setattr(enqueue, "KOMBU_TESTED", ((4, 0), (5, 0)))
+    calls = []
+    enqueue_buffer = buffer(lambda job: FakeSignature(job, calls))
+    enqueue_buffer._publish([{"n": n} for n in range(2)])
+    # published through the producer, message by message
+    assert calls == [(0, True), (1, True)]
+    assert enqueue_buffer.counters["failed_batches"] == 0
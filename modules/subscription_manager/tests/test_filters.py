@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from subscription_manager.subscriber.filters import NotificationFilter
+
+TOPIC = "cache/a/wis2/de-dwd-gts-to-wis2/data/core/weather/surface-based-observations/synop"  # noqa
+DATA_ID = "de-dwd-gts-to-wis2/data/core/weather/surface-based-observations/synop/WIGOS_0-20000-0-10384_20240101T000000"  # noqa
+
+
+def payload(data_id=DATA_ID, **properties):
+    return {"properties": dict(properties, data_id=data_id)}
+
+
+def test_empty_filter_accepts_everything():
+    notification_filter = NotificationFilter({"wsi": "", "max_age": None})
+    assert not notification_filter
+    assert notification_filter.rejected_by(TOPIC, payload()) is None
+
+
+def test_unknown_and_invalid_filters():
+    with pytest.raises(ValueError):
+        NotificationFilter({"station": "x"})
+    with pytest.raises(ValueError):
+        NotificationFilter({"data_id_regex": "("})
+    with pytest.raises(ValueError):
+        NotificationFilter({"max_age": "soon"})
+
+
+def test_centre_id():
+    notification_filter = NotificationFilter(
+        {"centre_id": "de-dwd-gts-to-wis2,fr-meteofrance"})
+    assert notification_filter.rejected_by(TOPIC, payload()) is None
+    assert notification_filter.rejected_by(
+        TOPIC.replace("de-dwd-gts-to-wis2", "ca-eccc-msc"),
+        payload()) == "centre_id"
+    assert notification_filter.rejected_by("cache/a", payload()) == \
+        "centre_id"
+
+
+def test_data_id_prefix_and_regex():
+    notification_filter = NotificationFilter({
+        "data_id_prefix": ["de-dwd-gts-to-wis2/data/core/weather"],
+        "data_id_regex": r"_\d{8}T"})
+    assert notification_filter.rejected_by(TOPIC, payload()) is None
+    assert notification_filter.rejected_by(
+        TOPIC, payload("other/" + DATA_ID)) == "data_id_prefix"
+    assert notification_filter.rejected_by(
+        TOPIC, payload(DATA_ID.replace("T000000", ""))) == "data_id_regex"
+
+
+def test_wsi_property():
+    notification_filter = NotificationFilter({"wsi": "0-20000-0-10384"})
+    assert notification_filter.rejected_by(
+        TOPIC, payload("x", wigos_station_identifier="0-20000-0-10384")) \
+        is None
+    assert notification_filter.rejected_by(
+        TOPIC, payload(DATA_ID, wigos_station_identifier="0-20000-0-10385")) \
+        == "wsi"
+
+
+@pytest.mark.parametrize("wsi, rejected", [
+    ("0-20000-0-10384", None),
+    ("0-20000-0-1038", "wsi"),
+    ("20000-0-10384", "wsi"),
+    ("0-20000-0-103", "wsi"),
+])
+def test_wsi_in_data_id_matches_whole_identifiers(wsi, rejected):
+    notification_filter = NotificationFilter({"wsi": [wsi]})
+    assert notification_filter.rejected_by(TOPIC, payload()) == rejected
+
+
+def test_wsi_at_the_end_of_the_data_id():
+    notification_filter = NotificationFilter({"wsi": ["0-20000-0-10384"]})
+    assert notification_filter.rejected_by(
+        TOPIC, payload("synop/0-20000-0-10384")) is None
+
+
+def test_max_age():
+    notification_filter = NotificationFilter({"max_age": 3600})
+    now = datetime.now(timezone.utc)
+    recent = (now - timedelta(minutes=5)).isoformat()
+    old = (now - timedelta(hours=2)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    assert notification_filter.rejected_by(
+        TOPIC, payload(datetime=recent)) is None
+    assert notification_filter.rejected_by(
+        TOPIC, payload(end_datetime=old)) == "max_age"
+    # no usable time, kept
+    assert notification_filter.rejected_by(
+        TOPIC, payload(datetime="yesterday")) is None
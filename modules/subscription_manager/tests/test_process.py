@@ -0,0 +1,26 @@
+import pytest
+
+try:
+    from subscription_manager.subscriber.process import (
+        start_subscriber_process)
+except (ImportError, KeyError) as e:
+    # the task manager, its dependencies and POSTGRES_* settings
+    pytest.skip(f"task manager unavailable: {e}", allow_module_level=True)
+
+TOPIC = "cache/a/wis2/+/data/core/weather/surface-based-observations/synop"
+
+
+def test_subscriber_in_a_separate_process():
+    manager, subscriber = start_subscriber_process(brokers=[])
+    try:
+        assert subscriber.subscribe(TOPIC, "test")[TOPIC]["target"] == "test"
+        assert list(subscriber.subscriptions()) == [TOPIC]
+        assert subscriber.statistics()["unmatched"]["messages"] == 0
+        assert subscriber.backpressure_status()["state"] == "normal"
+        with pytest.raises(ValueError):
+            subscriber.subscribe("cache/#/wis2", "test")
+        subscriber.unsubscribe(TOPIC)
+        assert subscriber.subscriptions() == {}
+    finally:
+        subscriber.stop()
+        manager.shutdown()
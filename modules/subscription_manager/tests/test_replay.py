@@ -0,0 +1,127 @@
+import gzip
+import json
+
+from celery import canvas
+import pytest
+
+from subscription_manager.subscriber import replay
+from subscription_manager.subscriber.replay import (read_recording, Recorder,
+                                                    Replayer)
+
+try:
+    import subscription_manager.subscriber as subscriber_package
+    from subscription_manager.subscriber import Subscriber
+except (ImportError, KeyError) as e:
+    # the task manager, its dependencies and POSTGRES_* settings
+    pytest.skip(f"task manager unavailable: {e}", allow_module_level=True)
+
+TOPIC = "cache/a/wis2/ca-eccc-msc/data/core/weather/surface-based-observations/synop"  # noqa
+
+
+def message(id):
+    return json.dumps({
+        "id": id,
+        "properties": {"data_id": f"synop/{id}",
+                       "integrity": {"method": "sha512", "value": id}},
+        "links": [{"rel": "canonical", "href": f"https://example.org/{id}"}]
+    }).encode()
+
+
+@pytest.fixture
+def recording(tmp_path):
+    path = str(tmp_path / "wis2.jsonl.gz")
+    recorder = Recorder(path, flush_interval=0)
+    for n in range(3):
+        recorder.record(TOPIC, message(str(n)), "broker-1",
+                        received=1000.0 + n)
+    # a copy of the first notification through another broker
+    recorder.record(TOPIC, message("0"), "broker-2", received=1003.0)
+    recorder.close()
+    return path
+
+
+def test_record_round_trip(tmp_path):
+    path = str(tmp_path / "wis2.jsonl.gz")
+    recorder = Recorder(path)
+    recorder.record(TOPIC, message("a"), "broker-1", received=1.5)
+    recorder.record("binary/topic", b"\xff\x00", None, received=2.5)
+    recorder.close()
+    # appending adds a gzip member, both are read back
+    recorder = Recorder(path)
+    recorder.record(TOPIC, message("b"), "broker-2", received=3.5)
+    recorder.close()
+    assert recorder.records == 1
+    assert list(read_recording(path)) == [
+        (1.5, "broker-1", TOPIC, message("a")),
+        (2.5, None, "binary/topic", b"\xff\x00"),
+        (3.5, "broker-2", TOPIC, message("b"))]
+
+
+def test_truncated_recording_is_read_up_to_the_cut(tmp_path):
+    path = str(tmp_path / "wis2.jsonl.gz")
+    with gzip.open(path, "wt", encoding="utf-8") as fh:
+        fh.write(json.dumps({"received": 1, "broker": "b", "topic": "t",
+                             "payload": "{}"}) + "\n")
+        fh.write('{"received": 2, "topic": "t", "pay')
+    assert list(read_recording(path)) == [(1, "b", "t", b"{}")]
+
+
+@pytest.fixture
+def subscriber(monkeypatch):
+    subscriber = Subscriber(brokers=[])
+    subscriber.enqueue.stop()
+    subscriber.enqueued = []
+
+    def put(job):
+        subscriber.enqueued.append(job["payload"]["id"])
+        return True
+
+    monkeypatch.setattr(subscriber.enqueue, "put", put)
+    subscriber.subscribe(TOPIC, "test")
+    yield subscriber
+    subscriber.stop()
+
+
+def test_replay_through_the_subscriber(subscriber, recording):
+    replayer = Replayer(subscriber, speed=None)
+    report = replayer.run(read_recording(recording), drain_timeout=1)
+    assert subscriber.enqueued == ["0", "1", "2"]
+    assert (report["sent"], report["processed"], report["lost"],
+            report["errors"]) == (4, 4, 0, 0)
+    assert report["outcomes"]["enqueued"] == 3
+    assert report["outcomes"]["duplicate"] == 1
+    assert report["speed"] == "max"
+    assert report["latency_ms"]["p50"] is not None
+
+
+def test_replay_limit(subscriber, recording):
+    report = Replayer(subscriber, speed=None).run(read_recording(recording),
+                                                  limit=2, drain_timeout=1)
+    assert report["sent"] == report["processed"] == 2
+    assert subscriber.enqueued == ["0", "1"]
+
+
+def test_dry_run_publishes_nothing(recording, monkeypatch, capsys):
+    published = []
+    monkeypatch.setattr(canvas.Signature, "apply_async",
+                        lambda self, *args, **kwargs: published.append(self))
+    subscribers = []
+
+    class RecordingSubscriber(Subscriber):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            subscribers.append(self)
+
+    monkeypatch.setattr(subscriber_package, "Subscriber", RecordingSubscriber)
+    monkeypatch.setattr("sys.argv", [
+        "subscription_replay", recording, "--speed", "max", "--dry-run",
+        "--subscribe", "cache/a/wis2/#", "--drain-timeout", "1"])
+    replay.main()
+    report = json.loads(capsys.readouterr().out)
+    assert report["processed"] == 4
+    assert report["outcomes"]["enqueued"] == 3
+    # the buffer is flushed on stop, every job counted and none sent
+    enqueue = subscribers[0].enqueue
+    assert enqueue.counters["published"] == 3
+    assert enqueue.counters["failed_batches"] == 0
+    assert published == []
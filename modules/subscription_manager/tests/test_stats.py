@@ -0,0 +1,90 @@
+import re
+
+from subscription_manager.subscriber import stats as stats_module
+from subscription_manager.subscriber.stats import SubscriptionStats
+
+TOPIC = "cache/a/wis2/+/data/core/#"
+# label values are quoted strings with \, " and newlines escaped
+SAMPLE = re.compile(r'^([a-z0-9_]+)'
+                    r'(?:\{((?:[a-z]+="(?:[^"\\\n]|\\.)*",?)*)\})? (\S+)$')
+
+
+def samples(text):
+    parsed = []
+    for line in text.splitlines():
+        if line.startswith("#"):
+            continue
+        match = SAMPLE.match(line)
+        assert match, line
+        parsed.append((match.group(1), match.group(2) or "",
+                       float(match.group(3))))
+    return parsed
+
+
+def test_metric_names_and_types():
+    stats = SubscriptionStats()
+    stats.record(TOPIC, 100, "enqueued", 0.0002)
+    text = stats.prometheus()
+    assert text.endswith("\n")
+    types = dict(re.findall(r"^# TYPE (\S+) (\S+)$", text, re.MULTILINE))
+    assert types == {
+        "wis2_subscription_messages_total": "counter",
+        "wis2_subscription_messages_per_second": "gauge",
+        "wis2_subscription_bytes_total": "counter",
+        "wis2_subscription_outcomes_total": "counter",
+        "wis2_subscription_latency_seconds": "histogram",
+        "wis2_unmatched_messages_total": "counter",
+        "wis2_unmatched_bytes_total": "counter"
+    }
+    assert {name for name, _, _ in samples(text)} == (
+        set(types) - {"wis2_subscription_latency_seconds"}) | {
+        "wis2_subscription_latency_seconds_bucket",
+        "wis2_subscription_latency_seconds_sum",
+        "wis2_subscription_latency_seconds_count"}
+
+
+def test_labels_and_values():
+    stats = SubscriptionStats()
+    stats.record(TOPIC, 100, "enqueued", 0.0002)
+    stats.record(TOPIC, 50, "duplicate", 2.0)
+    stats.record_unmatched(7)
+    parsed = samples(stats.prometheus({TOPIC: "dataset-1"}))
+    labels = f'subscription="{TOPIC}",target="dataset-1"'
+    assert ("wis2_subscription_messages_total", labels, 2) in parsed
+    assert ("wis2_subscription_bytes_total", labels, 150) in parsed
+    assert ("wis2_subscription_outcomes_total",
+            f'{labels},outcome="duplicate"', 1) in parsed
+    assert ("wis2_subscription_outcomes_total",
+            f'{labels},outcome="dropped"', 0) in parsed
+    # cumulative buckets, +Inf holds every observation
+    buckets = [(label, value) for name, label, value in parsed
+               if name == "wis2_subscription_latency_seconds_bucket"]
+    assert len(buckets) == len(stats_module.LATENCY_BUCKETS) + 1
+    assert buckets[0] == (f'{labels},le="0.0001"', 0)
+    assert (f'{labels},le="0.00025"', 1) in buckets
+    assert buckets[-1] == (f'{labels},le="+Inf"', 2)
+    assert ("wis2_subscription_latency_seconds_count", labels, 2) in parsed
+    assert ("wis2_unmatched_messages_total", "", 1) in parsed
+    assert ("wis2_unmatched_bytes_total", "", 7) in parsed
+
+
+def test_topic_labels_are_escaped():
+    topic = 'odd/"quoted"\\topic\nnext'
+    stats = SubscriptionStats()
+    stats.record(topic, 1, "enqueued", 0.001)
+    text = stats.prometheus()
+    assert 'subscription="odd/\\"quoted\\"\\\\topic\\nnext"' in text
+    # every sample is still a single, parseable line
+    assert len(samples(text)) == len(
+        [line for line in text.splitlines() if not line.startswith("#")])
+    assert ('wis2_subscription_messages_total',
+            'subscription="odd/\\"quoted\\"\\\\topic\\nnext",target=""',
+            1) in samples(text)
+
+
+def test_removed_subscription_is_not_exported():
+    stats = SubscriptionStats()
+    stats.record(TOPIC, 1, "enqueued", 0.001)
+    stats.remove(TOPIC)
+    assert [name for name, _, _ in samples(stats.prometheus())] == [
+        "wis2_unmatched_messages_total", "wis2_unmatched_bytes_total"]
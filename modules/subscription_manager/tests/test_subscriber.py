@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+from subscription_manager.subscriber.backpressure import (NORMAL, PAUSE, SHED,
+                                                           THROTTLE)
+
+try:
+    from subscription_manager.subscriber import Subscriber
+except (ImportError, KeyError) as e:
+    # the task manager, its dependencies and POSTGRES_* settings
+    pytest.skip(f"task manager unavailable: {e}", allow_module_level=True)
+
+TOPIC = "cache/a/wis2/ca-eccc-msc/data/core/weather/surface-based-observations/synop"  # noqa
+
+
+def message(id, hash="abc"):
+    return json.dumps({
+        "id": id,
+        "properties": {"data_id": "synop/1",
+                       "integrity": {"method": "sha512", "value": hash}},
+        "links": [{"rel": "canonical", "href": "https://example.org/1"}]
+    }).encode()
+
+
+@pytest.fixture
+def subscriber(monkeypatch):
+    subscriber = Subscriber(brokers=[])
+    subscriber.enqueue.stop()
+    subscriber.enqueued = []
+
+    def put(job):
+        subscriber.enqueued.append(job["payload"]["id"])
+        return True
+
+    monkeypatch.setattr(subscriber.enqueue, "put", put)
+    subscriber.subscribe(TOPIC, "test", priority=1)
+    yield subscriber
+    subscriber.stop()
+
+
+def outcomes(subscriber):
+    counts = subscriber.stats.as_dict()["subscriptions"][TOPIC]["outcomes"]
+    return {outcome: count for outcome, count in counts.items() if count}
+
+
+def test_duplicates_are_dropped(subscriber):
+    subscriber.process(TOPIC, message("a"), "broker-1", None)
+    subscriber.process(TOPIC, message("b"), "broker-2", None)
+    assert subscriber.enqueued == ["a"]
+
+
+def test_shed_notifications_are_not_recorded(subscriber):
+    subscriber.backpressure.state = SHED
+    subscriber.process(TOPIC, message("a"), "broker-1", None)
+    assert subscriber.enqueued == []
+    subscriber.backpressure.state = NORMAL
+    subscriber.process(TOPIC, message("b"), "broker-2", None)
+    assert subscriber.enqueued == ["b"]
+    assert outcomes(subscriber) == {"backpressure": 1, "enqueued": 1}
+
+
+def test_paused_notifications_are_held(subscriber):
+    subscriber.backpressure.state = PAUSE
+    subscriber.process(TOPIC, message("a"), "broker-1", None)
+    # a copy from another broker is still a duplicate of the held one
+    subscriber.process(TOPIC, message("b"), "broker-2", None)
+    assert subscriber.enqueued == []
+    assert outcomes(subscriber) == {"held": 1, "duplicate": 1}
+    subscriber.backpressure.state = NORMAL
+    subscriber.backpressure.release()
+    assert subscriber.enqueued == ["a"]
+
+
+def test_throttled_notifications_are_held(subscriber):
+    subscriber.backpressure.state = THROTTLE
+    subscriber.backpressure._take_token = lambda: False
+    subscriber.process(TOPIC, message("a"), "broker-1", None)
+    assert subscriber.enqueued == []
+    assert outcomes(subscriber) == {"held": 1}
+    subscriber.backpressure._take_token = lambda: True
+    subscriber.backpressure.release()
+    assert subscriber.enqueued == ["a"]
+
+
+def test_full_buffer_forgets_the_notification(subscriber, monkeypatch):
+    monkeypatch.setattr(subscriber.enqueue, "put", lambda job: False)
+    subscriber.process(TOPIC, message("a"), "broker-1", None)
+    assert subscriber.dedup.stats()["forgotten"] == 1
+    assert not subscriber.dedup.is_duplicate(json.loads(message("b")))
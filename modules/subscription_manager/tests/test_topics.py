@@ -0,0 +1,72 @@
+import pytest
+
+from subscription_manager.subscriber.topics import TopicTrie
+
+SYNOP = "cache/a/wis2/ca-eccc-msc/data/core/weather/surface-based-observations/synop"  # noqa
+
+
+def trie(*filters):
+    topics = TopicTrie()
+    for idx, topic_filter in enumerate(filters):
+        topics.insert(topic_filter, (idx, topic_filter))
+    return topics
+
+
+def test_exact_match():
+    topics = trie(SYNOP)
+    assert topics.match(SYNOP) == [(0, SYNOP)]
+    assert topics.match(SYNOP + "/extra") == []
+
+
+def test_single_level_wildcard():
+    topic_filter = "cache/a/wis2/+/data/core/weather/surface-based-observations/synop"  # noqa
+    topics = trie(topic_filter)
+    assert topics.match(SYNOP) == [(0, topic_filter)]
+    assert topics.match("cache/a/wis2/ca-eccc-msc/data/core/weather/"
+                        "surface-based-observations/temp") == []
+
+
+def test_multi_level_wildcard_matches_parent():
+    topics = trie("cache/a/wis2/#", "cache/a/wis2/ca-eccc-msc/#")
+    assert sorted(topics.match(SYNOP)) == [(0, "cache/a/wis2/#"),
+                                          (1, "cache/a/wis2/ca-eccc-msc/#")]
+    assert sorted(topics.match("cache/a/wis2/ca-eccc-msc")) == [
+        (0, "cache/a/wis2/#"), (1, "cache/a/wis2/ca-eccc-msc/#")]
+    assert topics.match("cache/a/wis2") == [(0, "cache/a/wis2/#")]
+
+
+def test_earliest_subscription_wins():
+    topics = trie("cache/a/wis2/#", SYNOP, "cache/a/wis2/+/data/#")
+    assert min(topics.match(SYNOP)) == (0, "cache/a/wis2/#")
+
+
+def test_leading_wildcard_skips_system_topics():
+    topics = trie("#", "+/broker", "$SYS/broker")
+    assert topics.match("$SYS/broker") == [(2, "$SYS/broker")]
+
+
+def test_remove_prunes_and_keeps_others():
+    topics = trie("cache/a/wis2/#", SYNOP)
+    assert len(topics) == 2
+    assert topics.remove(SYNOP)
+    assert not topics.remove(SYNOP)
+    assert SYNOP not in topics
+    assert "cache/a/wis2/#" in topics
+    assert topics.match(SYNOP) == [(0, "cache/a/wis2/#")]
+    assert topics.remove("cache/a/wis2/#")
+    assert len(topics) == 0
+    assert topics._root.children == {}
+
+
+def test_reinsert_replaces_value():
+    topics = trie(SYNOP)
+    topics.insert(SYNOP, "other")
+    assert len(topics) == 1
+    assert topics.match(SYNOP) == ["other"]
+
+
+@pytest.mark.parametrize("topic_filter", ["cache/#/wis2", "cache/a+/wis2",
+                                          "cache/#a"])
+def test_invalid_filters(topic_filter):
+    with pytest.raises(ValueError):
+        TopicTrie().insert(topic_filter, None)
@@ -92,7 +92,9 @@ setup(
     include_package_data=True,
     entry_points={
         'console_scripts': [
-            'task_manager_start=task_manager.worker:main'
+            'task_manager_start=task_manager.worker:main',
+            'task_manager_deadletter=task_manager.deadletter:main',
+            'task_manager_ingest=task_manager.ingest:main'
         ]
     },
     classifiers=[
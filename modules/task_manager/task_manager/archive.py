@@ -0,0 +1,158 @@
+import datetime as dt
+import os
+from pathlib import Path
+import tarfile
+import tempfile
+
+from celery.utils.log import get_task_logger
+
+LOGGER = get_task_logger(__name__)
+
+# days are compacted once they are this many days old, 1 is yesterday
+COMPACT_AFTER_DAYS = int(os.getenv("COMPACT_AFTER_DAYS", 1))
+
+ARCHIVE_SUFFIX = ".tar"
+INDEX_SUFFIX = ".tar.idx"
+_BLOCK = tarfile.BLOCKSIZE
+
+
+def archive_paths(day_directory):
+    # <dataset>/<yyyy>/<mm>/<dd> -> <dataset>/<yyyy>/<mm>/<dd>.tar (+ .idx)
+    day_directory = Path(day_directory)
+    return (day_directory.with_name(day_directory.name + ARCHIVE_SUFFIX),
+            day_directory.with_name(day_directory.name + INDEX_SUFFIX))
+
+
+class DailyArchive():
+    """
+    Read access to a day of downloads packed by `compact_day`. The archive
+    is an uncompressed tar, the sidecar index holds the offset and size of
+    every member ("<filename>\\t<offset>\\t<size>" per line) so that single
+    files are read with one seek. `scan` reads the whole day sequentially.
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = Path(path)
+        self.index_path = Path(index_path) if index_path is not None else \
+            self.path.with_name(self.path.name[:-len(ARCHIVE_SUFFIX)] +
+                                INDEX_SUFFIX)
+        self.index = read_index(self.index_path)
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def names(self):
+        return list(self.index)
+
+    def read(self, filename):
+        offset, size = self.index[filename]
+        with open(self.path, "rb") as fh:
+            fh.seek(offset)
+            return fh.read(size)
+
+    def scan(self):
+        # (filename, bytes) in archive order
+        with tarfile.open(self.path, "r:") as tar:
+            for member in tar:
+                if member.isfile():
+                    yield member.name, tar.extractfile(member).read()
+
+
+def read_index(index_path):
+    index = {}
+    if not Path(index_path).is_file():
+        return index
+    with open(index_path) as fh:
+        for line in fh:
+            name, offset, size = line.rstrip("\n").rsplit("\t", 2)
+            index[name] = (int(offset), int(size))
+    return index
+
+
+def _write_index(index_path, index):
+    fd, tmp = tempfile.mkstemp(dir=Path(index_path).parent,
+                               prefix=f".{Path(index_path).name}.")
+    with os.fdopen(fd, "w") as fh:
+        for name, (offset, size) in index.items():
+            fh.write(f"{name}\t{offset}\t{size}\n")
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, index_path)
+
+
+def read_download(path):
+    """Bytes of a downloaded file, loose or packed in its daily archive"""
+    path = Path(path)
+    try:
+        with open(path, "rb") as fh:
+            return fh.read()
+    except FileNotFoundError:
+        archive_path, index_path = archive_paths(path.parent)
+        if not index_path.is_file():
+            raise
+        archive = DailyArchive(archive_path, index_path)
+        if path.name not in archive:
+            raise
+        return archive.read(path.name)
+
+
+def compact_day(day_directory):
+    """
+    Pack the files of a finished day into <dd>.tar with an offset index and
+    remove them, returns the number of files packed. Files for a day that
+    has already been compacted are appended. The index is only replaced
+    once the archive is on disk and the files are removed after that, so an
+    interrupted run loses nothing and is picked up by the next.
+    """
+    day_directory = Path(day_directory)
+    archive_path, index_path = archive_paths(day_directory)
+    # skip in flight downloads (.<name>.part)
+    files = sorted(path for path in day_directory.iterdir()
+                   if path.is_file() and not path.name.startswith("."))
+    if not files:
+        return 0
+    index = read_index(index_path)
+    if archive_path.exists():
+        # drop anything written after the last indexed member, e.g. by an
+        # interrupted run, before appending
+        end = max((offset + -(-size // _BLOCK) * _BLOCK
+                   for offset, size in index.values()), default=0)
+        with open(archive_path, "r+b") as fh:
+            fh.truncate(end)
+            fh.seek(end)
+            fh.write(tarfile.NUL * 2 * _BLOCK)  # end of archive marker
+    mode = "a:" if archive_path.exists() and index else "w:"
+    with tarfile.open(archive_path, mode) as tar:
+        for path in files:
+            tar.add(path, arcname=path.name, recursive=False)
+    with tarfile.open(archive_path, "r:") as tar:
+        # offsets of the latest copy of each name
+        for member in tar:
+            if member.isfile():
+                index[member.name] = (member.offset_data, member.size)
+    with open(archive_path, "rb+") as fh:
+        os.fsync(fh.fileno())
+    _write_index(index_path, index)
+    for path in files:
+        path.unlink()
+    try:
+        day_directory.rmdir()
+    except OSError:
+        pass  # a download arrived for the day in the meantime
+    LOGGER.info(f"Compacted {len(files)} files into {archive_path}")
+    return len(files)
+
+
+def days_to_compact(basepath, after_days: int = COMPACT_AFTER_DAYS):
+    # <basepath>/<dataset>/<yyyy>/<mm>/<dd> directories older than the cutoff
+    cutoff = dt.date.today() - dt.timedelta(days=after_days)
+    for day_directory in sorted(Path(basepath).glob("*/[0-9]*/[0-9]*/[0-9]*")):
+        if not day_directory.is_dir():
+            continue
+        try:
+            yyyy, mm, dd = (int(part) for part in day_directory.parts[-3:])
+            day = dt.date(yyyy, mm, dd)
+        except ValueError:
+            continue
+        if day <= cutoff:
+            yield day_directory
@@ -0,0 +1,145 @@
+import os
+import time
+from urllib.parse import urlsplit
+
+from task_manager.shared import get_redis
+
+# minutes of per cache statistics kept and used for ranking
+CACHE_STATS_WINDOW = int(os.getenv("CACHE_STATS_WINDOW", 15))
+# latency assumed for caches without statistics, so they are tried too
+CACHE_UNKNOWN_LATENCY = float(os.getenv("CACHE_UNKNOWN_LATENCY", 0.5))
+# how long alternative links for an object are remembered
+CACHE_ALTERNATES_TTL = int(os.getenv("CACHE_ALTERNATES_TTL", 3600))
+CACHE_MAX_CANDIDATES = int(os.getenv("CACHE_MAX_CANDIDATES", 3))
+
+_PREFIX = "wis2:cache:"
+_FIELDS = ("requests", "errors", "bytes", "seconds", "latency")
+
+
+def alternates_key(data_id, hash_value=None):
+    # the same object republished by several global caches shares data_id
+    # and integrity hash, the link differs
+    return f"{_PREFIX}alt:{data_id}|{hash_value or ''}"
+
+
+def _add_alternates(pipe, payload):
+    properties = payload.get('properties', {})
+    data_id = properties.get('data_id')
+    if data_id is None:
+        return False
+    urls = [link['href'] for link in payload.get('links', [])
+            if link.get('rel') in ('canonical', 'update') and
+            link.get('href')]
+    if not urls:
+        return False
+    key = alternates_key(data_id,
+                         (properties.get('integrity') or {}).get('value'))
+    for url in urls:
+        pipe.hset(key, urlsplit(url).hostname or url, url)
+    pipe.expire(key, CACHE_ALTERNATES_TTL)
+    return True
+
+
+def register_alternates(payload, client=None):
+    """Remember the download links in a notification as equivalents"""
+    register_alternates_many([payload], client)
+
+
+def register_alternates_many(payloads, client=None):
+    """As register_alternates, for many notifications in one round trip"""
+    pipe = (client or get_redis()).pipeline(transaction=False)
+    added = [_add_alternates(pipe, payload) for payload in payloads]
+    if any(added):
+        pipe.execute()
+
+
+class CacheStats():
+    """
+    Rolling per cache (hostname) download statistics in Redis, one hash per
+    cache per minute, shared by all workers. Used to rank equivalent links
+    for the same object.
+    """
+
+    def __init__(self, client=None, window: int = CACHE_STATS_WINDOW):
+        self._client = client
+        self.window = window
+
+    @property
+    def client(self):
+        return self._client or get_redis()
+
+    def record(self, host, ok, latency=None, seconds=None, nbytes=0):
+        minute = int(time.time() // 60)
+        key = f"{_PREFIX}{host}:{minute}"
+        pipe = self.client.pipeline(transaction=False)
+        pipe.sadd(f"{_PREFIX}hosts", host)
+        pipe.hincrby(key, "requests", 1)
+        if ok:
+            pipe.hincrby(key, "bytes", nbytes)
+            pipe.hincrbyfloat(key, "seconds", seconds or 0)
+            pipe.hincrbyfloat(key, "latency", latency or 0)
+        else:
+            pipe.hincrby(key, "errors", 1)
+        pipe.expire(key, (self.window + 1) * 60)
+        pipe.execute()
+
+    def _totals(self, hosts):
+        minute = int(time.time() // 60)
+        pipe = self.client.pipeline(transaction=False)
+        for host in hosts:
+            for offset in range(self.window):
+                pipe.hmget(f"{_PREFIX}{host}:{minute - offset}", *_FIELDS)
+        rows = iter(pipe.execute())
+        totals = {}
+        for host in hosts:
+            total = dict.fromkeys(_FIELDS, 0.0)
+            for _ in range(self.window):
+                for field, value in zip(_FIELDS, next(rows)):
+                    total[field] += float(value or 0)
+            totals[host] = total
+        return totals
+
+    def summary(self, hosts=None):
+        if hosts is None:
+            hosts = sorted(host.decode() for host in
+                           self.client.smembers(f"{_PREFIX}hosts"))
+        summary = {}
+        for host, total in self._totals(hosts).items():
+            requests = int(total["requests"])
+            ok = requests - int(total["errors"])
+            summary[host] = {
+                "requests": requests,
+                "errors": int(total["errors"]),
+                "error_rate": total["errors"] / requests if requests else None,
+                "latency": total["latency"] / ok if ok else None,
+                "throughput": total["bytes"] / total["seconds"]
+                if total["seconds"] else None,
+                "bytes": int(total["bytes"]),
+                "window_minutes": self.window
+            }
+        return summary
+
+    @staticmethod
+    def score(stats):
+        # expected seconds to first byte, inflated by the failure rate
+        if stats is None or stats["requests"] == 0:
+            return CACHE_UNKNOWN_LATENCY
+        latency = stats["latency"]
+        if latency is None:  # nothing but errors
+            latency = CACHE_UNKNOWN_LATENCY * 10
+        return latency / max(1 - (stats["error_rate"] or 0), 0.05)
+
+    def candidates(self, url, key=None):
+        """
+        `url` plus any equivalent links registered under `key`, best first.
+        The list is what the download stage tries in turn on failure.
+        """
+        urls = {urlsplit(url).hostname: url}
+        if key is not None:
+            for host, alternate in self.client.hgetall(key).items():
+                urls.setdefault(host.decode(), alternate.decode())
+        if len(urls) == 1:
+            return [url]
+        summary = self.summary(list(urls))
+        ranked = sorted(urls, key=lambda host: self.score(summary.get(host)))
+        return [urls[host] for host in ranked][:max(1, CACHE_MAX_CANDIDATES)]
@@ -0,0 +1,172 @@
+import argparse
+import datetime as dt
+import json
+import os
+import random
+import uuid
+
+from celery.utils.log import get_task_logger
+
+from task_manager.shared import get_redis
+
+LOGGER = get_task_logger(__name__)
+
+# a failed download is retried DOWNLOAD_MAX_RETRIES times, the n-th retry
+# after DOWNLOAD_RETRY_BACKOFF * 2**n seconds (capped, with jitter). Keep
+# the cap below the broker visibility timeout (1 hour for Redis).
+DOWNLOAD_MAX_RETRIES = int(os.getenv("DOWNLOAD_MAX_RETRIES", 5))
+DOWNLOAD_RETRY_BACKOFF = float(os.getenv("DOWNLOAD_RETRY_BACKOFF", 30))
+DOWNLOAD_RETRY_BACKOFF_MAX = float(os.getenv("DOWNLOAD_RETRY_BACKOFF_MAX",
+                                             900))
+# entries kept in the dead letter queue, the oldest are dropped
+DEADLETTER_MAX = int(os.getenv("DEADLETTER_MAX", 100000))
+
+_PREFIX = "wis2:deadletter"
+
+
+def retry_countdown(retries, base: float = DOWNLOAD_RETRY_BACKOFF,
+                    cap: float = DOWNLOAD_RETRY_BACKOFF_MAX):
+    # exponential backoff with "equal jitter", half the delay is random so
+    # jobs failing together (e.g. a cache outage) are not retried together
+    delay = min(cap, base * 2 ** retries)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class DeadLetterQueue():
+    """
+    Jobs that failed after all retries, kept in Redis for inspection and
+    replay. Entries are stored in a hash by id and ordered by failure time
+    in a sorted set. `replay` removes entries before resubmitting them so
+    that concurrent replays do not submit a job twice.
+    """
+
+    def __init__(self, client=None, max_entries: int = DEADLETTER_MAX):
+        self._client = client
+        self.max_entries = max_entries
+
+    @property
+    def client(self):
+        return self._client or get_redis()
+
+    def push(self, job, error=None, attempts=None, result=None):
+        now = dt.datetime.now(dt.UTC)
+        entry = {
+            "id": uuid.uuid4().hex,
+            "failed": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "error": None if error is None else str(error),
+            "attempts": attempts,
+            "data_id": (result or {}).get("data_id"),
+            "cache": (result or {}).get("cache"),
+            "job": job
+        }
+        pipe = self.client.pipeline()
+        pipe.hset(f"{_PREFIX}:entries", entry["id"], json.dumps(entry))
+        pipe.zadd(_PREFIX, {entry["id"]: now.timestamp()})
+        pipe.execute()
+        self._trim()
+        return entry["id"]
+
+    def _trim(self):
+        excess = self.client.zcard(_PREFIX) - self.max_entries
+        if excess > 0:
+            ids = self.client.zrange(_PREFIX, 0, excess - 1)
+            self._take(ids)
+            LOGGER.warning(f"Dead letter queue full, dropped {len(ids)} "
+                           f"entries")
+
+    def size(self):
+        return self.client.zcard(_PREFIX)
+
+    def list(self, offset: int = 0, limit: int = 100):
+        ids = self.client.zrange(_PREFIX, offset, offset + limit - 1)
+        if not ids:
+            return []
+        entries = self.client.hmget(f"{_PREFIX}:entries", ids)
+        return [json.loads(entry) for entry in entries if entry is not None]
+
+    def get(self, id):
+        entry = self.client.hget(f"{_PREFIX}:entries", id)
+        return json.loads(entry) if entry is not None else None
+
+    def _take(self, ids):
+        # remove and return the entries, only the caller removing an id
+        # from the sorted set gets it
+        taken = []
+        for id in ids:
+            if self.client.zrem(_PREFIX, id):
+                entry = self.client.hget(f"{_PREFIX}:entries", id)
+                self.client.hdel(f"{_PREFIX}:entries", id)
+                if entry is not None:
+                    taken.append(json.loads(entry))
+        return taken
+
+    def replay(self, submit, ids=None, limit: int = None):
+        """
+        Resubmit entries (`ids`, or the oldest `limit`, or all) by calling
+        `submit(job)`, returns the number submitted. Entries that cannot be
+        submitted are put back.
+        """
+        if ids is None:
+            ids = self.client.zrange(_PREFIX, 0,
+                                     -1 if limit is None else limit - 1)
+        submitted = 0
+        for entry in self._take(ids):
+            try:
+                submit(entry["job"])
+                submitted += 1
+            except Exception as e:
+                LOGGER.error(f"Unable to replay {entry['id']}: {e}")
+                pipe = self.client.pipeline()
+                pipe.hset(f"{_PREFIX}:entries", entry["id"],
+                          json.dumps(entry))
+                pipe.zadd(_PREFIX, {entry["id"]: dt.datetime.strptime(
+                    entry["failed"], "%Y-%m-%d %H:%M:%S").replace(
+                    tzinfo=dt.UTC).timestamp()})
+                pipe.execute()
+        return submitted
+
+    def purge(self, ids=None):
+        if ids is None:
+            ids = self.client.zrange(_PREFIX, 0, -1)
+        return len(self._take(ids))
+
+
+def replay_job(job):
+    # imported here, the workflows import the tasks which use this module
+    from task_manager.workflows import wis2_download_and_ingest
+    wis2_download_and_ingest(job).apply_async()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Inspect and replay downloads in the dead letter queue")
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list", help="list entries")
+    list_parser.add_argument("--offset", type=int, default=0)
+    list_parser.add_argument("--limit", type=int, default=100)
+    commands.add_parser("size", help="number of entries")
+    replay_parser = commands.add_parser("replay", help="resubmit entries")
+    replay_parser.add_argument("ids", nargs="*",
+                               help="entries to replay, default all")
+    replay_parser.add_argument("--limit", type=int, default=None,
+                               help="replay at most the oldest LIMIT")
+    purge_parser = commands.add_parser("purge", help="delete entries")
+    purge_parser.add_argument("ids", nargs="*",
+                              help="entries to delete, default all")
+    args = parser.parse_args()
+
+    queue = DeadLetterQueue()
+    if args.command == "list":
+        for entry in queue.list(args.offset, args.limit):
+            print(json.dumps(entry))
+    elif args.command == "size":
+        print(queue.size())
+    elif args.command == "replay":
+        count = queue.replay(replay_job, args.ids or None, args.limit)
+        print(f"Replayed {count} jobs")
+    elif args.command == "purge":
+        print(f"Purged {queue.purge(args.ids or None)} entries")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import asyncio
+import base64
+import hashlib
+import io
+import os
+import time
+
+import urllib3
+
+from task_manager.storage import LocalStorage
+
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", 65536))
+
+
+class DownloadError(Exception):
+    pass
+
+
+class HTTPStatusError(DownloadError):
+    def __init__(self, status, url, retry_after=None):
+        super().__init__(f"HTTP {status} from {url}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _retry_after(value):
+    # only the delay-seconds form, an HTTP date falls back to the default
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_job(job):
+    """
+    Extract the identifiers, download link and integrity information from a
+    WIS2 notification job. The update link, if present, takes precedence
+    over the canonical link.
+    """
+    properties = job['payload']['properties']
+    links = {}
+    for link in job['payload'].get('links', []):
+        if link.get('rel') in ('canonical', 'update'):
+            links[link['rel']] = link
+    link = links.get('update') or links.get('canonical')
+    integrity = properties.get('integrity') or {}
+    return {
+        'data_id': properties['data_id'],
+        'metadata_id': properties.get('metadata_id'),
+        'message_id': job['payload']['id'],
+        'download_url': link['href'] if link else None,
+        'expected_length': link.get('length') if link else None,
+        'overwrite': 'update' in links,
+        'hash_method': integrity.get('method'),
+        'expected_hash': integrity.get('value')
+    }
+
+
+class DownloadWriter():
+    """
+    Writes a download in chunks to `storage` (local files by default)
+    under the key `output_path`, updating the digest as it goes. `commit`
+    makes the download visible only if the length and hash match those
+    advertised in the notification, so readers never see partial or
+    corrupt files. With `in_memory` the download is kept in memory (see
+    `data`) and only written to storage by `commit`, unless it grows beyond
+    `max_memory` bytes, in which case it is moved to storage as it arrives.
+    """
+
+    def __init__(self, output_path, hash_method=None, expected_hash=None,
+                 expected_length=None, in_memory: bool = False,
+                 storage=None, max_memory: int = None):
+        self.storage = storage if storage is not None else LocalStorage()
+        self.output_path = output_path
+        self.hash_method = hash_method
+        self.expected_hash = expected_hash
+        self.expected_length = None
+        if expected_length not in (None, ""):
+            self.expected_length = int(expected_length)
+        self._hash = None
+        hash_function = getattr(hashlib, hash_method, None) if hash_method \
+            else None
+        if hash_function is not None:
+            self._hash = hash_function()
+        self.size = 0
+        self.in_memory = in_memory
+        self.max_memory = max_memory
+        if in_memory:
+            self._buffer = io.BytesIO()
+            self._upload = None
+        else:
+            self._upload = self.storage.upload(output_path)
+        self.committed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.committed:
+            self.discard()
+
+    def check_length(self, content_length):
+        # fail before reading the body if the server disagrees on the length
+        if None in (content_length, self.expected_length):
+            return
+        if int(content_length) != self.expected_length:
+            raise DownloadError(f"Content-Length {content_length} does not "
+                                f"match expected length {self.expected_length}")  # noqa
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.expected_length is not None and \
+                self.size > self.expected_length:
+            raise DownloadError(f"Download exceeds expected length "
+                                f"{self.expected_length}")
+        if self._hash is not None:
+            self._hash.update(chunk)
+        if self.in_memory and self.max_memory is not None and \
+                self.size > self.max_memory:
+            self._spill()
+        if self.in_memory:
+            self._buffer.write(chunk)
+        else:
+            self._upload.write(chunk)
+
+    def _spill(self):
+        # too large to keep in memory, continue in storage
+        self._upload = self.storage.upload(self.output_path)
+        self._upload.write(self._buffer.getvalue())
+        self._buffer = None
+        self.in_memory = False
+
+    @property
+    def hash_value(self):
+        if self._hash is None:
+            return None
+        return base64.b64encode(self._hash.digest()).decode()
+
+    @property
+    def valid_hash(self):
+        if None in (self.hash_value, self.expected_hash):
+            return None
+        return self.hash_value == self.expected_hash
+
+    @property
+    def hexdigest(self):
+        return self._hash.hexdigest() if self._hash is not None else None
+
+    @property
+    def data(self):
+        return self._buffer.getvalue() if self.in_memory else None
+
+    def verify(self):
+        if self.expected_length is not None and \
+                self.size != self.expected_length:
+            raise DownloadError(f"Downloaded {self.size} bytes, expected "
+                                f"{self.expected_length}")
+        if self.valid_hash is False:
+            raise DownloadError(f"{self.hash_method} hash mismatch")
+
+    def commit(self, output_path=None):
+        # output_path allows the destination to depend on the content, for
+        # local storage it must be on the same filesystem as the original
+        if output_path is not None:
+            self.output_path = output_path
+        self.verify()
+        if self.in_memory:
+            self._upload = self.storage.upload(self.output_path)
+        try:
+            if self.in_memory:
+                self._upload.write(self._buffer.getvalue())
+            self._upload.complete(self.output_path)
+        except Exception:
+            self.discard()
+            raise
+        self.committed = True
+
+    def discard(self):
+        if self._upload is not None:
+            self._upload.abort()
+
+
+def stream_download(pool, url, writer, chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+                    timeout: float = None):
+    """
+    Stream `url` into `writer` without holding the body in memory, returns
+    the time (s) taken to receive the response headers. `timeout` bounds
+    the connection and each read (s), by default the pool's timeout applies.
+    """
+    kwargs = {}
+    if timeout is not None:
+        kwargs['timeout'] = urllib3.Timeout(connect=timeout, read=timeout)
+    start = time.perf_counter()
+    response = pool.request('GET', url, preload_content=False, **kwargs)
+    latency = time.perf_counter() - start
+    try:
+        if response.status != 200:
+            raise HTTPStatusError(
+                response.status, url,
+                _retry_after(response.headers.get('Retry-After')))
+        # a compressed transfer changes the length of the decoded body
+        if response.headers.get('Content-Encoding') is None:
+            writer.check_length(response.headers.get('Content-Length'))
+        for chunk in response.stream(chunk_size):
+            writer.write(chunk)
+    finally:
+        response.release_conn()
+    return latency
+
+
+async def stream_download_async(session, url, writer,
+                                chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+    """
+    As stream_download, using an aiohttp ClientSession. Chunks are written
+    to storage from a thread so that the event loop is not blocked.
+    """
+    start = time.perf_counter()
+    async with session.get(url) as response:
+        latency = time.perf_counter() - start
+        if response.status != 200:
+            raise HTTPStatusError(
+                response.status, url,
+                _retry_after(response.headers.get('Retry-After')))
+        if response.headers.get('Content-Encoding') is None:
+            writer.check_length(response.headers.get('Content-Length'))
+        async for chunk in response.content.iter_chunked(chunk_size):
+            if writer.in_memory:
+                writer.write(chunk)
+            else:
+                await asyncio.to_thread(writer.write, chunk)
+    return latency
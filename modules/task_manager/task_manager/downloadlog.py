@@ -0,0 +1,122 @@
+import atexit
+import csv
+from io import StringIO
+import os
+import threading
+import time
+
+from celery.utils.log import get_task_logger
+
+from task_manager.schema import DownloadLog
+
+LOGGER = get_task_logger(__name__)
+
+# records buffered per worker process before they are written, and the
+# longest a record waits in the buffer
+DOWNLOAD_LOG_BATCH = int(os.getenv("DOWNLOAD_LOG_BATCH", 500))
+DOWNLOAD_LOG_INTERVAL = float(os.getenv("DOWNLOAD_LOG_INTERVAL", 10))
+# records kept if the database is unavailable, the oldest are dropped
+DOWNLOAD_LOG_MAX_PENDING = int(os.getenv("DOWNLOAD_LOG_MAX_PENDING", 50000))
+
+COLUMNS = [column.name for column in DownloadLog.__table__.columns
+           if column.name != "id"]
+
+
+class DownloadLogWriter():
+    """
+    Buffers download results and writes them to task_manager.download_log
+    with COPY, either when `batch_size` records are pending or every
+    `interval` seconds from a background thread. `close` writes whatever
+    is left, it is called on worker process shutdown.
+    """
+
+    def __init__(self, engine, batch_size: int = DOWNLOAD_LOG_BATCH,
+                 interval: float = DOWNLOAD_LOG_INTERVAL,
+                 max_pending: int = DOWNLOAD_LOG_MAX_PENDING):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._pid = None
+        self.written = 0
+        self.dropped = 0
+        atexit.register(self.close)
+
+    def _start(self):
+        # the thread does not survive a fork, start one per worker process
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name="download-log")
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def add(self, result):
+        if not result:
+            return
+        with self._lock:
+            self._start()
+            self._pending.append([result.get(column) for column in COLUMNS])
+            overflow = len(self._pending) - self.max_pending
+            if overflow > 0:
+                del self._pending[:overflow]
+                self.dropped += overflow
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return 0
+            buffer = StringIO()
+            csv.writer(buffer).writerows(rows)
+            buffer.seek(0)
+            start = time.perf_counter()
+            try:
+                connection = self.engine.raw_connection()
+                try:
+                    cursor = connection.cursor()
+                    # received / queued / download_* are UTC without offset
+                    cursor.execute("SET LOCAL TIME ZONE 'UTC'")
+                    cursor.copy_expert(
+                        f"COPY task_manager.download_log "
+                        f"({', '.join(COLUMNS)}) FROM STDIN WITH CSV", buffer)
+                    connection.commit()
+                finally:
+                    connection.close()
+            except Exception as e:
+                LOGGER.warning(f"Unable to write {len(rows)} download log "
+                               f"records: {e}")
+                with self._lock:
+                    # keep them for the next attempt
+                    self._pending[:0] = rows
+                    overflow = len(self._pending) - self.max_pending
+                    if overflow > 0:
+                        del self._pending[:overflow]
+                        self.dropped += overflow
+                return 0
+            self.written += len(rows)
+            LOGGER.debug(f"Wrote {len(rows)} download log records in "
+                         f"{time.perf_counter() - start:.3f}s")
+            return len(rows)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self.flush()
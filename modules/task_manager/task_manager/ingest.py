@@ -0,0 +1,229 @@
+import json
+import os
+import signal
+import socket
+import time
+
+from celery.utils.log import get_task_logger
+import redis
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import sessionmaker
+
+from task_manager.ledger import ContentLedger, INGESTED, STORED
+from task_manager.schema import IngestedFile
+from task_manager.shared import get_redis
+from wccdm.utils import resolve_uris
+from wccdm.utils.bulk import write_observations
+
+LOGGER = get_task_logger(__name__)
+
+INGEST_STREAM = os.getenv("INGEST_STREAM_KEY", "wis2:ingest")
+INGEST_GROUP = "writers"
+# a transaction is committed once this many observations are buffered or
+# the oldest has waited INGEST_WRITER_INTERVAL seconds
+INGEST_WRITER_BATCH = int(os.getenv("INGEST_WRITER_BATCH", 5000))
+INGEST_WRITER_INTERVAL = float(os.getenv("INGEST_WRITER_INTERVAL", 2))
+# entries left unacknowledged this long (e.g. by a writer that died) are
+# taken over, entries failing this many times go to <stream>:dead
+INGEST_WRITER_CLAIM_IDLE = int(os.getenv("INGEST_WRITER_CLAIM_IDLE", 60))
+INGEST_WRITER_MAX_DELIVERIES = int(os.getenv("INGEST_WRITER_MAX_DELIVERIES",
+                                             5))
+# returned by ingest_bufr for observations published to the stream, the
+# writer moves the ledger entry of the file to INGESTED once committed
+QUEUED = "QUEUED"
+
+
+def publish(rows, result, client=None):
+    """Queue the observation rows of a decoded file for the ingest writer"""
+    entry = {
+        "filename": result.get("filename"),
+        "hash_method": result.get("hash_method"),
+        "expected_hash": result.get("expected_hash"),
+        "rows": rows
+    }
+    return (client or get_redis()).xadd(
+        INGEST_STREAM, {"data": json.dumps(entry, default=str)})
+
+
+def mark_ingested(session, filenames):
+    """Record the files as ingested, in the caller's transaction"""
+    filenames = sorted({str(filename) for filename in filenames
+                        if filename is not None})
+    if not filenames:
+        return
+    statement = insert(IngestedFile).values(
+        [{"filename": filename} for filename in filenames])
+    session.execute(statement.on_conflict_do_update(
+        index_elements=["filename"], set_={"ingested": func.now()}))
+
+
+class IngestWriter():
+    """
+    Drains the ingest stream into wccdm.observation, one transaction per
+    batch of files rather than per file. The lookup table URIs of the rows
+    are resolved to ids here too, the workers publishing to the stream
+    only use the database for the content ledger, the download log and
+    the download index. Entries are read through a consumer group and only
+    acknowledged (and deleted) once the batch is committed, so a writer
+    that dies loses nothing: its entries are taken over by the next read
+    after INGEST_WRITER_CLAIM_IDLE seconds. Files in a batch that fails are
+    written one by one to isolate the bad one.
+    """
+
+    def __init__(self, engine, client=None, ledger=None,
+                 consumer: str = None,
+                 batch: int = INGEST_WRITER_BATCH,
+                 interval: float = INGEST_WRITER_INTERVAL,
+                 stream: str = INGEST_STREAM):
+        self.Session = sessionmaker(bind=engine)
+        self._client = client
+        self.ledger = ledger
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.batch = batch
+        self.interval = interval
+        self.stream = stream
+        self._stop = False
+
+    @property
+    def client(self):
+        return self._client or get_redis()
+
+    def ensure_group(self):
+        try:
+            self.client.xgroup_create(self.stream, INGEST_GROUP, id="0",
+                                      mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self, block: float = None):
+        # stale entries of other consumers first, then new ones
+        entries = self.client.xautoclaim(
+            self.stream, INGEST_GROUP, self.consumer,
+            min_idle_time=INGEST_WRITER_CLAIM_IDLE * 1000, start_id="0-0",
+            count=100)[1]
+        if not entries:
+            response = self.client.xreadgroup(
+                INGEST_GROUP, self.consumer, {self.stream: ">"}, count=100,
+                block=None if block is None else int(block * 1000))
+            entries = response[0][1] if response else []
+        return [(id, json.loads(fields[b"data"])) for id, fields in entries
+                if fields]
+
+    def _write(self, entries):
+        session = self.Session()
+        try:
+            # copies, the entries are written again one by one on failure
+            rows = [dict(row) for id, entry in entries
+                    for row in entry["rows"]]
+            resolve_uris(rows, session)
+            count = write_observations(session, rows)
+            mark_ingested(session, [entry.get("filename")
+                                    for id, entry in entries])
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        return count
+
+    def _done(self, entries):
+        ids = [id for id, entry in entries]
+        pipe = self.client.pipeline()
+        pipe.xack(self.stream, INGEST_GROUP, *ids)
+        pipe.xdel(self.stream, *ids)
+        pipe.execute()
+        if self.ledger is None:
+            return
+        for id, entry in entries:
+            if None in (entry.get("hash_method"), entry.get("expected_hash")):
+                continue
+            try:
+                self.ledger.mark(entry["hash_method"], entry["expected_hash"],
+                                 INGESTED, if_state=STORED)
+            except Exception as e:
+                LOGGER.warning(f"Unable to update content ledger: {e}")
+
+    def _failed(self, id, entry, error):
+        pending = self.client.xpending_range(self.stream, INGEST_GROUP,
+                                             min=id, max=id, count=1)
+        deliveries = pending[0]["times_delivered"] if pending else 0
+        LOGGER.error(f"Unable to ingest {entry.get('filename')} "
+                     f"(attempt {deliveries}): {error}")
+        if deliveries >= INGEST_WRITER_MAX_DELIVERIES:
+            self.client.xadd(f"{self.stream}:dead",
+                             {"data": json.dumps(entry, default=str),
+                              "error": str(error)})
+            self.client.xack(self.stream, INGEST_GROUP, id)
+            self.client.xdel(self.stream, id)
+
+    def flush(self, entries):
+        """Write the entries in one transaction, returns the rows written"""
+        if not entries:
+            return 0
+        try:
+            count = self._write(entries)
+            self._done(entries)
+        except Exception as e:
+            LOGGER.warning(f"Batch of {len(entries)} files failed, writing "
+                           f"them one by one: {e}")
+            count = 0
+            for id, entry in entries:
+                try:
+                    count += self._write([(id, entry)])
+                    self._done([(id, entry)])
+                except Exception as e:
+                    # left pending, taken over again once idle
+                    self._failed(id, entry, e)
+        LOGGER.info(f"{count} observations from {len(entries)} files added")
+        return count
+
+    def stop(self, *args):
+        self._stop = True
+
+    def run(self):
+        self.ensure_group()
+        entries = []
+        rows = 0
+        deadline = None
+        while not self._stop:
+            timeout = self.interval if deadline is None else \
+                max(deadline - time.monotonic(), 0)
+            try:
+                new = self.read(block=timeout or None)
+            except redis.ConnectionError as e:
+                LOGGER.error(f"Unable to read from {self.stream}: {e}")
+                time.sleep(1)
+                continue
+            # taken over again while buffered
+            buffered = {id for id, entry in entries}
+            new = [(id, entry) for id, entry in new if id not in buffered]
+            if new and deadline is None:
+                deadline = time.monotonic() + self.interval
+            entries.extend(new)
+            rows += sum(len(entry["rows"]) for id, entry in new)
+            if entries and (rows >= self.batch or
+                            time.monotonic() >= deadline):
+                self.flush(entries)
+                entries = []
+                rows = 0
+                deadline = None
+        # unacknowledged entries are picked up again if this fails
+        self.flush(entries)
+
+
+def main():
+    from task_manager.db import engine
+    ledger = ContentLedger(engine) if os.getenv(
+        "CONTENT_LEDGER", "true").lower() == "true" else None
+    writer = IngestWriter(engine, ledger=ledger)
+    signal.signal(signal.SIGTERM, writer.stop)
+    signal.signal(signal.SIGINT, writer.stop)
+    LOGGER.info(f"Ingest writer {writer.consumer} reading {writer.stream}")
+    writer.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import os
+
+from sqlalchemy import delete, func, or_, text, update
+from sqlalchemy.dialects.postgresql import insert
+
+from task_manager.schema import LedgerEntry
+
+# seconds after which a claim left by a crashed worker can be taken over
+LEDGER_CLAIM_TIMEOUT = int(os.getenv("LEDGER_CLAIM_TIMEOUT", 600))
+# days after which STORED / INGESTED entries are dropped, 0 keeps them.
+# Entries are also dropped when retention evicts their file.
+LEDGER_STORED_TTL_DAYS = float(os.getenv("LEDGER_STORED_TTL_DAYS", 30))
+LEDGER_INGESTED_TTL_DAYS = float(os.getenv("LEDGER_INGESTED_TTL_DAYS", 90))
+
+CLAIMED = "CLAIMED"
+STORED = "STORED"
+INGESTED = "INGESTED"
+
+
+class ContentLedger():
+    """
+    Persistent record of content hashes, shared by all workers, consulted
+    before any HTTP request is made. `claim` atomically registers a hash
+    that is about to be downloaded and fails if the hash is already stored,
+    ingested or being downloaded elsewhere. Entries expire (`expire`) and
+    are forgotten with their files (`forget`), so that content received
+    again after its file is gone is downloaded again.
+    """
+
+    def __init__(self, engine, claim_timeout: int = LEDGER_CLAIM_TIMEOUT,
+                 stored_ttl_days: float = LEDGER_STORED_TTL_DAYS,
+                 ingested_ttl_days: float = LEDGER_INGESTED_TTL_DAYS):
+        self.engine = engine
+        self.claim_timeout = claim_timeout
+        self.ttls = {CLAIMED: claim_timeout,
+                     STORED: stored_ttl_days * 86400,
+                     INGESTED: ingested_ttl_days * 86400}
+
+    def claim(self, hash_method, hash_value, data_id=None, filename=None):
+        """True if the caller should download the content"""
+        return self.claim_many([(hash_method, hash_value, data_id,
+                                 filename)])[0]
+
+    def claim_many(self, items):
+        """
+        `claim` for (hash_method, hash_value, data_id, filename) tuples in a
+        single statement, returns a bool per item. Of items sharing a hash
+        only the first is claimed.
+        """
+        keys = [(item[0], item[1]) for item in items]
+        first = {}
+        for idx, key in enumerate(keys):
+            first.setdefault(key, idx)
+        if not first:
+            return []
+        # rows in a fixed order, concurrent batches lock them in that order
+        rows = [{"hash_method": items[idx][0], "hash_value": items[idx][1],
+                 "state": CLAIMED, "data_id": items[idx][2],
+                 "filename": items[idx][3]}
+                for key, idx in sorted(first.items())]
+        statement = insert(LedgerEntry).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=["hash_method", "hash_value"],
+            set_={"state": CLAIMED, "data_id": statement.excluded.data_id,
+                  "filename": statement.excluded.filename,
+                  "updated": func.now()},
+            where=(LedgerEntry.state == CLAIMED) & (
+                LedgerEntry.updated < func.now() - text(
+                    f"interval '{int(self.claim_timeout)} seconds'"))
+        ).returning(LedgerEntry.hash_method, LedgerEntry.hash_value)
+        with self.engine.begin() as conn:
+            claimed = {tuple(row) for row in conn.execute(statement)}
+        return [first[key] == idx and key in claimed
+                for idx, key in enumerate(keys)]
+
+    def release(self, hash_method, hash_value):
+        # the download failed, let the next notification try again
+        with self.engine.begin() as conn:
+            conn.execute(delete(LedgerEntry).where(
+                LedgerEntry.hash_method == hash_method,
+                LedgerEntry.hash_value == hash_value,
+                LedgerEntry.state == CLAIMED))
+
+    def mark(self, hash_method, hash_value, state, filename=None,
+             if_state=None):
+        # if_state only moves entries in that state, e.g. a file archived
+        # after it was ingested stays INGESTED
+        values = {"state": state, "updated": func.now()}
+        if filename is not None:
+            values["filename"] = filename
+        statement = update(LedgerEntry).where(
+            LedgerEntry.hash_method == hash_method,
+            LedgerEntry.hash_value == hash_value)
+        if if_state is not None:
+            statement = statement.where(LedgerEntry.state == if_state)
+        with self.engine.begin() as conn:
+            conn.execute(statement.values(**values))
+
+    def forget(self, filenames=(), directory=None):
+        """
+        Drop the entries of files that were deleted, given by name and / or
+        everything under `directory`. Returns the number of entries dropped.
+        """
+        filenames = [str(filename) for filename in filenames]
+        count = 0
+        with self.engine.begin() as conn:
+            if directory is not None:
+                count += conn.execute(delete(LedgerEntry).where(
+                    LedgerEntry.filename.startswith(
+                        f"{str(directory).rstrip('/')}/",
+                        autoescape=True))).rowcount
+            for idx in range(0, len(filenames), 1000):
+                count += conn.execute(delete(LedgerEntry).where(
+                    LedgerEntry.filename.in_(
+                        filenames[idx:idx + 1000]))).rowcount
+        return count
+
+    def expire(self):
+        """Drop entries older than the TTL of their state, returns how many"""
+        conditions = [
+            (LedgerEntry.state == state) & (LedgerEntry.updated < func.now() -
+                                            text(f"interval '{int(ttl)} "
+                                                 f"seconds'"))
+            for state, ttl in self.ttls.items() if ttl > 0]
+        if not conditions:
+            return 0
+        with self.engine.begin() as conn:
+            return conn.execute(
+                delete(LedgerEntry).where(or_(*conditions))).rowcount
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+import time
+
+from celery.utils.log import get_task_logger
+
+from task_manager.shared import get_redis
+
+LOGGER = get_task_logger(__name__)
+
+# requests per second and burst size allowed per cache host, across all
+# workers. A rate of 0 disables the limiter.
+DOWNLOAD_RATE = float(os.getenv("DOWNLOAD_RATE", 20))
+DOWNLOAD_BURST = float(os.getenv("DOWNLOAD_BURST", 40))
+# a request that would have to wait longer than this is not made, the
+# download moves on to an alternative cache (or fails)
+DOWNLOAD_RATE_MAX_WAIT = float(os.getenv("DOWNLOAD_RATE_MAX_WAIT", 10))
+# pause after a 429 / 503 without a Retry-After header
+DOWNLOAD_RATE_COOLDOWN = float(os.getenv("DOWNLOAD_RATE_COOLDOWN", 30))
+# per host overrides, e.g.
+# {"cache.example.org": {"rate": 50, "burst": 100, "connections": 16}}
+DOWNLOAD_HOST_LIMITS = json.loads(os.getenv("DOWNLOAD_HOST_LIMITS", "{}"))
+
+_PREFIX = "wis2:ratelimit:"
+
+# Token bucket, refilled at ARGV[1] tokens/s up to ARGV[2]. A token is
+# reserved if the wait for it is at most ARGV[3] seconds, the bucket may go
+# negative so that concurrent callers queue up behind each other. Returns
+# the wait in seconds (as a string, Lua numbers are truncated to integers).
+_TOKEN_BUCKET = """
+local pttl = redis.call('PTTL', KEYS[2])
+if pttl > 0 then
+    return tostring(pttl / 1000)
+end
+local now_t = redis.call('TIME')
+local now = tonumber(now_t[1]) + tonumber(now_t[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+if wait <= max_wait then
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+
+
+class RateLimited(Exception):
+    pass
+
+
+class HostRateLimiter():
+    """
+    Token bucket per download host shared by all worker processes through
+    Redis. `acquire` blocks until a request to the host is allowed, or
+    raises RateLimited if that would take longer than `max_wait`. Hosts
+    answering 429 / 503 are paused with `backoff`. If Redis is unavailable
+    requests are not limited.
+    """
+
+    def __init__(self, client=None, rate: float = DOWNLOAD_RATE,
+                 burst: float = DOWNLOAD_BURST,
+                 max_wait: float = DOWNLOAD_RATE_MAX_WAIT,
+                 limits: dict = None):
+        self._client = client
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.limits = DOWNLOAD_HOST_LIMITS if limits is None else limits
+        self._script = None
+
+    @property
+    def client(self):
+        return self._client or get_redis()
+
+    def _bucket(self, host):
+        limits = self.limits.get(host, {})
+        rate = float(limits.get("rate", self.rate))
+        return rate, max(float(limits.get("burst", self.burst)), 1.0)
+
+    def connections(self, host, default=None):
+        return self.limits.get(host, {}).get("connections", default)
+
+    def reserve(self, host):
+        """Seconds to wait before the request may be made"""
+        rate, burst = self._bucket(host)
+        if rate <= 0:
+            return 0.0
+        try:
+            if self._script is None:
+                self._script = self.client.register_script(_TOKEN_BUCKET)
+            wait = float(self._script(
+                keys=[f"{_PREFIX}{host}", f"{_PREFIX}{host}:pause"],
+                args=[rate, burst, self.max_wait]))
+        except Exception as e:
+            LOGGER.warning(f"Rate limiter unavailable, not limiting: {e}")
+            return 0.0
+        if wait > self.max_wait:
+            raise RateLimited(f"{host} rate limited for {wait:.1f}s")
+        return wait
+
+    def acquire(self, host):
+        wait = self.reserve(host)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, host):
+        # the reservation is a blocking Redis call, made off the event loop
+        wait = await asyncio.to_thread(self.reserve, host)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def backoff(self, host, seconds=None):
+        seconds = seconds if seconds is not None else DOWNLOAD_RATE_COOLDOWN
+        LOGGER.warning(f"Pausing downloads from {host} for {seconds}s")
+        try:
+            self.client.set(f"{_PREFIX}{host}:pause", 1,
+                            px=max(1, int(seconds * 1000)))
+        except Exception as e:
+            LOGGER.warning(f"Unable to pause {host}: {e}")
@@ -0,0 +1,340 @@
+import datetime as dt
+import json
+import os
+from pathlib import Path
+import shutil
+
+from celery.utils.log import get_task_logger
+from sqlalchemy import delete, exists, select
+
+from task_manager.archive import INDEX_SUFFIX, read_index
+from task_manager.schema import DownloadIndex, DownloadLog, IngestedFile
+from task_manager.shared import get_redis
+from task_manager.store import lock_object
+
+LOGGER = get_task_logger(__name__)
+
+# per dataset policies, "default" applies to datasets not listed, e.g.
+# {"default": {"max_age_days": 30},
+#  "surface": {"max_age_days": 90, "max_bytes": 50e9},
+#  "test": {"max_age_days": 2, "keep_only_ingested": true}}
+# max_age_days: days kept, the current day counts as day 0
+# max_bytes: oldest days are evicted until the dataset fits
+# keep_only_ingested: files logged as downloaded (download_log SUCCESS) but
+#   not recorded as ingested are evicted after ingest_grace_hours, files
+#   with no download log entry are kept
+RETENTION_POLICIES = json.loads(os.getenv(
+    "RETENTION_POLICIES", '{"default": {"max_age_days": 30}}'))
+# oldest days of any dataset are evicted while less than this percentage of
+# the filesystem is free, 0 disables
+RETENTION_MIN_FREE_PERCENT = float(os.getenv("RETENTION_MIN_FREE_PERCENT",
+                                             10))
+# days less than this many days old are never evicted for space
+RETENTION_PROTECT_DAYS = int(os.getenv("RETENTION_PROTECT_DAYS", 1))
+
+_REPORT_KEY = "wis2:retention:last"
+
+
+class _Day():
+    # one day of a dataset, loose files and / or the daily archive
+    def __init__(self, dataset, date):
+        self.dataset = dataset
+        self.date = date
+        self.paths = []
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, path):
+        path = Path(path)
+        self.paths.append(path)
+        if path.is_dir():
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        self.files += 1
+                        self.bytes += entry.stat(follow_symlinks=False).st_size
+        else:
+            if path.name.endswith(INDEX_SUFFIX):
+                self.files += len(read_index(path))
+            self.bytes += path.stat().st_size
+
+
+class RetentionEngine():
+    """
+    Applies retention policies to the download tree, evicting whole days
+    oldest first so each pass is a handful of directory removals rather
+    than a per file scan. With the content addressed store, index entries
+    older than max_age_days are removed and objects no dataset refers to
+    are deleted. With object storage only the content addressed store is
+    managed here, use the bucket's lifecycle rules for the rest. Content
+    ledger entries of evicted files are dropped, and expired ones. `run`
+    returns (and stores in Redis) the reclaimed files and bytes per dataset.
+    """
+
+    def __init__(self, basepath, engine=None, store=None, storage=None,
+                 policies=None, ledger=None,
+                 min_free_percent: float = RETENTION_MIN_FREE_PERCENT,
+                 protect_days: int = RETENTION_PROTECT_DAYS):
+        self.basepath = Path(basepath)
+        self.engine = engine
+        self.store = store
+        self.ledger = ledger
+        self.local = storage is None or storage.local
+        self.policies = RETENTION_POLICIES if policies is None else policies
+        self.min_free_percent = min_free_percent
+        self.protect_days = protect_days
+        self.report = {}
+
+    def policy(self, dataset):
+        return dict(self.policies.get("default", {}),
+                    **self.policies.get(dataset, {}))
+
+    def datasets(self):
+        return sorted(path.name for path in self.basepath.iterdir()
+                      if path.is_dir() and not (
+                          self.store is not None and
+                          path == self.store.root))
+
+    def days(self, dataset):
+        """_Day per date of the dataset, oldest first"""
+        days = {}
+        for path in (self.basepath / dataset).glob("[0-9]*/[0-9]*/[0-9]*"):
+            try:
+                yyyy, mm = (int(part) for part in path.parts[-3:-1])
+                date = dt.date(yyyy, mm, int(path.name.split(".")[0]))
+            except ValueError:
+                continue
+            if date not in days:
+                days[date] = _Day(dataset, date)
+            days[date].add(path)
+        return [days[date] for date in sorted(days)]
+
+    def _reclaimed(self, dataset, files, nbytes, reason):
+        entry = self.report.setdefault(dataset, {})
+        reclaimed = entry.setdefault(reason, {"files": 0, "bytes": 0})
+        reclaimed["files"] += files
+        reclaimed["bytes"] += nbytes
+
+    def _forget(self, filenames=(), directory=None):
+        # the content can be downloaded again
+        if self.ledger is None:
+            return
+        try:
+            self.ledger.forget(filenames, directory)
+        except Exception as e:
+            LOGGER.warning(f"Unable to update content ledger: {e}")
+
+    def _forget_ingested(self, directory):
+        # ingest records of the evicted files
+        if self.engine is None:
+            return
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(delete(IngestedFile).where(
+                    IngestedFile.filename.startswith(
+                        f"{str(directory).rstrip('/')}/", autoescape=True)))
+        except Exception as e:
+            LOGGER.warning(f"Unable to drop ingest records: {e}")
+
+    def _evict_day(self, day, reason):
+        for path in day.paths:
+            try:
+                if path.is_dir():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+        for parent in (day.paths[0].parent, day.paths[0].parent.parent):
+            try:
+                parent.rmdir()  # empty month / year
+            except OSError:
+                break
+        # <dd>, <dd>.tar, <dd>.tar.idx hold the files of <dd>/
+        for directory in {path.with_name(path.name.split(".")[0])
+                          for path in day.paths}:
+            self._forget(directory=directory)
+            self._forget_ingested(directory)
+        LOGGER.info(f"Evicted {day.dataset} {day.date} ({reason}, "
+                    f"{day.files} files, {day.bytes} bytes)")
+        self._reclaimed(day.dataset, day.files, day.bytes, reason)
+
+    def _apply(self, dataset, policy, today):
+        days = self.days(dataset)
+        max_age = policy.get("max_age_days")
+        if max_age is not None:
+            cutoff = today - dt.timedelta(days=int(max_age))
+            while days and days[0].date < cutoff:
+                self._evict_day(days.pop(0), "max_age")
+        max_bytes = policy.get("max_bytes")
+        if max_bytes is not None:
+            total = sum(day.bytes for day in days)
+            # the current day is kept whatever its size
+            while len(days) > 1 and total > float(max_bytes):
+                day = days.pop(0)
+                total -= day.bytes
+                self._evict_day(day, "max_bytes")
+        if policy.get("keep_only_ingested"):
+            self._evict_not_ingested(
+                dataset, days, float(policy.get("ingest_grace_hours", 24)))
+
+    def _evict_not_ingested(self, dataset, days, grace_hours):
+        if self.engine is None:
+            LOGGER.warning(f"keep_only_ingested for {dataset} needs the "
+                           f"database, skipped")
+            return
+        cutoff = dt.datetime.now().timestamp() - grace_hours * 3600
+        for day in days:
+            for directory in day.paths:
+                if not directory.is_dir():
+                    continue  # archived days were ingested or given up on
+                candidates = {}
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(".") or \
+                                not entry.is_file(follow_symlinks=False):
+                            continue
+                        stat = entry.stat(follow_symlinks=False)
+                        if stat.st_mtime < cutoff:
+                            candidates[entry.path] = stat.st_size
+                if not candidates:
+                    continue
+                # only files known to be downloaded and not ingested are
+                # evicted, anything in doubt is kept
+                paths = list(candidates)
+                downloaded = set()
+                ingested = set()
+                with self.engine.connect() as conn:
+                    for idx in range(0, len(paths), 1000):
+                        chunk = paths[idx:idx + 1000]
+                        downloaded.update(conn.execute(
+                            select(DownloadLog.filename).where(
+                                DownloadLog.status == "SUCCESS",
+                                DownloadLog.filename.in_(chunk))).scalars())
+                        ingested.update(conn.execute(
+                            select(IngestedFile.filename).where(
+                                IngestedFile.filename.in_(chunk))).scalars())
+                files = nbytes = 0
+                evicted = []
+                for path, size in candidates.items():
+                    if path not in downloaded or path in ingested:
+                        continue
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        continue
+                    evicted.append(path)
+                    files += 1
+                    nbytes += size
+                self._forget(evicted)
+                if files:
+                    LOGGER.info(f"Evicted {files} files not ingested from "
+                                f"{directory}")
+                    self._reclaimed(dataset, files, nbytes, "not_ingested")
+
+    def _apply_store(self, dataset, policy, today):
+        # content addressed store, age only
+        max_age = policy.get("max_age_days")
+        if max_age is None or self.engine is None:
+            return
+        cutoff = dt.datetime.combine(
+            today - dt.timedelta(days=int(max_age)), dt.time(),
+            tzinfo=dt.UTC)
+        with self.engine.begin() as conn:
+            objects = set(conn.execute(
+                delete(DownloadIndex).where(DownloadIndex.dataset == dataset,
+                                            DownloadIndex.stored < cutoff)
+                .returning(DownloadIndex.hash_method,
+                           DownloadIndex.hash_value)).all())
+        storage = self.store.storage
+        files = nbytes = 0
+        for hash_method, hash_value in objects:
+            key = self.store.object_key(hash_method, hash_value)
+            with self.engine.begin() as conn:
+                # downloads cannot index the object until it is deleted
+                lock_object(conn, key, shared=False)
+                referenced = conn.execute(select(exists().where(
+                    DownloadIndex.hash_method == hash_method,
+                    DownloadIndex.hash_value == hash_value))).scalar()
+                if referenced:
+                    continue
+                try:
+                    nbytes += storage.size(key)
+                except Exception:
+                    continue  # already gone
+                storage.delete(key)
+            self._forget([storage.uri(key)])
+            files += 1
+        if files:
+            self._reclaimed(dataset, files, nbytes, "max_age")
+
+    def _free_percent(self):
+        usage = shutil.disk_usage(self.basepath)
+        return 100 * usage.free / usage.total
+
+    def _free_space(self, today):
+        # date ordered pass over all datasets until enough space is free
+        if self.min_free_percent <= 0 or \
+                self._free_percent() >= self.min_free_percent:
+            return
+        cutoff = today - dt.timedelta(days=self.protect_days)
+        days = sorted((day for dataset in self.datasets()
+                       for day in self.days(dataset) if day.date <= cutoff),
+                      key=lambda day: day.date)
+        for day in days:
+            if self._free_percent() >= self.min_free_percent:
+                break
+            self._evict_day(day, "disk_space")
+        if self._free_percent() < self.min_free_percent:
+            LOGGER.error(f"Less than {self.min_free_percent}% free on "
+                         f"{self.basepath} after eviction")
+
+    def run(self):
+        self.report = {}
+        today = dt.date.today()
+        for dataset in self.datasets() if self.local else []:
+            try:
+                self._apply(dataset, self.policy(dataset), today)
+            except Exception as e:
+                LOGGER.error(f"Retention for {dataset} failed: {e}")
+        if self.store is not None and self.engine is not None:
+            with self.engine.connect() as conn:
+                datasets = conn.execute(
+                    select(DownloadIndex.dataset).distinct()).scalars().all()
+            for dataset in datasets:
+                try:
+                    self._apply_store(dataset, self.policy(dataset), today)
+                except Exception as e:
+                    LOGGER.error(f"Retention for {dataset} failed: {e}")
+        if self.local:
+            self._free_space(today)
+        expired = None
+        if self.ledger is not None:
+            try:
+                expired = self.ledger.expire()
+            except Exception as e:
+                LOGGER.warning(f"Unable to expire content ledger: {e}")
+        files = sum(reclaimed["files"] for entry in self.report.values()
+                    for reclaimed in entry.values())
+        nbytes = sum(reclaimed["bytes"] for entry in self.report.values()
+                     for reclaimed in entry.values())
+        report = {
+            "run": dt.datetime.now(dt.UTC).strftime("%Y-%m-%d %H:%M:%S"),
+            "files": files,
+            "bytes": nbytes,
+            "free_percent": round(self._free_percent(), 2)
+            if self.local else None,
+            "ledger_expired": expired,
+            "datasets": self.report
+        }
+        LOGGER.info(f"Retention reclaimed {nbytes} bytes in {files} files")
+        try:
+            get_redis().set(_REPORT_KEY, json.dumps(report))
+        except Exception as e:
+            LOGGER.warning(f"Unable to store retention report: {e}")
+        return report
+
+
+def last_report(client=None):
+    report = (client or get_redis()).get(_REPORT_KEY)
+    return json.loads(report) if report is not None else {}
@@ -0,0 +1,76 @@
+import datetime
+
+from sqlalchemy import (BigInteger, Boolean, DateTime, Identity, Index,
+                        String, func)
+from sqlalchemy.orm import mapped_column, registry, Mapped
+
+
+mapper_registry = registry()
+Base = mapper_registry.generate_base()
+
+
+class DownloadIndex(Base):
+    # maps a downloaded file to its object in the content addressed store
+    __tablename__ = "download_index"
+    __table_args__ = (
+        Index("ix_download_index_object", "hash_method", "hash_value"),
+        {"schema": "task_manager"}
+    )
+    dataset: Mapped[str] = mapped_column(String, primary_key=True)
+    data_id: Mapped[str] = mapped_column(String, primary_key=True)
+    filename: Mapped[str] = mapped_column(String, primary_key=True)
+    hash_method: Mapped[str] = mapped_column(String, nullable=False)
+    hash_value: Mapped[str] = mapped_column(String, nullable=False)  # hex
+    size: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    stored: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class LedgerEntry(Base):
+    # content hashes already downloaded (STORED) or decoded (INGESTED), a
+    # CLAIMED entry is a download in progress on one of the workers
+    __tablename__ = "content_ledger"
+    __table_args__ = {"schema": "task_manager"}
+    hash_method: Mapped[str] = mapped_column(String, primary_key=True)
+    hash_value: Mapped[str] = mapped_column(String, primary_key=True)  # base64, as notified
+    state: Mapped[str] = mapped_column(String, nullable=False)
+    data_id: Mapped[str] = mapped_column(String, nullable=True)
+    filename: Mapped[str] = mapped_column(String, nullable=True)
+    updated: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class IngestedFile(Base):
+    # downloaded files whose observations were added, written in the same
+    # transaction as the observations
+    __tablename__ = "ingested_file"
+    __table_args__ = {"schema": "task_manager"}
+    filename: Mapped[str] = mapped_column(String, primary_key=True)
+    ingested: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class DownloadLog(Base):
+    # one row per download_from_wis2 result, written in bulk with COPY
+    __tablename__ = "download_log"
+    __table_args__ = (
+        Index("ix_download_log_received", "received"),
+        {"schema": "task_manager"}
+    )
+    id: Mapped[int] = mapped_column(BigInteger, Identity(), primary_key=True)
+    broker: Mapped[str] = mapped_column(String, nullable=True)
+    message_id: Mapped[str] = mapped_column(String, nullable=True)
+    data_id: Mapped[str] = mapped_column(String, nullable=True)
+    metadata_id: Mapped[str] = mapped_column(String, nullable=True)
+    received: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    queued: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    status: Mapped[str] = mapped_column(String, nullable=True)
+    cache: Mapped[str] = mapped_column(String, nullable=True)
+    filename: Mapped[str] = mapped_column(String, nullable=True)
+    save: Mapped[bool] = mapped_column(Boolean, nullable=True)
+    valid_hash: Mapped[bool] = mapped_column(Boolean, nullable=True)
+    hash_method: Mapped[str] = mapped_column(String, nullable=True)
+    expected_hash: Mapped[str] = mapped_column(String, nullable=True)
+    hash_value: Mapped[str] = mapped_column(String, nullable=True)
+    expected_length: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    filesize: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    download_start: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    download_end: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    dataset: Mapped[str] = mapped_column(String, nullable=True)
@@ -0,0 +1,17 @@
+import os
+
+import redis
+
+from task_manager.worker import CELERY_BROKER
+
+# Redis used for state shared between workers (and the subscriber)
+TASK_MANAGER_REDIS = os.getenv("TASK_MANAGER_REDIS", CELERY_BROKER)
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(TASK_MANAGER_REDIS)
+    return _redis
@@ -0,0 +1,233 @@
+import os
+from pathlib import Path
+import tempfile
+from urllib.parse import urlsplit
+
+from celery.utils.log import get_task_logger
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from task_manager.archive import read_download
+
+LOGGER = get_task_logger(__name__)
+
+# "local": files under DATA, "s3": objects in an S3 compatible bucket
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+STORAGE_S3_ENDPOINT = os.getenv("STORAGE_S3_ENDPOINT")  # e.g. http://bucket:9000
+STORAGE_S3_BUCKET = os.getenv("STORAGE_S3_BUCKET", "wis2-downloads")
+STORAGE_S3_REGION = os.getenv("STORAGE_S3_REGION", "us-east-1")
+STORAGE_S3_ACCESS_KEY = os.getenv("STORAGE_S3_ACCESS_KEY")
+STORAGE_S3_SECRET_KEY = os.getenv("STORAGE_S3_SECRET_KEY")
+# uploads larger than one part are sent as multipart uploads (min 5 MiB)
+STORAGE_S3_PART_SIZE = int(os.getenv("STORAGE_S3_PART_SIZE", 8 * 1024 * 1024))
+
+# mkstemp creates files readable by the owner only, uploads get the mode a
+# file created with open() would have
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class _LocalUpload():
+    # temporary file next to the destination, renamed into place
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.path = storage.path(key)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        fd, self._tmp = tempfile.mkstemp(dir=self.path.parent,
+                                         prefix=f".{self.path.name}.",
+                                         suffix=".part")
+        self._fh = os.fdopen(fd, "wb")
+        os.fchmod(fd, 0o666 & ~_UMASK)
+
+    def write(self, chunk):
+        self._fh.write(chunk)
+
+    def complete(self, key=None):
+        # key must be on the same filesystem as the original key
+        self._fh.close()
+        path = self.storage.path(key) if key is not None else self.path
+        path.parent.mkdir(exist_ok=True, parents=True)
+        os.replace(self._tmp, path)
+
+    def abort(self):
+        self._fh.close()
+        try:
+            os.unlink(self._tmp)
+        except FileNotFoundError:
+            pass
+
+
+class LocalStorage():
+    """
+    Downloads as files under `root`, a key is the path relative to it.
+    Without a root keys are used as paths as they are.
+    """
+
+    local = True
+
+    def __init__(self, root=None):
+        self.root = Path(root) if root is not None else None
+
+    def path(self, key):
+        return self.root / key if self.root is not None else Path(key)
+
+    def uri(self, key):
+        return str(self.path(key))
+
+    def upload(self, key):
+        return _LocalUpload(self, key)
+
+    def exists(self, key):
+        return self.path(key).is_file()
+
+    def size(self, key):
+        return self.path(key).stat().st_size
+
+    def read(self, key):
+        return read_download(self.path(key))
+
+    def read_uri(self, uri):
+        # files compacted into daily archives are read from the archive
+        return read_download(uri)
+
+    def delete(self, key):
+        try:
+            self.path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+
+class _S3Upload():
+    # buffered until a part is full, small objects are sent with a single
+    # PUT once complete, larger ones as a multipart upload to the key
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def _upload_part(self):
+        client = self.storage.client
+        if self._upload_id is None:
+            self._upload_id = client.create_multipart_upload(
+                Bucket=self.storage.bucket, Key=self.key)["UploadId"]
+        number = len(self._parts) + 1
+        response = client.upload_part(
+            Bucket=self.storage.bucket, Key=self.key,
+            UploadId=self._upload_id, PartNumber=number,
+            Body=bytes(self._buffer))
+        self._parts.append({"ETag": response["ETag"], "PartNumber": number})
+        self._buffer.clear()
+
+    def write(self, chunk):
+        self._buffer.extend(chunk)
+        if len(self._buffer) >= self.storage.part_size:
+            self._upload_part()
+
+    def complete(self, key=None):
+        # a multipart upload is completed at its own key, moved if the
+        # destination turned out to differ (e.g. content addressed objects
+        # without an advertised hash)
+        key = key if key is not None else self.key
+        client = self.storage.client
+        if self._upload_id is None:
+            client.put_object(Bucket=self.storage.bucket, Key=key,
+                              Body=bytes(self._buffer))
+            return
+        if self._buffer:
+            self._upload_part()
+        client.complete_multipart_upload(
+            Bucket=self.storage.bucket, Key=self.key,
+            UploadId=self._upload_id, MultipartUpload={"Parts": self._parts})
+        self._upload_id = None
+        if key == self.key:
+            return
+        try:
+            client.copy({"Bucket": self.storage.bucket, "Key": self.key},
+                        self.storage.bucket, key)
+        finally:
+            client.delete_object(Bucket=self.storage.bucket, Key=self.key)
+
+    def abort(self):
+        self._buffer.clear()
+        if self._upload_id is not None:
+            try:
+                self.storage.client.abort_multipart_upload(
+                    Bucket=self.storage.bucket, Key=self.key,
+                    UploadId=self._upload_id)
+            except ClientError as e:
+                LOGGER.warning(f"Unable to abort upload of {self.key}: {e}")
+            self._upload_id = None
+
+
+class S3Storage():
+    """
+    Downloads as objects in an S3 compatible bucket (e.g. MinIO), so that
+    workers on different hosts share them without a shared volume. The
+    bucket is created if it does not exist.
+    """
+
+    local = False
+
+    def __init__(self, bucket: str = STORAGE_S3_BUCKET,
+                 endpoint: str = STORAGE_S3_ENDPOINT,
+                 part_size: int = STORAGE_S3_PART_SIZE, client=None):
+        self.bucket = bucket
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.client = client or boto3.client(
+            "s3", endpoint_url=endpoint, region_name=STORAGE_S3_REGION,
+            aws_access_key_id=STORAGE_S3_ACCESS_KEY,
+            aws_secret_access_key=STORAGE_S3_SECRET_KEY,
+            config=Config(retries={"mode": "standard"},
+                          max_pool_connections=32))
+        try:
+            self.client.head_bucket(Bucket=bucket)
+        except ClientError:
+            try:
+                self.client.create_bucket(Bucket=bucket)
+            except ClientError as e:
+                LOGGER.warning(f"Unable to create bucket {bucket}: {e}")
+
+    def uri(self, key):
+        return f"s3://{self.bucket}/{key}"
+
+    def upload(self, key):
+        return _S3Upload(self, key)
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey",
+                                                          "NotFound"):
+                return False
+            raise
+        return True
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket,
+                                       Key=key)["ContentLength"]
+
+    def read(self, key):
+        return self.client.get_object(Bucket=self.bucket,
+                                      Key=key)["Body"].read()
+
+    def read_uri(self, uri):
+        parts = urlsplit(uri)
+        if parts.scheme != "s3":
+            return read_download(uri)
+        return self.client.get_object(Bucket=parts.netloc,
+                                      Key=parts.path.lstrip("/"))["Body"].read()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+def get_storage(basepath=None):
+    if STORAGE_BACKEND == "local":
+        return LocalStorage(basepath)
+    elif STORAGE_BACKEND == "s3":
+        return S3Storage()
+    raise ValueError(f"Unknown storage backend {STORAGE_BACKEND}")
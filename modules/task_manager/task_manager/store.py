@@ -0,0 +1,162 @@
+import base64
+import binascii
+import hashlib
+import os
+from pathlib import Path
+import uuid
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from task_manager.download import DownloadWriter
+from task_manager.schema import DownloadIndex
+from task_manager.storage import LocalStorage
+
+# "tree": DATA/<target>/<yyyy>/<mm>/<dd>/<filename>
+# "cas": DATA/objects/<method>/<aa>/<bb>/<digest>, see ContentStore
+DOWNLOAD_STORE = os.getenv("DOWNLOAD_STORE", "tree")
+# used when the notification has no (supported) integrity method
+CAS_HASH_METHOD = os.getenv("CAS_HASH_METHOD", "sha512")
+
+# first key of the advisory locks taken on objects, the second is a hash of
+# the object key
+_LOCK_SPACE = 0x43415300
+
+
+def lock_object(conn, key, shared=True):
+    """
+    Lock the object for the rest of the transaction. Downloads hold shared
+    locks while they store and index an object, retention deletes it under
+    an exclusive one.
+    """
+    function = "pg_advisory_xact_lock_shared" if shared else \
+        "pg_advisory_xact_lock"
+    conn.execute(text(f"SELECT {function}(:space, hashtext(:key))"),
+                 {"space": _LOCK_SPACE, "key": key})
+
+
+def _hexdigest(b64value):
+    try:
+        return base64.b64decode(b64value, validate=True).hex()
+    except (binascii.Error, TypeError, ValueError):
+        return None
+
+
+class ContentStore():
+    """
+    Content addressed store for downloads. Objects are named by their digest
+    and sharded on the first two bytes, so identical payloads received from
+    different caches or for different subscriptions are stored once and no
+    directory grows beyond 256 entries plus the objects sharing a prefix.
+    The download_index table maps (dataset, data_id, filename) to objects.
+    Objects are kept in `storage`, by default files under `basepath`.
+    """
+
+    def __init__(self, basepath, engine, storage=None):
+        self.storage = storage if storage is not None else \
+            LocalStorage(basepath)
+        self.root = Path(basepath) / "objects"
+        if self.storage.local:
+            self.root.mkdir(exist_ok=True, parents=True)
+        self.engine = engine
+
+    def hash_method(self, hash_method):
+        if hash_method and getattr(hashlib, hash_method, None) is not None:
+            return hash_method
+        return CAS_HASH_METHOD
+
+    def object_key(self, hash_method, hexdigest):
+        return f"objects/{hash_method}/{hexdigest[0:2]}/{hexdigest[2:4]}/" \
+            f"{hexdigest}"
+
+    def object_path(self, hash_method, hexdigest):
+        # location of the object, a path or URI depending on the storage
+        return self.storage.uri(self.object_key(hash_method, hexdigest))
+
+    def lookup(self, hash_method, expected_hash):
+        """Key of the object with the advertised hash, None if not stored"""
+        if hash_method != self.hash_method(hash_method):
+            return None
+        hexdigest = _hexdigest(expected_hash)
+        if hexdigest is None:
+            return None
+        key = self.object_key(hash_method, hexdigest)
+        return key if self.storage.exists(key) else None
+
+    def writer(self, filename, hash_method=None, expected_hash=None,
+               expected_length=None, in_memory=False, max_memory=None):
+        # written to the object named by the advertised hash, the writer
+        # fails unless the content matches it. Without one the download is
+        # staged under a unique key in the store root (on the same
+        # filesystem) and moved once its digest is known.
+        method = self.hash_method(hash_method)
+        if method != hash_method:
+            expected_hash = None
+        hexdigest = _hexdigest(expected_hash) if expected_hash else None
+        if hexdigest:
+            key = self.object_key(method, hexdigest)
+        else:
+            key = f"objects/{uuid.uuid4().hex}.{filename}"
+        return DownloadWriter(key, method, expected_hash,
+                              expected_length, in_memory, self.storage,
+                              max_memory)
+
+    def commit(self, writer, dataset=None, data_id=None, filename=None):
+        """
+        Store the download, returns the path of its object. With `dataset`
+        the object is indexed for the file in the same transaction.
+        """
+        writer.verify()
+        key = self.object_key(writer.hash_method, writer.hexdigest)
+        with self.engine.begin() as conn:
+            lock_object(conn, key)
+            if self.storage.exists(key):
+                # already stored, e.g. by a concurrent download from another
+                # cache
+                writer.discard()
+                writer.committed = True
+            else:
+                writer.commit(key)
+            path = self.storage.uri(key)
+            if dataset is not None:
+                self._index(conn, dataset, data_id, filename, path,
+                            writer.size)
+        return path
+
+    def indexed(self, dataset, data_id, filename):
+        """Path of the object indexed for the file, None if not indexed"""
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                select(DownloadIndex.hash_method, DownloadIndex.hash_value)
+                .where(DownloadIndex.dataset == dataset,
+                       DownloadIndex.data_id == data_id,
+                       DownloadIndex.filename == filename)).first()
+        return self.object_path(*row) if row is not None else None
+
+    def index(self, dataset, data_id, filename, path, size=None):
+        # an object found by lookup, it may have been deleted since
+        path = Path(path)
+        key = self.object_key(path.parts[-4], path.name)
+        with self.engine.begin() as conn:
+            lock_object(conn, key)
+            if not self.storage.exists(key):
+                raise FileNotFoundError(f"{path} is no longer stored")
+            self._index(conn, dataset, data_id, filename, path, size)
+
+    def _index(self, conn, dataset, data_id, filename, path, size=None):
+        # objects/<method>/<aa>/<bb>/<digest>
+        path = Path(path)
+        values = {
+            "dataset": dataset,
+            "data_id": data_id,
+            "filename": filename,
+            "hash_method": path.parts[-4],
+            "hash_value": path.name,
+            "size": size
+        }
+        statement = insert(DownloadIndex).values(**values)
+        statement = statement.on_conflict_do_update(
+            index_elements=["dataset", "data_id", "filename"],
+            set_={key: values[key] for key in
+                  ("hash_method", "hash_value", "size")})
+        conn.execute(statement)
@@ -1,28 +1,44 @@
-import base64
+import asyncio
+import contextlib
 import datetime as dt
-import importlib
 import json
-from multiprocessing import Process
+from concurrent.futures import ThreadPoolExecutor
 import os
-from pathlib import Path
+import time
 import urllib3
 from urllib.parse import urlsplit
 
-from celery import Task
+import aiohttp
+from celery import group, Task
+from celery.signals import worker_process_shutdown, worker_shutdown
 
 from celery.utils.log import get_task_logger
 
-from sqlalchemy import create_engine, select
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import ProgrammingError
 
 from bufr2geojson import transform
-from task_manager.db import session
+from task_manager.archive import compact_day, days_to_compact
+from task_manager.caches import alternates_key, CacheStats
+from task_manager.db import engine, session
+from task_manager.deadletter import (DeadLetterQueue, DOWNLOAD_MAX_RETRIES,
+                                     retry_countdown)
+from task_manager.download import (DownloadWriter, HTTPStatusError,
+                                   parse_job, stream_download,
+                                   stream_download_async)
+from task_manager.downloadlog import DownloadLogWriter
+from task_manager.ingest import mark_ingested, publish, QUEUED
+from task_manager.ledger import ContentLedger, CLAIMED, INGESTED, STORED
+from task_manager.ratelimit import HostRateLimiter, RateLimited
+from task_manager.retention import RetentionEngine
+from task_manager.storage import get_storage
+from task_manager.store import ContentStore, DOWNLOAD_STORE
 from task_manager.worker import app as app
 
 from station_metadata.utils import camel2snake
 from wccdm.schema import *
 from wccdm.utils import *
+from wccdm.utils.bulk import write_observations
+from wccdm.utils.cache import cache_stats
 
 
 
@@ -73,8 +89,27 @@ report_type_map = {
 }
 
 
-_pool = urllib3.PoolManager()
-hash_module = importlib.import_module("hashlib")
+# connection budget per cache host (also used by the batch downloads) and
+# number of hosts kept in the pool, block stops bursts opening extra
+# connections to a single cache
+DOWNLOAD_LIMIT_PER_HOST = int(os.getenv("DOWNLOAD_LIMIT_PER_HOST", 8))
+DOWNLOAD_NUM_POOLS = int(os.getenv("DOWNLOAD_NUM_POOLS", 32))
+_pool = urllib3.PoolManager(num_pools=DOWNLOAD_NUM_POOLS,
+                            maxsize=DOWNLOAD_LIMIT_PER_HOST, block=True)
+_host_pools = {}
+_limiter = HostRateLimiter()
+
+
+def _pool_for(host):
+    # hosts with their own connection budget in DOWNLOAD_HOST_LIMITS get a
+    # pool of that size, as the batch downloads do
+    limit = _limiter.connections(host)
+    if not limit:
+        return _pool
+    if host not in _host_pools:
+        _host_pools.setdefault(host, urllib3.PoolManager(
+            num_pools=1, maxsize=limit, block=True))
+    return _host_pools[host]
 
 # environment variables
 DATA_BASEPATH = os.getenv("DATA",".")
@@ -86,9 +121,46 @@ DBNAME = os.environ["POSTGRES_DB"]
 DBHOST = os.environ["POSTGRES_HOST"]
 DBPORT = os.environ["POSTGRES_PORT"]
 
-#LOGGER = logging.getLogger(__name__)
-#LOG_LEVEL = os.getenv("LOG_LEVEL","DEBUG").upper()
-#LOGGER.setLevel(LOG_LEVEL)
+# local files under DATA or an S3 compatible bucket, see STORAGE_BACKEND
+_storage = get_storage(DATA_BASEPATH)
+
+if DOWNLOAD_STORE == "cas":
+    _store = ContentStore(DATA_BASEPATH, engine, _storage)
+elif DOWNLOAD_STORE == "tree":
+    _store = None
+else:
+    raise ValueError(f"Unknown download store {DOWNLOAD_STORE}")
+
+CONTENT_LEDGER = os.getenv("CONTENT_LEDGER", "true").lower() == "true"
+_ledger = ContentLedger(engine) if CONTENT_LEDGER else None
+
+# rank equivalent links by per cache latency / error rate and fall back
+CACHE_SELECTION = os.getenv("CACHE_SELECTION", "true").lower() == "true"
+_caches = CacheStats() if CACHE_SELECTION else None
+
+# download results are written to task_manager.download_log in bulk
+DOWNLOAD_LOG = os.getenv("DOWNLOAD_LOG", "true").lower() == "true"
+_download_log = DownloadLogWriter(engine) if DOWNLOAD_LOG else None
+
+# downloads failing after all retries
+_deadletter = DeadLetterQueue()
+
+# download_and_ingest decodes files up to this size straight from memory
+# and leaves writing them to disk to a pool of threads
+FUSED_MAX_BYTES = int(os.getenv("FUSED_MAX_BYTES", 1048576))
+FUSED_ARCHIVE_THREADS = int(os.getenv("FUSED_ARCHIVE_THREADS", 4))
+_archiver = ThreadPoolExecutor(max_workers=FUSED_ARCHIVE_THREADS,
+                               thread_name_prefix="archive")
+
+# observations are written with COPY, falling back to the ORM on failure
+INGEST_BULK = os.getenv("INGEST_BULK", "true").lower() == "true"
+# decoded observations are queued for the ingest writer (task_manager_ingest)
+# rather than written by the task
+INGEST_STREAM = os.getenv("INGEST_STREAM", "false").lower() == "true"
+
+# download_batch_from_wis2 connection limits
+DOWNLOAD_BATCH_CONCURRENCY = int(os.getenv("DOWNLOAD_BATCH_CONCURRENCY", 64))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", 60))
 
 LOGGER = get_task_logger(__name__)
 
@@ -99,142 +171,541 @@ class DBTask(Task):
     def after_return(selfself, status, retval, task_id, args, kwargs, einfo):
         session.remove()
 
-@app.task
-def download_from_wis2(job):
-    # get output directory
-    LOGGER.debug(f"Processing job{json.dumps(job)}")
-    target_directory = job.get("target",".")
-    dataset = str(target_directory)
-
-    # get date (used in output path due to number of files)
-    today = dt.date.today()
-    yyyy = f"{today.year:04}"
-    mm = f"{today.month:02}"
-    dd = f"{today.day:02}"
-    target_directory = Path(DATA_BASEPATH)/target_directory/yyyy/mm/dd
-    target_directory.mkdir(exist_ok=True, parents=True)
-
-    # get identifiers
-    data_id = job['payload']['properties']['data_id']
-    metadata_id = job['payload']['properties'].get("metadata_id")
-    message_id = job['payload']['id']
-    # search links, find canonical and update
-    canonical = None
-    update = None
-    canonical_length = None
-    update_length = None
-    for link in job['payload']['links']:
-        if link['rel'] == 'canonical':
-            canonical = link['href']
-            canonical_length = link.get('length')
-        if link['rel'] == 'update':
-            update = link['href']
-            update_length = link.get('length')
-
-    # now check if we have hash
-    hash_method = None
-    hash_function = None
-    hash_expected_value = None
-    if 'integrity' in job['payload']['properties']:
-        hash_method = job['payload']['properties']['integrity']['method']
-        hash_expected_value = job['payload']['properties']['integrity']['value']  # noqa
-        hash_function = getattr(hash_module, hash_method, None)
-
-    # Get some diagnostic information to log
-    broker = job['_broker']  # broker the message received from
-    received = job['_received']  # time the message was received
-    queued = job['_queued']  # time the message added to the queue
-
-    # identify which download link to use
-    download_url = None
-    expected_length = None
-    overwrite = False
-    if update is not None:
-        download_url = update
-        expected_length = update_length
-        overwrite = True
-    elif canonical is not None:
-        download_url = canonical
-        expected_length =canonical_length
-
-    # Now download (if we have link)
-    if download_url is not None:
-        path = urlsplit(link['href']).path
-        cache = urlsplit(link['href']).hostname
-        filename = os.path.basename(path)
-        output_path = target_directory / filename
-        status = ""
-        valid_hash = None
-        save = False
-        filesize = None
-        hash_base64 = None
-        download_start = None
-        download_end = None
-        if (not output_path.is_file()) or overwrite:
-            download_start = dt.datetime.now(dt.UTC).strftime("%Y-%m-%d %H:%M:%S")
+def _record_cache(host, ok, latency=None, seconds=None, nbytes=0):
+    if _caches is None:
+        return
+    try:
+        _caches.record(host, ok, latency, seconds, nbytes)
+    except Exception as e:
+        LOGGER.warning(f"Unable to record cache statistics: {e}")
+
+
+def _log_result(result):
+    if not result:
+        return
+    LOGGER.info(f"{result['status']} {result['data_id']} from "
+                f"{result['cache']}")
+    if _download_log is not None:
+        _download_log.add(result)
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def _shutdown(**kwargs):
+    # files still being archived log their results when done
+    _archiver.shutdown(wait=True)
+    if _download_log is not None:
+        _download_log.close()
+    for name, stats in cache_stats().items():
+        LOGGER.info(f"URI cache {name}: {stats}")
+
+
+def _now():
+    return dt.datetime.now(dt.UTC).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class _Download():
+    # State of one notification through the download stage, shared by the
+    # single job and batch download tasks. `fetch_needed` is set if the
+    # bytes have to be fetched, `finish` returns the task result. With
+    # `in_memory` small downloads are held in `pending` until `finish`.
+    # Without `claim` the caller claims the content and calls `start`.
+    def __init__(self, job, in_memory=False, claim=True):
+        target_directory = job.get("target",".")
+        self.dataset = str(target_directory)
+
+        # get date (used in output path due to number of files)
+        today = dt.date.today()
+        yyyy = f"{today.year:04}"
+        mm = f"{today.month:02}"
+        dd = f"{today.day:02}"
+        self.target_directory = f"{target_directory}/{yyyy}/{mm}/{dd}"
+
+        # get identifiers, download link and integrity
+        self.info = parse_job(job)
+        self.url = self.info['download_url']
+        self.hash_method = self.info['hash_method']
+        self.expected_hash = self.info['expected_hash']
+
+        # Get some diagnostic information to log
+        self.broker = job['_broker']  # broker the message received from
+        self.received = job['_received']  # time the message was received
+        self.queued = job['_queued']  # time the message added to the queue
+
+        self.status = ""
+        self.valid_hash = None
+        self.save = False
+        self.filesize = None
+        self.hash_base64 = None
+        self.download_start = None
+        self.download_end = None
+        self.downloading = False
+        self.fetch_needed = False
+        self.claimed = False
+        self.indexed = False
+        self.in_memory = in_memory
+        self.pending = None
+        self.wanted = False
+        self.claimable = False
+        if self.url is None:
+            return
+
+        self.cache = urlsplit(self.url).hostname
+        self.filename = os.path.basename(urlsplit(self.url).path)
+        # key in the storage, output_path is its path / URI
+        self.key = f"{self.target_directory}/{self.filename}"
+        self.output_path = _storage.uri(self.key)
+        if _store is not None:
+            # content addressed, the index says whether we have the file
+            indexed = _store.indexed(self.dataset, self.info['data_id'],
+                                     self.filename)
+            exists = indexed is not None
+            if exists:
+                self.output_path = indexed
+        else:
+            exists = _storage.exists(self.key)
+        self.wanted = (not exists) or self.info['overwrite']
+        # the ledger claim stops other workers fetching the same content
+        # concurrently, batches claim all their downloads at once
+        self.claimable = self.wanted and _ledger is not None and \
+            None not in (self.hash_method, self.expected_hash)
+        if claim:
+            self.start(self.claim())
+
+    def claim(self):
+        # True / False if the ledger (dis)allows the download, None if there
+        # is nothing to claim or the ledger is unavailable
+        if not self.claimable:
+            return None
+        try:
+            return _ledger.claim(self.hash_method, self.expected_hash,
+                                 self.info['data_id'], self.filename)
+        except Exception as e:
+            LOGGER.warning(f"Content ledger unavailable: {e}")
+            return None
+
+    def start(self, claimed=None):
+        # decides, from the claim, whether the download goes ahead
+        if self.url is None:
+            return
+        self.claimed = bool(claimed)
+        if claimed is False:
+            self.status = "DUPLICATE"
+        elif not self.wanted:
+            self.status = "SKIPPED"
+        else:
+            self.downloading = True
+            self.download_start = _now()
+            stored = None
+            if _store is not None:
+                stored = _store.lookup(self.hash_method, self.expected_hash)
+            if stored is not None:
+                # identical bytes already stored, no need to fetch them
+                self.output_path = _storage.uri(stored)
+                self.filesize = _storage.size(stored)
+                self.hash_base64 = self.expected_hash
+                self.valid_hash = True
+            else:
+                self.fetch_needed = True
+
+    def candidates(self):
+        # the notified link plus equivalent links from other caches, best
+        # first
+        if _caches is not None:
             try:
-                # download the data
-                response = _pool.request('GET', download_url)
-                # get file size
-                filesize = len(response.data)
-                # calculate hash of data if method supplied
-                if None not in (hash_method, hash_function):
-                    hash_value = hash_function(response.data).digest()
-                    # convert to base64
-                    hash_base64 = base64.b64encode(hash_value).decode()
+                return _caches.candidates(
+                    self.url, alternates_key(self.info['data_id'],
+                                             self.expected_hash))
             except Exception as e:
-                status = "FAIL"
-                pass
-            # if we have hashes compare
+                LOGGER.warning(f"Unable to rank caches: {e}")
+        return [self.url]
+
+    def writer(self):
+        # stream to storage, hashing as we go, the file is only made
+        # visible if the length and hash check out. In memory downloads
+        # without an advertised length move to storage once they exceed
+        # FUSED_MAX_BYTES.
+        length = self.info['expected_length']
+        in_memory = self.in_memory and (
+            length in (None, "") or int(length) <= FUSED_MAX_BYTES)
+        if _store is not None:
+            return _store.writer(self.filename, self.hash_method,
+                                 self.expected_hash, length, in_memory,
+                                 FUSED_MAX_BYTES)
+        return DownloadWriter(self.key, self.hash_method,
+                              self.expected_hash, length, in_memory, _storage,
+                              FUSED_MAX_BYTES)
+
+    def commit(self, url, writer):
+        self.filesize = writer.size
+        if writer.hash_method == self.hash_method:
+            self.hash_base64 = writer.hash_value
+            self.valid_hash = writer.valid_hash
+        self.url = url
+        self.cache = urlsplit(url).hostname
+        if writer.in_memory:
+            # checked now, written to storage by finish
+            writer.verify()
+            if _store is not None:
+                self.output_path = _store.object_path(writer.hash_method,
+                                                      writer.hexdigest)
+            self.pending = writer
+            writer.committed = True  # nothing to clean up on disk
+            return
+        self.persist(writer)
+
+    def persist(self, writer):
+        if _store is not None:
+            self.output_path = _store.commit(writer, self.dataset,
+                                             self.info['data_id'],
+                                             self.filename)
+            self.indexed = True
+        else:
+            writer.commit()
+
+    def archive(self):
+        # writes the download held in memory to storage, trying twice.
+        # Returns the error, None once stored.
+        writer, self.pending = self.pending, None
+        error = None
+        for attempt in range(2):
             try:
-                if None not in (hash_base64, hash_expected_value):
-                    if hash_base64 == hash_expected_value:
-                        save = True
-                        valid_hash = True
-                    else:
-                        save = True
-                        valid_hash = False
-                else:
-                    save = True
-                if save:
-                    status = "SUCCESS"
-                    output_path.write_bytes(response.data)
+                writer.committed = False
+                self.persist(writer)
+                return None
             except Exception as e:
-                status = "FAIL"
-
-            download_end = dt.datetime.now(dt.UTC).strftime("%Y-%m-%d %H:%M:%S")
-        else:
-            status = "SKIPPED"
-
-        result = {
-            'broker': broker, # int -> varchar
-            'message_id': message_id, # varchar
-            'data_id': data_id, # varchar
-            'metadata_id': metadata_id, # int -> varchar
-            'received': received, # timestamp with timezone
-            'queued': queued, # timestamp with timezone
-            'status': status, # int -> varchar
-            'cache': cache, # int -> varchar
-            'filename': str(target_directory / filename), # varchar
-            'save': save, # bool
-            'valid_hash': valid_hash, # varchar
-            'hash_method': hash_method, # int -> varchar
-            'expected_hash': hash_expected_value, # varchar
-            'hash_value': hash_base64, # varchar
-            'expected_length': expected_length, # int
-            'filesize': filesize, # int
-            'download_start': download_start, # timestamp with time zone
-            'download_end': download_end, # timestamp with time zone
-            'dataset': dataset # int -> varchar
+                LOGGER.warning(f"Unable to store {self.filename} "
+                               f"(attempt {attempt + 1}): {e}")
+                error = e
+        return error
+
+    def finish(self, error=None, ingested=False):
+        # `ingested` if the observations were already added (fused path)
+        # or QUEUED for the ingest writer, which marks them INGESTED
+        queued = ingested == QUEUED
+        if self.url is None:
+            return {}
+        if self.downloading:
+            if error is None:
+                try:
+                    if self.pending is not None:
+                        writer, self.pending = self.pending, None
+                        writer.committed = False
+                        self.persist(writer)
+                    if _store is not None and not self.indexed:
+                        _store.index(self.dataset, self.info['data_id'],
+                                     self.filename, self.output_path,
+                                     self.filesize)
+                    self.save = True
+                    self.status = "SUCCESS"
+                except Exception as e:
+                    error = e
+            if error is not None:
+                LOGGER.error(f"Download of {self.url} failed: {error}")
+                self.status = "FAIL"
+            if self.claimed:
+                try:
+                    if self.status == "SUCCESS":
+                        _ledger.mark(self.hash_method, self.expected_hash,
+                                     INGESTED if ingested and not queued
+                                     else STORED,
+                                     str(self.output_path),
+                                     if_state=CLAIMED)
+                    elif queued:
+                        # not stored, nothing for the writer to move on,
+                        # the claim expires after LEDGER_CLAIM_TIMEOUT
+                        pass
+                    elif ingested:
+                        # not stored, but copies received later are
+                        # still duplicates
+                        _ledger.mark(self.hash_method, self.expected_hash,
+                                     INGESTED, if_state=CLAIMED)
+                    else:
+                        _ledger.release(self.hash_method, self.expected_hash)
+                except Exception as e:
+                    LOGGER.warning(f"Unable to update content ledger: {e}")
+            self.download_end = _now()
+        elif self.status == "DUPLICATE":
+            self.index_duplicate()
+        return self.result()
+
+    def index_duplicate(self):
+        # the ledger is keyed by content, the same bytes notified for
+        # another dataset or subscription are a duplicate. The object they
+        # were stored as is indexed for this dataset too, observations are
+        # not added twice. Objects still being downloaded elsewhere (or in
+        # tree mode) are not indexed.
+        if _store is None:
+            return
+        stored = _store.lookup(self.hash_method, self.expected_hash)
+        if stored is None:
+            return
+        try:
+            path = _storage.uri(stored)
+            size = _storage.size(stored)
+            _store.index(self.dataset, self.info['data_id'], self.filename,
+                         path, size)
+        except Exception as e:
+            LOGGER.warning(f"Unable to index {self.filename} for "
+                           f"{self.dataset}: {e}")
+            return
+        self.output_path = path
+        self.filesize = size
+        self.indexed = True
+
+    def result(self):
+        if self.url is None:
+            return {}
+        return {
+            'broker': self.broker, # int -> varchar
+            'message_id': self.info['message_id'], # varchar
+            'data_id': self.info['data_id'], # varchar
+            'metadata_id': self.info['metadata_id'], # int -> varchar
+            'received': self.received, # timestamp with timezone
+            'queued': self.queued, # timestamp with timezone
+            'status': self.status, # int -> varchar
+            'cache': self.cache, # int -> varchar
+            'filename': str(self.output_path), # varchar
+            'save': self.save, # bool
+            'valid_hash': self.valid_hash, # varchar
+            'hash_method': self.hash_method, # int -> varchar
+            'expected_hash': self.expected_hash, # varchar
+            'hash_value': self.hash_base64, # varchar
+            'expected_length': self.info['expected_length'], # int
+            'filesize': self.filesize, # int
+            'download_start': self.download_start, # timestamp with time zone
+            'download_end': self.download_end, # timestamp with time zone
+            'dataset': self.dataset # int -> varchar
         }
-    else:
-        result = {}
 
-    # print(json.dumps(result, indent=4))
-    LOGGER.warning(json.dumps(result, indent=4))
 
+def _failed(host, error):
+    _record_cache(host, False)
+    # the cache is overloaded or throttling us, give it a break
+    if isinstance(error, HTTPStatusError) and error.status in (429, 503):
+        _limiter.backoff(host, error.retry_after)
+
+
+def _fallback(candidates, attempt, url, error):
+    # re-raise after the last candidate, otherwise log and move on
+    if attempt == len(candidates) - 1:
+        raise error
+    LOGGER.warning(f"Download from {urlsplit(url).hostname} failed "
+                   f"({error}), trying "
+                   f"{urlsplit(candidates[attempt + 1]).hostname}")
+
+
+def _fetch(download):
+    candidates = download.candidates()
+    for attempt, url in enumerate(candidates):
+        host = urlsplit(url).hostname
+        try:
+            _limiter.acquire(host)
+        except RateLimited as e:
+            _fallback(candidates, attempt, url, e)
+            continue
+        start = time.perf_counter()
+        writer = download.writer()
+        try:
+            with writer:
+                latency = stream_download(_pool_for(host), url, writer,
+                                          timeout=DOWNLOAD_TIMEOUT)
+                download.commit(url, writer)
+        except Exception as e:
+            _failed(host, e)
+            _fallback(candidates, attempt, url, e)
+            continue
+        _record_cache(host, True, latency, time.perf_counter() - start,
+                      writer.size)
+        return
+
+
+async def _fetch_async(session, download, connections):
+    # as _fetch, the ledger, Redis and storage calls are made from threads
+    # so that they do not hold up the other downloads of the batch
+    candidates = await asyncio.to_thread(download.candidates)
+    for attempt, url in enumerate(candidates):
+        host = urlsplit(url).hostname
+        try:
+            await _limiter.acquire_async(host)
+        except RateLimited as e:
+            _fallback(candidates, attempt, url, e)
+            continue
+        start = time.perf_counter()
+        writer = await asyncio.to_thread(download.writer)
+        try:
+            with writer:
+                async with connections(host):
+                    latency = await stream_download_async(session, url,
+                                                          writer)
+                await asyncio.to_thread(download.commit, url, writer)
+        except Exception as e:
+            await asyncio.to_thread(_failed, host, e)
+            _fallback(candidates, attempt, url, e)
+            continue
+        await asyncio.to_thread(_record_cache, host, True, latency,
+                                time.perf_counter() - start, writer.size)
+        return
+
+
+async def _fetch_all(downloads):
+    # one event loop and connection pool for the whole batch, the per host
+    # limit stops a batch from hammering a single cache
+    connector = aiohttp.TCPConnector(limit=DOWNLOAD_BATCH_CONCURRENCY,
+                                     limit_per_host=DOWNLOAD_LIMIT_PER_HOST)
+    timeout = aiohttp.ClientTimeout(sock_connect=DOWNLOAD_TIMEOUT,
+                                    sock_read=DOWNLOAD_TIMEOUT)
+    semaphores = {}
+
+    def connections(host):
+        # hosts with their own connection budget in DOWNLOAD_HOST_LIMITS
+        if host not in semaphores:
+            limit = _limiter.connections(host)
+            semaphores[host] = asyncio.Semaphore(limit) if limit \
+                else contextlib.nullcontext()
+        return semaphores[host]
+
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=timeout) as session:
+        return await asyncio.gather(
+            *(_fetch_async(session, download, connections)
+              for download in downloads),
+            return_exceptions=True)
+
+
+def _retry_or_dead_letter(task, job, error, result):
+    retries = task.request.retries
+    if retries < DOWNLOAD_MAX_RETRIES:
+        # re-sent to the broker with an ETA, the worker slot is free in the
+        # meantime and any linked ingest follows the retry
+        countdown = retry_countdown(retries)
+        LOGGER.warning(f"Retrying {result['data_id']} in {countdown:.0f}s")
+        raise task.retry(countdown=countdown, exc=error,
+                         max_retries=DOWNLOAD_MAX_RETRIES)
+    _dead_letter(job, error, result, retries + 1)
+
+
+def _dead_letter(job, error, result, attempts):
+    LOGGER.error(f"Giving up on {result.get('data_id')} after {attempts} "
+                 f"attempts: {error}")
+    try:
+        _deadletter.push(job, error, attempts, result)
+    except Exception as e:
+        LOGGER.error(f"Unable to add job to dead letter queue: {e}")
+
+
+@app.task(bind=True)
+def download_from_wis2(self, job):
+    LOGGER.debug(f"Processing job{json.dumps(job)}")
+    download = _Download(job)
+    error = None
+    if download.fetch_needed:
+        try:
+            _fetch(download)
+        except Exception as e:
+            error = e
+    result = download.finish(error)
+    _log_result(result)
+    if error is not None:
+        _retry_or_dead_letter(self, job, error, result)
+    return result
+
+
+@app.task(bind=True, base=DBTask)
+def download_and_ingest(self, job):
+    # download_from_wis2 and decode_and_ingest in one task. Small files are
+    # decoded from memory while they are written to disk in the background,
+    # saving the second task, the result round trip through Redis and
+    # reading the file back.
+    LOGGER.debug(f"Processing job{json.dumps(job)}")
+    download = _Download(job, in_memory=True)
+    error = None
+    if download.fetch_needed:
+        try:
+            _fetch(download)
+        except Exception as e:
+            error = e
+    if download.pending is None:
+        # failed, skipped, already on disk or too large to keep in memory
+        result = download.finish(error)
+        _log_result(result)
+        if error is not None:
+            _retry_or_dead_letter(self, job, error, result)
+        decode_and_ingest(result)
+        return result
+    # decoded from memory while the file is written to storage, the result
+    # is returned once it is stored
+    bufr = download.pending.data
+    archived = _archiver.submit(download.archive)
+    ingested = False
+    try:
+        ingested = ingest_bufr(bufr, download.result(), mark=False)
+    finally:
+        error = archived.result()
+        result = download.finish(error, ingested)
+        _log_result(result)
+    if error is not None and not ingested:
+        _retry_or_dead_letter(self, job, error, result)
     return result
 
+
+def _claim_all(downloads):
+    # one ledger statement for the whole batch rather than one per job
+    claimable = [download for download in downloads if download.claimable]
+    claims = {}
+    if claimable:
+        try:
+            claims = dict(zip(map(id, claimable), _ledger.claim_many([
+                (download.hash_method, download.expected_hash,
+                 download.info['data_id'], download.filename)
+                for download in claimable])))
+        except Exception as e:
+            LOGGER.warning(f"Content ledger unavailable: {e}")
+    for download in downloads:
+        download.start(claims.get(id(download)))
+
+
+@app.task
+def download_batch_from_wis2(jobs):
+    # Downloads a list of jobs concurrently on an asyncio HTTP client, so a
+    # worker slot is not tied up by a single blocking request. Returns one
+    # result per job, in order, as download_from_wis2 would.
+    LOGGER.debug(f"Processing batch of {len(jobs)} jobs")
+    downloads = [_Download(job, claim=False) for job in jobs]
+    _claim_all(downloads)
+    pending = [download for download in downloads if download.fetch_needed]
+    errors = {}
+    if pending:
+        outcomes = asyncio.run(_fetch_all(pending))
+        errors = {id(download): outcome for download, outcome in
+                  zip(pending, outcomes) if isinstance(outcome, BaseException)}
+    results = []
+    for job, download in zip(jobs, downloads):
+        error = errors.get(id(download))
+        result = download.finish(error)
+        _log_result(result)
+        if error is not None:
+            if DOWNLOAD_MAX_RETRIES > 0:
+                # retried on its own, as the first retry of a single job
+                download_from_wis2.signature(
+                    (job,), link=decode_and_ingest.s()).apply_async(
+                    countdown=retry_countdown(0), retries=1)
+            else:
+                _dead_letter(job, error, result, 1)
+        results.append(result)
+    return results
+
+
+@app.task
+def ingest_batch(results):
+    # fan out, one decode_and_ingest per downloaded file so that decoding
+    # is spread over the workers
+    to_ingest = [result for result in results
+                 if result.get('status') == 'SUCCESS']
+    if to_ingest:
+        group(decode_and_ingest.s(result) for result in to_ingest).apply_async()
+    return len(to_ingest)
+
 @app.task(base=DBTask)
 def decode_and_ingest(result):
     if result.get('status','FAILED') == 'SUCCESS':
@@ -243,150 +714,232 @@ def decode_and_ingest(result):
         #with sessionmaker(bind=engine)() as session:
         # load BUFR data
         datafile = result.get('filename')
-        with open(datafile, 'rb') as fh:
-            bufr = fh.read()
-        # convert / transform
-        features = transform(bufr)
-        observations = []
-        is_member_of = result.get('dataset', 'NA')
-        is_member_of = fetch_uri_id(Dataset, is_member_of, session)
-        # iterate over features
-        for obj in features:
-            feature = obj.get("geojson")
-            if feature is None:
-                continue
-            observation = {}
-            if feature['geometry'] is None:
-                LOGGER.error(f"Bad location in {datafile}, skipping")
-                continue
-            geom_type = feature['geometry']['type']
-            if geom_type != "Point":
-                raise NotImplementedError
-            lon, lat = feature['geometry']['coordinates']
-            if None in (lon, lat):
-                LOGGER.error(f"Bad location in {datafile}, skipping")
-                continue
-            location = f"POINT({lon} {lat})"
-            observation['location'] = location
-            # extract properties, first value
-            if feature['properties'].get('observationType') == MEASURE:
-                observation['result_value'] = feature['properties'][
-                    'result'].get('value')
-                observation['result_units'] = feature['properties'][
-                    'result'].get('units')
-                observation['result_units'] = fetch_uri_id(Units, observation[
-                    'result_units'], session)
-                observation['result_uncertainty'] = feature['properties'][
-                    'result'].get('standardUncertainty')
-            elif feature['properties'].get('observationType') == CATEGORICAL:
-                # check if we have flag or code table
-                if 'flags' in feature['properties']['result']['value']:
-                    observation['result_value'] = int(feature['properties']['result']['value']['entry'], 2)
-                    observation['result_code_table'] = feature['properties']['result']['value']['flags']
-                    observation['result_description'] = ""
-                else:
-                    observation['result_value'] = int(feature['properties']['result']['value']['entry'])
-                    observation['result_code_table'] = feature['properties']['result']['value']['codetable']
-                    observation['result_description'] = feature['properties']['result']['value']['description']
-                observation['result_units'] = feature['properties']['result']['units']
-                observation['result_uncertainty'] = feature['properties']['result']['standardUncertainty']
-                observation['result_units'] = fetch_uri_id(Units, observation['result_units'],session)
-                observation['result_code_table'] = fetch_uri_id(CodeTable,observation['result_code_table'],session)
-            uri = feature['properties'].get('observationType')
-            if uri is not None:
-                observation['observation_type'] = fetch_uri_id(ObservationType,uri,session)
-            uri = feature['properties'].get('observingProcedure')
-            if uri is not None:
-                observation['observing_procedure'] = fetch_uri_id(ObservingProcedure, uri,session)
-
-
-            uri = feature['properties'].get('observedProperty')
-            observation['observed_property'] = observed_property_map.get(uri, {}).get("id", None)
-            if observation['observed_property'] is None:
-                LOGGER.warning(f"Skipping observed property: {uri}")
-                continue
-
-            uri = feature['properties'].get('host','UNKNOWN')
-            if uri is not None:
-                observation['host'] = fetch_uri_id(Host, uri,session)
+        bufr = _storage.read_uri(datafile)
+        ingest_bufr(bufr, result)
+    else:
+        pass
+
+
+def ingest_bufr(bufr, result, mark=True):
+    # decode the BUFR bytes of a downloaded file and add the observations.
+    # Returns True if they were added, QUEUED if they were published for the
+    # ingest writer. With `mark` the ledger entry of the stored file is moved
+    # to INGESTED once they are added.
+    datafile = result.get('filename')
+    # convert / transform
+    features = list(transform(bufr))
+    observations = []
+    # lookup table URIs are replaced by their ids when the observations are
+    # written, see resolve_uris
+    is_member_of = result.get('dataset', 'NA')
+    # iterate over features
+    for obj in features:
+        feature = obj.get("geojson")
+        if feature is None:
+            continue
+        observation = {}
+        if feature['geometry'] is None:
+            LOGGER.error(f"Bad location in {datafile}, skipping")
+            continue
+        geom_type = feature['geometry']['type']
+        if geom_type != "Point":
+            raise NotImplementedError
+        lon, lat = feature['geometry']['coordinates']
+        if None in (lon, lat):
+            LOGGER.error(f"Bad location in {datafile}, skipping")
+            continue
+        location = f"POINT({lon} {lat})"
+        observation['location'] = location
+        # extract properties, first value
+        if feature['properties'].get('observationType') == MEASURE:
+            observation['result_value'] = feature['properties'][
+                'result'].get('value')
+            observation['result_units'] = feature['properties'][
+                'result'].get('units')
+            observation['result_uncertainty'] = feature['properties'][
+                'result'].get('standardUncertainty')
+        elif feature['properties'].get('observationType') == CATEGORICAL:
+            # check if we have flag or code table
+            if 'flags' in feature['properties']['result']['value']:
+                observation['result_value'] = int(feature['properties']['result']['value']['entry'], 2)
+                observation['result_code_table'] = feature['properties']['result']['value']['flags']
+                observation['result_description'] = ""
             else:
-                observation['host'] = fetch_uri_id(Host, "UNKNOWN", session)
-
-            uri = feature['properties'].get('observer')
-            if uri is not None:
-                observation['observer'] = fetch_uri_id(Observer, uri,session)
-
-            observation['is_member_of'] = is_member_of
-
-            # parse date / time elements
-            start, end, duration = time_parser(feature['properties']['phenomenonTime'])
-            observation['phenomenon_time_start'] = start
-            observation['phenomenon_time_end'] = end
-            observation['phenomenon_duration'] = f"{duration.total_seconds()} seconds"
-            observation['result_time'] = feature['properties']['resultTime']
-            for k, v in feature['properties']['parameter'].items():
-                if k not in ("additionalProperties", "reportType", "reportIdentifier","isMemberOf"):
-                    key = camel2snake(k)
-                    observation[key] = v
-
-
-            uri = feature['properties']['parameter']['reportType']
-            observation['report_type'] = report_type_map.get(uri, {}).get("id", 0)
-            if observation['report_type'] is None:
-                LOGGER.warning(f"Skipping report_type: {uri}")
-                continue
-
-
-            uri = feature['properties']['parameter']['reportIdentifier']
-            observation['report_identifier'] = fetch_uri_id(ReportIdentifier,uri,session, use_cache=False)
-
-            result_quality = list()
-            for flag in feature['properties']['resultQuality']:
-                if flag.get('inScheme') is not None:
-                    result_quality.append(QualityFlag(
-                        scheme=flag.get('inScheme'),
-                        flag=flag.get('flag'),
-                        value=flag.get('flagValue')))
-
-            feature_of_interest = list()
-            for foi in feature['properties']['featureOfInterest']:
-                if foi.get('id') is not None:
-                    feature_of_interest.append(Feature(
-                        uri=foi.get('id'),
-                        label=foi.get('label'),
-                        relation=foi.get('relation')))
-
-            observation['result_quality'] = result_quality
-            observation['feature_of_interest'] = feature_of_interest
-            try:
-                observations.append(Observation(**observation))
-            except Exception as e:
-                LOGGER.eeror("Error appending observation, skipping")
-                continue
+                observation['result_value'] = int(feature['properties']['result']['value']['entry'])
+                observation['result_code_table'] = feature['properties']['result']['value']['codetable']
+                observation['result_description'] = feature['properties']['result']['value']['description']
+            observation['result_units'] = feature['properties']['result']['units']
+            observation['result_uncertainty'] = feature['properties']['result']['standardUncertainty']
+        uri = feature['properties'].get('observationType')
+        if uri is not None:
+            observation['observation_type'] = uri
+        uri = feature['properties'].get('observingProcedure')
+        if uri is not None:
+            observation['observing_procedure'] = uri
+
+
+        uri = feature['properties'].get('observedProperty')
+        observation['observed_property'] = observed_property_map.get(uri, {}).get("id", None)
+        if observation['observed_property'] is None:
+            LOGGER.warning(f"Skipping observed property: {uri}")
+            continue
+
+        uri = feature['properties'].get('host','UNKNOWN')
+        if uri is not None:
+            observation['host'] = uri
+        else:
+            observation['host'] = "UNKNOWN"
+
+        uri = feature['properties'].get('observer')
+        if uri is not None:
+            observation['observer'] = uri
+
+        observation['is_member_of'] = is_member_of
+
+        # parse date / time elements
+        start, end, duration = time_parser(feature['properties']['phenomenonTime'])
+        observation['phenomenon_time_start'] = start
+        observation['phenomenon_time_end'] = end
+        observation['phenomenon_duration'] = f"{duration.total_seconds()} seconds"
+        observation['result_time'] = feature['properties']['resultTime']
+        for k, v in feature['properties']['parameter'].items():
+            if k not in ("additionalProperties", "reportType", "reportIdentifier","isMemberOf"):
+                key = camel2snake(k)
+                observation[key] = v
+
+
+        uri = feature['properties']['parameter']['reportType']
+        observation['report_type'] = report_type_map.get(uri, {}).get("id", 0)
+        if observation['report_type'] is None:
+            LOGGER.warning(f"Skipping report_type: {uri}")
+            continue
+
+
+        uri = feature['properties']['parameter']['reportIdentifier']
+        observation['report_identifier'] = uri
+
+        result_quality = list()
+        for flag in feature['properties']['resultQuality']:
+            if flag.get('inScheme') is not None:
+                result_quality.append({
+                    'scheme': flag.get('inScheme'),
+                    'flag': flag.get('flag'),
+                    'value': flag.get('flagValue')})
+
+        feature_of_interest = list()
+        for foi in feature['properties']['featureOfInterest']:
+            if foi.get('id') is not None:
+                feature_of_interest.append({
+                    'uri': foi.get('id'),
+                    'label': foi.get('label'),
+                    'relation': foi.get('relation')})
+
+        observation['result_quality'] = result_quality
+        observation['feature_of_interest'] = feature_of_interest
+        observations.append(observation)
+    if INGEST_STREAM and observations:
+        try:
+            publish(observations, result)
+            LOGGER.info(f"{len(observations)} observations queued")
+            # the ingest writer updates the ledger once they are written
+            return QUEUED
+        except Exception as e:
+            LOGGER.warning(f"Unable to queue observations from {datafile}, "
+                           f"writing them directly: {e}")
+    resolve_uris(observations, session)
+    ingested = False
+    if INGEST_BULK:
         try:
-            session.add_all(observations)
+            count = write_observations(session, observations)
+            mark_ingested(session, [datafile])
             session.commit()
-            print(f"{len(observations)} observations added")
-        except ProgrammingError as e:
-            session.rollback()
-            for o in observations:
-                LOGGER.error("Adding 1")
-                try:
-                    session.add(o)
-                    session.commit()
-                except Exception as e:
-                    LOGGER.error("Failed add 1")
-                    LOGGER.error(e)
-                    LOGGER.error(o)
-                    session.rollback()
+            LOGGER.info(f"{count} observations added")
+            ingested = True
         except Exception as e:
-            LOGGER.error(e)
-            LOGGER.error("Error adding data, dumping to file")
-            LOGGER.error(observations)
             session.rollback()
-    else:
-        pass
+            LOGGER.warning(f"Bulk ingest of {datafile} failed, adding "
+                           f"observations with the ORM: {e}")
+    if not ingested:
+        ingested = _add_observations(observations)
+        if ingested:
+            try:
+                mark_ingested(session, [datafile])
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                LOGGER.warning(f"Unable to record {datafile} as ingested: "
+                               f"{e}")
+    if ingested and mark and _ledger is not None and None not in (
+            result.get('hash_method'), result.get('expected_hash')):
+        try:
+            _ledger.mark(result['hash_method'], result['expected_hash'],
+                         INGESTED, if_state=STORED)
+        except Exception as e:
+            LOGGER.warning(f"Unable to update content ledger: {e}")
+    return ingested
+
+
+def _add_observations(rows):
+    # ORM path, row by row if the batch fails
+    observations = []
+    for row in rows:
+        try:
+            observations.append(Observation(
+                **dict(row,
+                       result_quality=[QualityFlag(**flag) for flag in
+                                       row['result_quality']],
+                       feature_of_interest=[Feature(**foi) for foi in
+                                            row['feature_of_interest']])))
+        except Exception as e:
+            LOGGER.error("Error appending observation, skipping")
+            continue
+    ingested = False
+    try:
+        session.add_all(observations)
+        session.commit()
+        LOGGER.debug(f"{len(observations)} observations added")
+        ingested = True
+    except ProgrammingError as e:
+        session.rollback()
+        # whatever can be added is added one by one
+        added = 0
+        for o in observations:
+            LOGGER.error("Adding 1")
+            try:
+                session.add(o)
+                session.commit()
+                added += 1
+            except Exception as e:
+                LOGGER.error("Failed add 1")
+                LOGGER.error(e)
+                LOGGER.error(o)
+                session.rollback()
+        ingested = added > 0
+    except Exception as e:
+        LOGGER.error(e)
+        LOGGER.error("Error adding data, dumping to file")
+        LOGGER.error(observations)
+        session.rollback()
+    return ingested
 
 
+@app.task
+def compact_downloads():
+    # pack finished days of the download tree into daily archives, objects
+    # in the content addressed store or object storage are left as they are
+    if _store is not None or not _storage.local:
+        return 0
+    total = 0
+    for day_directory in days_to_compact(DATA_BASEPATH):
+        try:
+            total += compact_day(day_directory)
+        except Exception as e:
+            LOGGER.error(f"Unable to compact {day_directory}: {e}")
+    return total
+
+
+@app.task
 def clean_up():
-    pass
\ No newline at end of file
+    # apply the retention policies, returns what was reclaimed
+    return RetentionEngine(DATA_BASEPATH, engine, _store, _storage,
+                           ledger=_ledger).run()
@@ -0,0 +1,21 @@
+import os
+
+from sqlalchemy import create_engine, text
+
+# Import tables to create
+from task_manager.schema import *
+
+# set connection details
+UID = os.environ["POSTGRES_USER"]
+PWD = os.environ["POSTGRES_PASSWORD"]
+DBNAME = os.environ["POSTGRES_DB"]
+DBHOST = os.environ["POSTGRES_HOST"]
+DBPORT = os.environ["POSTGRES_PORT"]
+
+engine = create_engine(f"postgresql+psycopg2://{UID}:{PWD}@{DBHOST}:{DBPORT}/{DBNAME}", echo=True)
+
+with engine.begin() as conn:
+    # the index refers to objects on disk, keep it if it already exists
+    conn.execute(text("CREATE SCHEMA IF NOT EXISTS task_manager"))
+
+Base.metadata.create_all(engine)
@@ -2,6 +2,7 @@
 import os
 
 from celery import Celery
+from celery.schedules import crontab
 import sys
 
 
@@ -15,6 +16,21 @@ app = Celery('tasks',
              broker=CELERY_BROKER,
              result_backend=CELERY_RESULT_BACKEND)
 
+# Periodic tasks, run by `task_manager_start beat`
+COMPACT_SCHEDULE = os.environ.get("COMPACT_SCHEDULE", "30 0")  # minute hour, UTC
+RETENTION_SCHEDULE = os.environ.get("RETENTION_SCHEDULE", "15 *")
+app.conf.beat_schedule = {
+    'compact-downloads': {
+        'task': 'task_manager.tasks.wis2.compact_downloads',
+        'schedule': crontab(*COMPACT_SCHEDULE.split())
+    },
+    'clean-up': {
+        'task': 'task_manager.tasks.wis2.clean_up',
+        'schedule': crontab(*RETENTION_SCHEDULE.split())
+    }
+}
+app.conf.timezone = 'UTC'
+
 # Import your tasks
 app.autodiscover_tasks(['task_manager.tasks','task_manager.tasks.wis2' ])
 
@@ -2,5 +2,23 @@ from celery import chain, signature
 from task_manager.tasks.wis2 import *
 
 def wis2_download_and_ingest(args):
-    workflow = download_from_wis2.s(args) | decode_and_ingest.s()
-    return workflow
\ No newline at end of file
+    # equivalent to download_from_wis2.s(args) | decode_and_ingest.s() but,
+    # unlike a chain, the signature honours the producer passed to
+    # apply_async, allowing jobs to be published in batches
+    workflow = download_from_wis2.s(args)
+    workflow.link(decode_and_ingest.s())
+    return workflow
+
+
+def wis2_batch_download_and_ingest(jobs):
+    # a list of jobs downloaded concurrently by one task, the downloaded
+    # files are then fanned out to decode_and_ingest individually
+    workflow = download_batch_from_wis2.s(jobs)
+    workflow.link(ingest_batch.s())
+    return workflow
+
+
+def wis2_fused_download_and_ingest(args):
+    # download and ingest in a single task, small files are decoded from
+    # memory without a round trip through disk and the result backend
+    return download_and_ingest.s(args)
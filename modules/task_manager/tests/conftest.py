@@ -0,0 +1,35 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from task_manager.schema import Base
+
+# a scratch PostgreSQL database, e.g.
+# postgresql+psycopg2://postgres@localhost/test. Its task_manager schema is
+# dropped and created again, tests needing the database are skipped if
+# this is not set.
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+def engine():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL not set")
+    engine = create_engine(TEST_DATABASE_URL)
+    with engine.begin() as conn:
+        conn.execute(text("DROP SCHEMA IF EXISTS task_manager CASCADE"))
+        conn.execute(text("CREATE SCHEMA task_manager"))
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    import fakeredis
+
+    from task_manager import shared
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(shared, "_redis", client)
+    return client
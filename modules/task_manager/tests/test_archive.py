@@ -0,0 +1,75 @@
+import datetime as dt
+import tarfile
+
+from task_manager.archive import (archive_paths, compact_day, DailyArchive,
+                                  days_to_compact, read_download)
+
+
+def day(tmp_path, files, date="2024/01/02"):
+    directory = tmp_path / "dataset" / date
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, data in files.items():
+        (directory / name).write_bytes(data)
+    return directory
+
+
+def test_compact_and_read(tmp_path):
+    directory = day(tmp_path, {"a.bufr": b"A" * 1000, "b.bufr": b"B" * 10,
+                               ".c.bufr.part": b"partial"})
+    assert compact_day(directory) == 2
+    archive_path, index_path = archive_paths(directory)
+    assert archive_path.name == "02.tar" and index_path.name == "02.tar.idx"
+    # in flight downloads stay, so does the directory
+    assert [path.name for path in directory.iterdir()] == [".c.bufr.part"]
+    archive = DailyArchive(archive_path)
+    assert sorted(archive.names()) == ["a.bufr", "b.bufr"]
+    assert archive.read("a.bufr") == b"A" * 1000
+    assert dict(archive.scan()) == {"a.bufr": b"A" * 1000, "b.bufr": b"B" * 10}
+    assert read_download(directory / "b.bufr") == b"B" * 10
+
+
+def test_directory_removed_once_empty(tmp_path):
+    directory = day(tmp_path, {"a.bufr": b"A"})
+    compact_day(directory)
+    assert not directory.exists()
+    assert read_download(directory / "a.bufr") == b"A"
+    assert compact_day(day(tmp_path, {})) == 0
+
+
+def test_append(tmp_path):
+    directory = day(tmp_path, {"a.bufr": b"A" * 600, "b.bufr": b"B"})
+    compact_day(directory)
+    # late arrivals, including a new copy of a packed file
+    day(tmp_path, {"b.bufr": b"B2", "c.bufr": b"C" * 700})
+    assert compact_day(directory) == 2
+    archive = DailyArchive(archive_paths(directory)[0])
+    assert {name: archive.read(name) for name in archive.names()} == {
+        "a.bufr": b"A" * 600, "b.bufr": b"B2", "c.bufr": b"C" * 700}
+    with tarfile.open(archive.path) as tar:
+        assert tar.getnames() == ["a.bufr", "b.bufr", "b.bufr", "c.bufr"]
+
+
+def test_interrupted_run_is_truncated(tmp_path):
+    directory = day(tmp_path, {"a.bufr": b"A" * 600})
+    compact_day(directory)
+    archive_path, index_path = archive_paths(directory)
+    index = index_path.read_text()
+    # a run that wrote to the archive but died before the index was replaced
+    with open(archive_path, "ab") as fh:
+        fh.write(b"\x01" * 3000)
+    day(tmp_path, {"b.bufr": b"B"})
+    assert compact_day(directory) == 1
+    assert index_path.read_text().startswith(index)
+    archive = DailyArchive(archive_path)
+    assert dict(archive.scan()) == {"a.bufr": b"A" * 600, "b.bufr": b"B"}
+    assert archive.read("b.bufr") == b"B"
+
+
+def test_days_to_compact(tmp_path):
+    today = dt.date.today()
+    old = today - dt.timedelta(days=3)
+    for date in (today, old):
+        day(tmp_path, {"a.bufr": b"A"}, f"{date:%Y/%m/%d}")
+    (tmp_path / "dataset" / "2024" / "01" / "xx").mkdir(parents=True)
+    assert list(days_to_compact(tmp_path, after_days=1)) == [
+        tmp_path / "dataset" / f"{old:%Y/%m/%d}"]
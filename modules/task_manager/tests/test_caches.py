@@ -0,0 +1,42 @@
+import fakeredis
+
+from task_manager.caches import (alternates_key, CacheStats,
+                                 register_alternates_many)
+
+
+def notification(n, host):
+    return {"properties": {"data_id": f"synop/{n}",
+                           "integrity": {"method": "sha512", "value": "abc"}},
+            "links": [{"rel": "canonical", "href": f"https://{host}/{n}"},
+                      {"rel": "via", "href": f"https://{host}/meta"}]}
+
+
+def test_alternates_from_several_caches():
+    client = fakeredis.FakeRedis()
+    register_alternates_many([notification(1, "cache-a"),
+                              notification(1, "cache-b"),
+                              {"properties": {}}], client)
+    assert client.hgetall(alternates_key("synop/1", "abc")) == {
+        b"cache-a": b"https://cache-a/1", b"cache-b": b"https://cache-b/1"}
+    assert client.ttl(alternates_key("synop/1", "abc")) > 0
+
+
+def test_candidates_ranked_by_score():
+    client = fakeredis.FakeRedis()
+    stats = CacheStats(client)
+    register_alternates_many([notification(1, "cache-b"),
+                              notification(1, "cache-c")], client)
+    for _ in range(4):
+        stats.record("cache-a", True, latency=0.5, seconds=1, nbytes=100)
+        stats.record("cache-b", True, latency=0.05, seconds=1, nbytes=100)
+        stats.record("cache-c", False)
+    candidates = stats.candidates("https://cache-a/1",
+                                  alternates_key("synop/1", "abc"))
+    assert candidates == ["https://cache-b/1", "https://cache-a/1",
+                          "https://cache-c/1"]
+
+
+def test_single_link_needs_no_ranking():
+    stats = CacheStats(fakeredis.FakeRedis())
+    assert stats.candidates("https://cache-a/1", "missing") == [
+        "https://cache-a/1"]
@@ -0,0 +1,150 @@
+import fakeredis
+import pytest
+
+from task_manager import deadletter
+from task_manager.deadletter import DeadLetterQueue, retry_countdown
+
+
+def job(n):
+    return {"topic": "cache/a/wis2/x", "target": "ds",
+            "payload": {"id": f"m{n}", "properties": {"data_id": f"d{n}"}}}
+
+
+@pytest.fixture
+def queue():
+    return DeadLetterQueue(fakeredis.FakeRedis(), max_entries=10)
+
+
+def test_push_and_list(queue):
+    first = queue.push(job(1), ConnectionError("refused"), 6,
+                       {"data_id": "d1", "cache": "cache-a.example.org"})
+    second = queue.push(job(2))
+    assert queue.size() == 2
+    entries = queue.list()
+    assert [entry["id"] for entry in entries] == [first, second]
+    assert entries[0]["error"] == "refused"
+    assert (entries[0]["attempts"], entries[0]["data_id"],
+            entries[0]["cache"]) == (6, "d1", "cache-a.example.org")
+    assert entries[0]["job"] == job(1)
+    assert entries[1]["error"] is None
+    assert queue.list(offset=1, limit=1) == entries[1:]
+    assert queue.get(first) == entries[0]
+    assert queue.get("missing") is None
+
+
+def test_trim_drops_the_oldest(queue):
+    queue.max_entries = 3
+    ids = [queue.push(job(n)) for n in range(5)]
+    assert queue.size() == 3
+    assert [entry["id"] for entry in queue.list()] == ids[2:]
+    assert queue.get(ids[0]) is None
+
+
+def test_replay_removes_submitted_entries(queue):
+    ids = [queue.push(job(n)) for n in range(3)]
+    submitted = []
+    assert queue.replay(submitted.append, limit=2) == 2
+    assert submitted == [job(0), job(1)]
+    assert [entry["id"] for entry in queue.list()] == ids[2:]
+    assert queue.replay(submitted.append, ids=[ids[2], "missing"]) == 1
+    assert queue.size() == 0
+
+
+def test_failed_replay_puts_the_entry_back(queue):
+    ids = [queue.push(job(n)) for n in range(2)]
+
+    def submit(job):
+        if job["payload"]["id"] == "m0":
+            raise ConnectionError("broker unavailable")
+
+    assert queue.replay(submit) == 1
+    entry, = queue.list()
+    assert entry["id"] == ids[0]
+    assert entry["job"] == job(0)
+
+
+def test_purge(queue):
+    ids = [queue.push(job(n)) for n in range(3)]
+    assert queue.purge([ids[1]]) == 1
+    assert [entry["id"] for entry in queue.list()] == [ids[0], ids[2]]
+    assert queue.purge() == 2
+    assert queue.size() == 0
+    assert queue.client.hlen("wis2:deadletter:entries") == 0
+
+
+def test_retry_countdown_bounds():
+    for retries in range(8):
+        delay = min(900, 30 * 2 ** retries)
+        countdowns = [retry_countdown(retries, 30, 900) for _ in range(200)]
+        # half the delay is fixed, half is jitter
+        assert all(delay / 2 <= countdown <= delay
+                   for countdown in countdowns)
+        assert len(set(countdowns)) > 1
+
+
+def test_retry_countdown_jitter_extremes(monkeypatch):
+    monkeypatch.setattr(deadletter.random, "uniform", lambda low, high: low)
+    assert retry_countdown(0, 30, 900) == 15
+    monkeypatch.setattr(deadletter.random, "uniform", lambda low, high: high)
+    assert retry_countdown(1, 30, 900) == 60
+    assert retry_countdown(10, 30, 900) == 900
+
+
+@pytest.fixture
+def wis2(monkeypatch, queue):
+    try:
+        from task_manager.tasks import wis2
+    except (ImportError, KeyError) as e:
+        # the decoders, the wccdm package and POSTGRES_* settings
+        pytest.skip(f"download tasks unavailable: {e}")
+    monkeypatch.setattr(wis2, "_deadletter", queue)
+    monkeypatch.setattr(wis2, "DOWNLOAD_MAX_RETRIES", 2)
+    return wis2
+
+
+class Retry(Exception):
+    pass
+
+
+class FakeTask():
+    def __init__(self, retries):
+        self.request = type("Request", (), {"retries": retries})()
+        self.retried = None
+
+    def retry(self, countdown=None, exc=None, max_retries=None):
+        self.retried = (countdown, exc, max_retries)
+        return Retry()
+
+
+def test_failures_are_retried_with_backoff(wis2, queue):
+    task = FakeTask(retries=1)
+    error = ConnectionError("refused")
+    with pytest.raises(Retry):
+        wis2._retry_or_dead_letter(task, job(1), error, {"data_id": "d1"})
+    countdown, exc, max_retries = task.retried
+    delay = min(deadletter.DOWNLOAD_RETRY_BACKOFF_MAX,
+                deadletter.DOWNLOAD_RETRY_BACKOFF * 2)
+    assert delay / 2 <= countdown <= delay
+    assert (exc, max_retries) == (error, 2)
+    assert queue.size() == 0
+
+
+def test_exhausted_retries_are_dead_lettered(wis2, queue):
+    task = FakeTask(retries=2)
+    wis2._retry_or_dead_letter(task, job(1), ConnectionError("refused"),
+                               {"data_id": "d1", "cache": "cache-a"})
+    assert task.retried is None
+    entry, = queue.list()
+    assert (entry["attempts"], entry["error"], entry["data_id"],
+            entry["cache"], entry["job"]) == \
+        (3, "refused", "d1", "cache-a", job(1))
+
+
+def test_dead_letter_survives_redis_errors(wis2, monkeypatch):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    monkeypatch.setattr(wis2, "_deadletter", DeadLetterQueue(
+        fakeredis.FakeRedis(server=server)))
+    # logged, the task itself does not fail
+    wis2._retry_or_dead_letter(FakeTask(retries=2), job(1),
+                               ConnectionError("refused"), {"data_id": "d1"})
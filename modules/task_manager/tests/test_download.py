@@ -0,0 +1,161 @@
+import base64
+import hashlib
+import http.server
+import os
+import stat
+import threading
+
+import pytest
+import urllib3
+
+from task_manager.download import (DownloadError, DownloadWriter, parse_job,
+                                   stream_download)
+from task_manager.storage import LocalStorage
+
+DATA = b"BUFR" + bytes(range(256)) * 4 + b"7777"
+SHA512 = base64.b64encode(hashlib.sha512(DATA).digest()).decode()
+
+
+def writer(tmp_path, **kwargs):
+    kwargs.setdefault("hash_method", "sha512")
+    kwargs.setdefault("expected_hash", SHA512)
+    kwargs.setdefault("expected_length", len(DATA))
+    return DownloadWriter("a/b/file.bufr", storage=LocalStorage(tmp_path),
+                          **kwargs)
+
+
+def files(tmp_path):
+    return sorted(str(path.relative_to(tmp_path))
+                  for path in tmp_path.rglob("*") if path.is_file())
+
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_commit(tmp_path, in_memory):
+    with writer(tmp_path, in_memory=in_memory) as download:
+        download.write(DATA[:100])
+        download.write(DATA[100:])
+        download.commit()
+    assert (tmp_path / "a/b/file.bufr").read_bytes() == DATA
+    assert files(tmp_path) == ["a/b/file.bufr"]
+    assert download.hexdigest == hashlib.sha512(DATA).hexdigest()
+    assert download.data == (DATA if in_memory else None)
+
+
+def test_in_memory_spills_to_storage(tmp_path):
+    with writer(tmp_path, in_memory=True, expected_length=None,
+                max_memory=100) as download:
+        download.write(DATA[:100])
+        assert download.in_memory
+        download.write(DATA[100:200])
+        assert not download.in_memory and download.data is None
+        download.write(DATA[200:])
+        download.commit()
+    assert (tmp_path / "a/b/file.bufr").read_bytes() == DATA
+    assert files(tmp_path) == ["a/b/file.bufr"]
+
+
+def test_spilled_download_is_discarded(tmp_path):
+    with writer(tmp_path, in_memory=True, max_memory=10) as download:
+        download.write(DATA[:100])
+    assert files(tmp_path) == []
+
+
+def test_committed_file_mode_follows_umask(tmp_path):
+    umask = os.umask(0o022)
+    os.umask(umask)
+    with writer(tmp_path) as download:
+        download.write(DATA)
+        download.commit()
+    mode = stat.S_IMODE((tmp_path / "a/b/file.bufr").stat().st_mode)
+    assert mode == 0o666 & ~umask
+
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_hash_mismatch_leaves_nothing(tmp_path, in_memory):
+    with pytest.raises(DownloadError, match="hash mismatch"):
+        with writer(tmp_path, in_memory=in_memory,
+                    expected_hash=SHA512[::-1]) as download:
+            download.write(DATA)
+            download.commit()
+    assert files(tmp_path) == []
+
+
+def test_short_download(tmp_path):
+    with pytest.raises(DownloadError, match="expected"):
+        with writer(tmp_path) as download:
+            download.write(DATA[:-1])
+            download.commit()
+    assert files(tmp_path) == []
+
+
+def test_long_download_fails_early(tmp_path):
+    with writer(tmp_path) as download:
+        with pytest.raises(DownloadError, match="exceeds"):
+            download.write(DATA + b"x")
+
+
+def test_content_length(tmp_path):
+    download = writer(tmp_path, expected_length=str(len(DATA)))
+    download.check_length(str(len(DATA)))
+    download.check_length(None)
+    with pytest.raises(DownloadError):
+        download.check_length(str(len(DATA) + 1))
+    download.discard()
+
+
+def test_without_integrity(tmp_path):
+    with writer(tmp_path, hash_method=None, expected_hash=None,
+                expected_length="") as download:
+        download.write(DATA)
+        assert download.valid_hash is None
+        download.commit("c/file.bufr")
+    assert files(tmp_path) == ["c/file.bufr"]
+
+
+def test_parse_job_prefers_update_link():
+    job = {"payload": {
+        "id": "m1",
+        "properties": {"data_id": "d1",
+                       "integrity": {"method": "sha512", "value": SHA512}},
+        "links": [
+            {"rel": "canonical", "href": "https://a/1", "length": 10},
+            {"rel": "update", "href": "https://a/2"}]}}
+    parsed = parse_job(job)
+    assert parsed["download_url"] == "https://a/2"
+    assert parsed["overwrite"]
+    assert parsed["expected_length"] is None
+    assert parsed["hash_method"] == "sha512"
+
+
+@pytest.fixture
+def stalled_server():
+    # sends the headers, then stalls before the body
+    release = threading.Event()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(DATA)))
+            self.end_headers()
+            self.wfile.flush()
+            release.wait(5)
+            self.wfile.write(DATA)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/file.bufr"
+    release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def test_stream_download_times_out(tmp_path, stalled_server):
+    pool = urllib3.PoolManager(retries=False)
+    with pytest.raises(urllib3.exceptions.ReadTimeoutError):
+        with writer(tmp_path) as download:
+            stream_download(pool, stalled_server, download, timeout=0.2)
+    assert files(tmp_path) == []
@@ -0,0 +1,175 @@
+import csv
+import datetime as dt
+from io import StringIO
+import time
+
+import pytest
+from sqlalchemy import select
+
+from task_manager import downloadlog
+from task_manager.downloadlog import COLUMNS, DownloadLogWriter
+from task_manager.schema import DownloadLog
+
+
+def result(n, **values):
+    result = {
+        'broker': "globalbroker.meteo.fr",
+        'message_id': f"m{n}",
+        'data_id': f"wis2/synop/{n}",
+        'metadata_id': None,
+        'received': "2024-01-01 00:00:00",
+        'queued': "2024-01-01 00:00:01",
+        'status': "SUCCESS",
+        'cache': "cache-a.example.org",
+        'filename': f"ds/2024/01/01/{n}.bufr",
+        'save': True,
+        'valid_hash': True,
+        'hash_method': "sha512",
+        'expected_hash': "abc=",
+        'hash_value': "abc=",
+        'expected_length': 100,
+        'filesize': 100,
+        'download_start': "2024-01-01 00:00:02",
+        'download_end': "2024-01-01 00:00:03",
+        'dataset': "ds"
+    }
+    result.update(values)
+    return result
+
+
+class FakeCursor():
+    def __init__(self, copies, fail):
+        self.copies = copies
+        self.fail = fail
+
+    def execute(self, sql):
+        pass
+
+    def copy_expert(self, sql, buffer):
+        if self.fail:
+            raise ConnectionError("database unavailable")
+        self.copies.append((sql, buffer.read()))
+
+
+class FakeEngine():
+    # records what would be sent with COPY
+    def __init__(self):
+        self.copies = []
+        self.fail = False
+
+    def raw_connection(self):
+        engine = self
+
+        class Connection():
+            def cursor(self):
+                return FakeCursor(engine.copies, engine.fail)
+
+            def commit(self):
+                pass
+
+            def close(self):
+                pass
+
+        return Connection()
+
+    def rows(self):
+        return [row for sql, data in self.copies
+                for row in csv.reader(StringIO(data))]
+
+
+@pytest.fixture
+def writer():
+    writer = DownloadLogWriter(FakeEngine(), batch_size=100, interval=60)
+    yield writer
+    writer.close()
+
+
+def test_copy_rows(writer):
+    writer.add(result(1, filename='a, "quoted"\nname', metadata_id=None))
+    writer.add({})  # results of jobs without a link are not logged
+    assert writer.flush() == 1
+    (sql, _), = writer.engine.copies
+    assert sql == (f"COPY task_manager.download_log ({', '.join(COLUMNS)}) "
+                   f"FROM STDIN WITH CSV")
+    row, = writer.engine.rows()
+    assert dict(zip(COLUMNS, row)) == dict(
+        result(1, filename='a, "quoted"\nname', metadata_id="",
+               save="True", valid_hash="True", expected_length="100",
+               filesize="100"))
+    assert writer.written == 1
+    assert writer.flush() == 0
+
+
+def test_failed_copy_keeps_the_records(writer):
+    writer.max_pending = 3
+    writer.engine.fail = True
+    for n in range(2):
+        writer.add(result(n))
+    assert writer.flush() == 0
+    for n in range(2, 4):
+        writer.add(result(n))
+    # the oldest records are dropped beyond max_pending
+    assert writer.dropped == 1
+    writer.engine.fail = False
+    assert writer.flush() == 3
+    assert [row[1] for row in writer.engine.rows()] == ["m1", "m2", "m3"]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_full_batch_is_flushed_by_the_thread(writer):
+    writer.batch_size = 2
+    writer.add(result(1))
+    time.sleep(0.05)
+    assert writer.written == 0
+    writer.add(result(2))
+    assert wait_for(lambda: writer.written == 2)
+
+
+def test_interval_flush():
+    writer = DownloadLogWriter(FakeEngine(), batch_size=100, interval=0.05)
+    writer.add(result(1))
+    assert wait_for(lambda: writer.written == 1)
+    writer.close()
+
+
+def test_pending_records_are_written_on_exit(monkeypatch):
+    registered = []
+    monkeypatch.setattr(downloadlog.atexit, "register", registered.append)
+    writer = DownloadLogWriter(FakeEngine(), batch_size=100, interval=60)
+    assert registered == [writer.close]
+    writer.add(result(1))
+    registered[0]()
+    assert writer.written == 1
+    # the background thread stops
+    assert wait_for(lambda: not writer._thread.is_alive())
+    # a second call (e.g. worker shutdown, then atexit) writes nothing
+    writer.close()
+    assert len(writer.engine.copies) == 1
+
+
+def test_copy_into_download_log(engine):
+    writer = DownloadLogWriter(engine, batch_size=100, interval=60)
+    writer.add(result(1, filename='a, "quoted"\nname', metadata_id=None))
+    writer.add(result(2, status="FAIL", save=False, valid_hash=None,
+                      filesize=None, hash_value=None))
+    assert writer.flush() == 2
+    writer.close()
+    with engine.connect() as conn:
+        rows = conn.execute(select(DownloadLog.__table__).order_by(
+            DownloadLog.id)).all()
+    assert [row.message_id for row in rows] == ["m1", "m2"]
+    assert rows[0].filename == 'a, "quoted"\nname'
+    assert rows[0].metadata_id is None
+    assert (rows[0].save, rows[0].valid_hash, rows[0].filesize) == \
+        (True, True, 100)
+    # written as UTC
+    assert rows[0].received == dt.datetime(2024, 1, 1, tzinfo=dt.timezone.utc)
+    assert (rows[1].status, rows[1].save, rows[1].valid_hash,
+            rows[1].filesize, rows[1].hash_value) == \
+        ("FAIL", False, None, None, None)
@@ -0,0 +1,158 @@
+import fakeredis
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from task_manager import ingest
+from task_manager.ingest import IngestWriter, mark_ingested, publish
+from task_manager.ledger import CLAIMED, ContentLedger, INGESTED, STORED
+from task_manager.schema import IngestedFile, LedgerEntry
+
+STREAM = ingest.INGEST_STREAM
+
+
+class Ledger():
+    def __init__(self):
+        self.marked = []
+
+    def mark(self, hash_method, hash_value, state, if_state=None):
+        self.marked.append((hash_value, state, if_state))
+
+
+class Writer(IngestWriter):
+    # records the rows of each transaction instead of writing them, files
+    # named "bad" fail
+    def __init__(self, client, **kwargs):
+        self.Session = None
+        self._client = client
+        self.ledger = kwargs.pop("ledger", None)
+        self.consumer = kwargs.pop("consumer", "c1")
+        self.batch = 100
+        self.interval = 0
+        self.stream = STREAM
+        self._stop = False
+        self.transactions = []
+
+    def _write(self, entries):
+        if any(entry["filename"] == "bad" for id, entry in entries):
+            raise ValueError("bad rows")
+        self.transactions.append([entry["filename"] for id, entry in entries])
+        return sum(len(entry["rows"]) for id, entry in entries)
+
+
+def queue(client, *filenames):
+    for filename in filenames:
+        publish([{"value": 1}, {"value": 2}],
+                {"filename": filename, "hash_method": "sha512",
+                 "expected_hash": f"h-{filename}"}, client)
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis()
+
+
+def test_flush_acknowledges_and_deletes(client):
+    writer = Writer(client, ledger=Ledger())
+    writer.ensure_group()
+    writer.ensure_group()  # already there
+    queue(client, "a", "b")
+    entries = writer.read()
+    assert [entry["filename"] for id, entry in entries] == ["a", "b"]
+    assert writer.flush(entries) == 4
+    assert writer.transactions == [["a", "b"]]
+    assert client.xlen(STREAM) == 0
+    assert client.xpending(STREAM, ingest.INGEST_GROUP)["pending"] == 0
+    assert writer.ledger.marked == [("h-a", INGESTED, STORED),
+                                    ("h-b", INGESTED, STORED)]
+
+
+def test_failed_batch_is_written_one_by_one(client, monkeypatch):
+    monkeypatch.setattr(ingest, "INGEST_WRITER_MAX_DELIVERIES", 2)
+    monkeypatch.setattr(ingest, "INGEST_WRITER_CLAIM_IDLE", 0)
+    writer = Writer(client)
+    writer.ensure_group()
+    queue(client, "a", "bad", "b")
+    assert writer.flush(writer.read()) == 4
+    assert writer.transactions == [["a"], ["b"]]
+    # the bad file is left pending, taken over again and then given up on
+    assert client.xlen(STREAM) == 1
+    entries = writer.read()
+    assert [entry["filename"] for id, entry in entries] == ["bad"]
+    writer.flush(entries)
+    assert client.xlen(STREAM) == 0
+    assert client.xpending(STREAM, ingest.INGEST_GROUP)["pending"] == 0
+    dead = client.xrange(f"{STREAM}:dead")
+    assert len(dead) == 1 and dead[0][1][b"error"] == b"bad rows"
+
+
+def test_entries_of_a_dead_writer_are_taken_over(client, monkeypatch):
+    writer = Writer(client, consumer="c1")
+    writer.ensure_group()
+    queue(client, "a")
+    assert len(writer.read()) == 1  # c1 dies before flushing
+    other = Writer(client, consumer="c2")
+    assert other.read() == []  # not idle long enough
+    monkeypatch.setattr(ingest, "INGEST_WRITER_CLAIM_IDLE", 0)
+    entries = other.read()
+    assert [entry["filename"] for id, entry in entries] == ["a"]
+    other.flush(entries)
+    assert other.transactions == [["a"]]
+    assert client.xlen(STREAM) == 0
+
+
+def test_run_flushes_on_stop(client):
+    writer = Writer(client)
+    queue(client, "a", "b")
+
+    def read(block=None):
+        entries = IngestWriter.read(writer, block=None)
+        writer.stop()
+        return entries
+
+    writer.read = read
+    writer.batch = 1000
+    writer.interval = 60
+    writer.run()
+    assert writer.transactions == [["a", "b"]]
+    assert client.xlen(STREAM) == 0
+
+
+def ingested(engine):
+    with engine.connect() as conn:
+        return sorted(conn.execute(
+            select(IngestedFile.filename)).scalars())
+
+
+def test_mark_ingested_follows_the_transaction(engine):
+    with Session(engine) as session:
+        mark_ingested(session, ["/data/a", "/data/b", "/data/a", None])
+        session.rollback()
+    assert ingested(engine) == []
+    with Session(engine) as session:
+        mark_ingested(session, ["/data/a", "/data/b"])
+        session.commit()
+        # ingested again
+        mark_ingested(session, ["/data/a"])
+        session.commit()
+    assert ingested(engine) == ["/data/a", "/data/b"]
+
+
+def test_dead_lettered_file_stays_stored(engine, client, monkeypatch):
+    monkeypatch.setattr(ingest, "INGEST_WRITER_MAX_DELIVERIES", 1)
+    ledger = ContentLedger(engine)
+    for filename in ("a", "bad"):
+        # as the fused download path leaves files queued for the writer
+        ledger.claim("sha512", f"h-{filename}", filename=filename)
+        ledger.mark("sha512", f"h-{filename}", STORED, filename,
+                    if_state=CLAIMED)
+    writer = Writer(client, ledger=ledger)
+    writer.ensure_group()
+    queue(client, "a", "bad")
+    writer.flush(writer.read())
+    assert len(client.xrange(f"{STREAM}:dead")) == 1
+    with engine.connect() as conn:
+        states = dict(conn.execute(
+            select(LedgerEntry.hash_value, LedgerEntry.state)).all())
+    # copies of the bad file are still duplicates, but not ingested ones
+    assert states == {"h-a": INGESTED, "h-bad": STORED}
@@ -0,0 +1,111 @@
+from sqlalchemy import select, text
+
+from task_manager.ledger import (CLAIMED, ContentLedger, INGESTED, STORED)
+from task_manager.schema import LedgerEntry
+
+
+def entries(engine):
+    with engine.connect() as conn:
+        return {row.hash_value: (row.state, row.filename) for row in
+                conn.execute(select(LedgerEntry))}
+
+
+def age(engine, hash_value, seconds):
+    with engine.begin() as conn:
+        conn.execute(text(
+            "UPDATE task_manager.content_ledger SET updated = now() - "
+            "make_interval(secs => :seconds) WHERE hash_value = :hash"),
+            {"seconds": seconds, "hash": hash_value})
+
+
+def test_claim_is_exclusive(engine):
+    ledger = ContentLedger(engine)
+    assert ledger.claim("sha512", "h1", "d1", "f1")
+    assert not ledger.claim("sha512", "h1", "d2", "f2")
+    assert entries(engine) == {"h1": (CLAIMED, "f1")}
+
+
+def test_stale_claim_is_taken_over(engine):
+    ledger = ContentLedger(engine, claim_timeout=60)
+    assert ledger.claim("sha512", "h1", "d1", "f1")
+    age(engine, "h1", 120)
+    assert ledger.claim("sha512", "h1", "d2", "f2")
+    assert entries(engine) == {"h1": (CLAIMED, "f2")}
+
+
+def test_release_only_drops_claims(engine):
+    ledger = ContentLedger(engine)
+    ledger.claim("sha512", "h1")
+    ledger.claim("sha512", "h2")
+    ledger.mark("sha512", "h2", STORED, "/data/a/f2")
+    ledger.release("sha512", "h1")
+    ledger.release("sha512", "h2")
+    assert entries(engine) == {"h2": (STORED, "/data/a/f2")}
+    assert not ledger.claim("sha512", "h2")
+
+
+def test_mark_if_state(engine):
+    ledger = ContentLedger(engine)
+    ledger.claim("sha512", "h1", filename="f1")
+    ledger.mark("sha512", "h1", STORED, "/data/a/f1", if_state=CLAIMED)
+    ledger.mark("sha512", "h1", INGESTED, if_state=STORED)
+    # archived after it was ingested, stays INGESTED
+    ledger.mark("sha512", "h1", STORED, "/data/b/f1", if_state=CLAIMED)
+    assert entries(engine) == {"h1": (INGESTED, "/data/a/f1")}
+
+
+def test_forget_files_and_directories(engine):
+    ledger = ContentLedger(engine)
+    for name, filename in (("h1", "/data/a/2024/01/01/f1"),
+                           ("h2", "/data/a/2024/01/01/f2"),
+                           ("h3", "/data/a/2024/01/02/f3"),
+                           ("h4", "/data/a/2024/01/010/f4"),
+                           ("h5", "/data/a_b/f5")):
+        ledger.claim("sha512", name)
+        ledger.mark("sha512", name, STORED, filename)
+    assert ledger.forget(directory="/data/a/2024/01/01") == 2
+    assert ledger.forget(["/data/a/2024/01/02/f3"]) == 1
+    # LIKE wildcards in the path are literal
+    assert ledger.forget(directory="/data/a%") == 0
+    assert ledger.forget(directory="/data/a_") == 0
+    assert sorted(entries(engine)) == ["h4", "h5"]
+    # the content can be downloaded again
+    assert ledger.claim("sha512", "h1")
+
+
+def test_expire(engine):
+    ledger = ContentLedger(engine, claim_timeout=60, stored_ttl_days=1,
+                           ingested_ttl_days=0)
+    for name, state in (("h1", CLAIMED), ("h2", STORED), ("h3", STORED),
+                        ("h4", INGESTED)):
+        ledger.claim("sha512", name)
+        if state != CLAIMED:
+            ledger.mark("sha512", name, state)
+    age(engine, "h1", 120)
+    age(engine, "h2", 2 * 86400)
+    age(engine, "h4", 365 * 86400)
+    assert ledger.expire() == 2
+    assert sorted(entries(engine)) == ["h3", "h4"]
+
+
+def test_claim_many(engine):
+    ledger = ContentLedger(engine)
+    ledger.claim("sha512", "h2")
+    assert ledger.claim_many([("sha512", "h1", "d1", "f1"),
+                              ("sha512", "h2", "d2", "f2"),
+                              ("sha512", "h1", "d3", "f3"),
+                              ("sha512", "h3", "d4", "f4")]) == \
+        [True, False, False, True]
+    assert entries(engine) == {"h1": (CLAIMED, "f1"), "h2": (CLAIMED, None),
+                               "h3": (CLAIMED, "f4")}
+    assert ledger.claim_many([]) == []
+
+
+def test_claim_many_takes_over_stale_claims(engine):
+    ledger = ContentLedger(engine, claim_timeout=60)
+    ledger.claim_many([("sha512", "h1", "d1", "f1"),
+                       ("sha512", "h2", "d2", "f2")])
+    age(engine, "h1", 120)
+    assert ledger.claim_many([("sha512", "h1", "d3", "f3"),
+                              ("sha512", "h2", "d4", "f4")]) == [True, False]
+    assert entries(engine) == {"h1": (CLAIMED, "f3"), "h2": (CLAIMED, "f2")}
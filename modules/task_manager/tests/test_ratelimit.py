@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from task_manager.ratelimit import HostRateLimiter, RateLimited
+
+
+def test_burst_then_wait(redis_client):
+    limiter = HostRateLimiter(rate=10, burst=3, max_wait=1, limits={})
+    assert [limiter.reserve("a.example") for _ in range(3)] == [0, 0, 0]
+    # the bucket is empty, each further request queues behind the last
+    first = limiter.reserve("a.example")
+    second = limiter.reserve("a.example")
+    assert 0 < first <= 0.1
+    assert first < second <= 0.2
+    # other hosts have their own bucket
+    assert limiter.reserve("b.example") == 0
+
+
+def test_max_wait(redis_client):
+    limiter = HostRateLimiter(rate=1, burst=1, max_wait=0.5, limits={})
+    assert limiter.reserve("a.example") == 0
+    with pytest.raises(RateLimited):
+        limiter.reserve("a.example")
+
+
+def test_host_limits(redis_client):
+    limiter = HostRateLimiter(rate=1, burst=1, max_wait=0, limits={
+        "a.example": {"rate": 100, "burst": 5, "connections": 4}})
+    assert [limiter.reserve("a.example") for _ in range(5)] == [0] * 5
+    assert limiter.connections("a.example") == 4
+    assert limiter.connections("b.example") is None
+    # a zero rate disables the limiter
+    assert HostRateLimiter(rate=0, limits={}).reserve("a.example") == 0
+
+
+def test_backoff(redis_client):
+    limiter = HostRateLimiter(rate=10, burst=10, max_wait=60, limits={})
+    limiter.backoff("a.example", 30)
+    assert 29 < limiter.reserve("a.example") <= 30
+    with pytest.raises(RateLimited):
+        HostRateLimiter(rate=10, burst=10, max_wait=10,
+                        limits={}).reserve("a.example")
+
+
+def test_redis_unavailable():
+    class Broken():
+        def register_script(self, script):
+            raise ConnectionError("down")
+
+    limiter = HostRateLimiter(client=Broken(), limits={})
+    assert limiter.reserve("a.example") == 0
+
+
+def test_acquire_async(redis_client):
+    limiter = HostRateLimiter(rate=50, burst=1, max_wait=1, limits={})
+
+    async def acquire():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.gather(limiter.acquire_async("a.example"),
+                             limiter.acquire_async("a.example"))
+        return loop.time() - start
+
+    assert asyncio.run(acquire()) >= 0.015
@@ -0,0 +1,105 @@
+import datetime as dt
+import os
+
+from sqlalchemy import insert, select
+
+from task_manager.ledger import ContentLedger, STORED
+from task_manager.retention import last_report, RetentionEngine
+from task_manager.schema import DownloadLog, IngestedFile
+
+
+def write(path, size=10):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+    return path
+
+
+def day_path(root, dataset, date, name):
+    return root / dataset / f"{date:%Y/%m/%d}" / name
+
+
+def test_max_age(tmp_path, redis_client):
+    today = dt.date.today()
+    old = write(day_path(tmp_path, "synop", today - dt.timedelta(days=5),
+                         "a.bufr"))
+    kept = write(day_path(tmp_path, "synop", today - dt.timedelta(days=2),
+                          "b.bufr"))
+    engine = RetentionEngine(tmp_path, policies={
+        "default": {"max_age_days": 3}}, min_free_percent=0)
+    report = engine.run()
+    assert not old.exists()
+    assert kept.exists()
+    assert report["datasets"]["synop"]["max_age"] == {"files": 1,
+                                                      "bytes": 10}
+    assert last_report(redis_client)["files"] == 1
+
+
+def test_max_bytes_keeps_the_current_day(tmp_path, redis_client):
+    today = dt.date.today()
+    for days in (2, 1, 0):
+        write(day_path(tmp_path, "synop", today - dt.timedelta(days=days),
+                       "a.bufr"), 100)
+    engine = RetentionEngine(tmp_path, policies={
+        "default": {"max_bytes": 150}}, min_free_percent=0)
+    report = engine.run()
+    assert report["datasets"]["synop"]["max_bytes"]["files"] == 2
+    assert [path.name for path in (tmp_path / "synop").rglob("*.bufr")] == \
+        ["a.bufr"]
+
+
+def test_evicted_days_are_forgotten_by_the_ledger(tmp_path, engine,
+                                                  redis_client):
+    today = dt.date.today()
+    old = write(day_path(tmp_path, "synop", today - dt.timedelta(days=5),
+                         "a.bufr"))
+    kept = write(day_path(tmp_path, "synop", today, "b.bufr"))
+    ledger = ContentLedger(engine)
+    for hash_value, path in (("h1", old), ("h2", kept)):
+        ledger.claim("sha512", hash_value)
+        ledger.mark("sha512", hash_value, STORED, str(path))
+    RetentionEngine(tmp_path, engine, policies={
+        "default": {"max_age_days": 3}}, ledger=ledger,
+        min_free_percent=0).run()
+    assert ledger.claim("sha512", "h1")
+    assert not ledger.claim("sha512", "h2")
+
+
+def test_keep_only_ingested(tmp_path, engine, redis_client):
+    today = dt.date.today()
+    paths = {name: write(day_path(tmp_path, "synop", today, name))
+             for name in ("ingested", "not_ingested", "unknown", "failed",
+                          "recent")}
+    old = dt.datetime.now().timestamp() - 48 * 3600
+    for name, path in paths.items():
+        if name != "recent":
+            os.utime(path, (old, old))
+    with engine.begin() as conn:
+        conn.execute(insert(DownloadLog), [
+            {"filename": str(paths[name]), "status": status}
+            for name, status in (("ingested", "SUCCESS"),
+                                 ("not_ingested", "SUCCESS"),
+                                 ("failed", "FAIL"),
+                                 ("recent", "SUCCESS"))])
+        conn.execute(insert(IngestedFile),
+                     [{"filename": str(paths["ingested"])}])
+    report = RetentionEngine(tmp_path, engine, policies={
+        "default": {"keep_only_ingested": True,
+                    "ingest_grace_hours": 24}}, min_free_percent=0).run()
+    assert sorted(name for name, path in paths.items() if path.exists()) == \
+        ["failed", "ingested", "recent", "unknown"]
+    assert report["datasets"]["synop"]["not_ingested"]["files"] == 1
+
+
+def test_evicted_days_drop_ingest_records(tmp_path, engine, redis_client):
+    today = dt.date.today()
+    old = write(day_path(tmp_path, "synop", today - dt.timedelta(days=5),
+                         "a.bufr"))
+    kept = write(day_path(tmp_path, "synop", today, "b.bufr"))
+    with engine.begin() as conn:
+        conn.execute(insert(IngestedFile), [{"filename": str(old)},
+                                            {"filename": str(kept)}])
+    RetentionEngine(tmp_path, engine, policies={
+        "default": {"max_age_days": 3}}, min_free_percent=0).run()
+    with engine.connect() as conn:
+        assert conn.execute(select(IngestedFile.filename)).scalars().all() \
+            == [str(kept)]
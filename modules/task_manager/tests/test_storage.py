@@ -0,0 +1,144 @@
+import base64
+import hashlib
+
+import boto3
+import pytest
+
+from task_manager.download import DownloadError
+from task_manager.storage import S3Storage
+from task_manager.store import ContentStore
+
+moto = pytest.importorskip("moto")
+
+PART_SIZE = 5 * 1024 * 1024
+LARGE = b"BUFR" + b"x" * PART_SIZE + b"7777"
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(name, "testing")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        yield S3Storage("wis2-test", part_size=PART_SIZE, client=client)
+
+
+def keys(storage):
+    response = storage.client.list_objects_v2(Bucket=storage.bucket)
+    return sorted(item["Key"] for item in response.get("Contents", []))
+
+
+def uploads(storage):
+    return storage.client.list_multipart_uploads(
+        Bucket=storage.bucket).get("Uploads", [])
+
+
+def test_small_upload_is_a_single_put(storage):
+    upload = storage.upload("ds/a.bufr")
+    upload.write(b"BUFR")
+    upload.write(b"7777")
+    assert keys(storage) == []
+    upload.complete()
+    assert storage.read("ds/a.bufr") == b"BUFR7777"
+    assert uploads(storage) == []
+
+
+def test_multipart_upload_completes_at_its_key(storage):
+    upload = storage.upload("ds/a.bufr")
+    upload.write(LARGE[:PART_SIZE])
+    assert len(uploads(storage)) == 1
+    upload.write(LARGE[PART_SIZE:])
+    upload.complete()
+    assert keys(storage) == ["ds/a.bufr"]
+    assert storage.read("ds/a.bufr") == LARGE
+    assert uploads(storage) == []
+
+
+def test_multipart_upload_moved_to_another_key(storage):
+    upload = storage.upload("objects/staged.bufr")
+    upload.write(LARGE)
+    upload.complete("objects/sha512/ab/cd/abcd")
+    assert keys(storage) == ["objects/sha512/ab/cd/abcd"]
+    assert storage.read("objects/sha512/ab/cd/abcd") == LARGE
+
+
+def test_failed_move_removes_the_staged_object(storage, monkeypatch):
+    upload = storage.upload("objects/staged.bufr")
+    upload.write(LARGE)
+
+    def copy(*args, **kwargs):
+        raise ConnectionError("lost connection")
+
+    monkeypatch.setattr(storage.client, "copy", copy)
+    with pytest.raises(ConnectionError):
+        upload.complete("objects/sha512/ab/cd/abcd")
+    assert keys(storage) == []
+    assert uploads(storage) == []
+
+
+def test_failed_completion_is_aborted(storage, monkeypatch):
+    upload = storage.upload("ds/a.bufr")
+    upload.write(LARGE)
+
+    def complete(**kwargs):
+        raise ConnectionError("lost connection")
+
+    monkeypatch.setattr(storage.client, "complete_multipart_upload", complete)
+    with pytest.raises(ConnectionError):
+        upload.complete()
+    # as DownloadWriter.commit does when completing fails
+    upload.abort()
+    assert keys(storage) == []
+    assert uploads(storage) == []
+
+
+def test_abort_discards_parts(storage):
+    upload = storage.upload("ds/a.bufr")
+    upload.write(LARGE)
+    upload.abort()
+    assert uploads(storage) == []
+    assert keys(storage) == []
+
+
+def test_store_uploads_straight_to_the_object(storage, tmp_path, monkeypatch):
+    store = ContentStore(tmp_path, None, storage)
+    digest = hashlib.sha512(LARGE).digest()
+    writer = store.writer("a.bufr", "sha512",
+                          base64.b64encode(digest).decode(), len(LARGE))
+    key = store.object_key("sha512", digest.hex())
+    assert writer.output_path == key
+
+    def copy(*args, **kwargs):
+        raise AssertionError("object copied")
+
+    monkeypatch.setattr(storage.client, "copy", copy)
+    with writer:
+        writer.write(LARGE)
+        writer.commit(key)
+    assert keys(storage) == [key]
+
+
+def test_store_without_hash_moves_the_object(storage, tmp_path):
+    store = ContentStore(tmp_path, None, storage)
+    writer = store.writer("a.bufr")
+    assert writer.output_path.startswith("objects/")
+    assert writer.output_path.endswith(".a.bufr")
+    with writer:
+        writer.write(LARGE)
+        key = store.object_key(writer.hash_method, writer.hexdigest)
+        writer.commit(key)
+    assert keys(storage) == [key]
+    assert storage.read(key) == LARGE
+
+
+def test_mismatched_content_is_not_stored(storage, tmp_path):
+    store = ContentStore(tmp_path, None, storage)
+    digest = hashlib.sha512(b"other").digest()
+    writer = store.writer("a.bufr", "sha512",
+                          base64.b64encode(digest).decode())
+    with pytest.raises(DownloadError):
+        with writer:
+            writer.write(LARGE)
+            writer.commit()
+    assert keys(storage) == []
+    assert uploads(storage) == []
@@ -0,0 +1,87 @@
+import base64
+import hashlib
+
+import pytest
+from sqlalchemy import select, text
+
+from task_manager.retention import RetentionEngine
+from task_manager.schema import DownloadIndex
+from task_manager.storage import LocalStorage
+from task_manager.store import ContentStore, lock_object
+
+DATA = b"BUFR" + b"x" * 100 + b"7777"
+SHA512 = base64.b64encode(hashlib.sha512(DATA).digest()).decode()
+
+
+@pytest.fixture
+def store(tmp_path, engine):
+    return ContentStore(tmp_path, engine, LocalStorage(tmp_path))
+
+
+def download(store, filename="a.bufr"):
+    writer = store.writer(filename, "sha512", SHA512, len(DATA))
+    writer.write(DATA)
+    return writer
+
+
+def index(engine):
+    with engine.connect() as conn:
+        return conn.execute(select(DownloadIndex.dataset,
+                                   DownloadIndex.filename)).all()
+
+
+def test_commit_indexes_the_object(store, engine):
+    path = store.commit(download(store), "synop", "d1", "a.bufr")
+    assert path == store.object_path("sha512",
+                                     hashlib.sha512(DATA).hexdigest())
+    assert store.lookup("sha512", SHA512) is not None
+    # the same bytes for another dataset share the object
+    assert store.commit(download(store, "b.bufr"), "temp", "d2",
+                        "b.bufr") == path
+    assert sorted(index(engine)) == [("synop", "a.bufr"),
+                                     ("temp", "b.bufr")]
+    assert store.indexed("temp", "d2", "b.bufr") == path
+
+
+def test_index_of_a_deleted_object_fails(store, engine):
+    path = store.commit(download(store))
+    store.storage.delete(store.lookup("sha512", SHA512))
+    with pytest.raises(FileNotFoundError):
+        store.index("synop", "d1", "a.bufr", path, len(DATA))
+    assert index(engine) == []
+
+
+def test_index_waits_for_retention(store, engine):
+    path = store.commit(download(store))
+    key = store.lookup("sha512", SHA512)
+    with engine.begin() as conn:
+        lock_object(conn, key, shared=False)
+        conn.execute(text("SET LOCAL lock_timeout = '100ms'"))
+        with pytest.raises(Exception, match="lock timeout"):
+            with engine.begin() as other:
+                other.execute(text("SET LOCAL lock_timeout = '100ms'"))
+                lock_object(other, key)
+    store.index("synop", "d1", "a.bufr", path, len(DATA))
+    assert index(engine) == [("synop", "a.bufr")]
+
+
+def test_retention_deletes_unreferenced_objects(store, engine, tmp_path,
+                                                redis_client):
+    store.commit(download(store), "synop", "d1", "a.bufr")
+    store.commit(download(store, "b.bufr"), "temp", "d2", "b.bufr")
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE task_manager.download_index SET stored = "
+                          "now() - interval '10 days'"))
+    retention = RetentionEngine(tmp_path, engine, store, store.storage,
+                                policies={"default": {},
+                                          "synop": {"max_age_days": 3}},
+                                min_free_percent=0)
+    retention.run()
+    # still referenced by temp
+    assert index(engine) == [("temp", "b.bufr")]
+    assert store.lookup("sha512", SHA512) is not None
+    retention.policies["temp"] = {"max_age_days": 3}
+    report = retention.run()
+    assert index(engine) == []
+    assert store.lookup("sha512", SHA512) is None
+    assert report["datasets"]["temp"]["max_age"]["files"] == 1
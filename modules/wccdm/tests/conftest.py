@@ -0,0 +1,35 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from wccdm.schema import CodeTable, Host, Units
+from wccdm.utils import cache
+
+# a scratch PostgreSQL database, e.g.
+# postgresql+psycopg2://postgres@localhost/test. Its wccdm schema is dropped
+# and created again with the lookup tables only, tests needing the database
+# are skipped if this is not set.
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+def engine():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL not set")
+    engine = create_engine(TEST_DATABASE_URL)
+    with engine.begin() as conn:
+        conn.execute(text("DROP SCHEMA IF EXISTS wccdm CASCADE"))
+        conn.execute(text("CREATE SCHEMA wccdm"))
+    for table_class in (CodeTable, Host, Units):
+        table_class.__table__.create(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(autouse=True)
+def caches(monkeypatch):
+    # a fresh set of per process URI caches, not shared through Redis
+    monkeypatch.setattr(cache, "_caches", {})
+    monkeypatch.setattr(cache, "_client", None)
+    monkeypatch.setattr(cache, "URI_CACHE_REDIS", None)
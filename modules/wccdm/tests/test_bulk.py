@@ -0,0 +1,156 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+
+from wccdm.schema import (Base, Dataset, Host, Observation, ObservationType,
+                          ObservedProperty, Observer, ObservingProcedure,
+                          QualityFlag, ReportIdentifier, ReportType)
+from wccdm.utils.bulk import _copy, _copy_value, write_observations
+
+AWKWARD = "tab\there\nnew line\r\\N back\\slash \\t"
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, "\\N"),
+    ("plain", "plain"),
+    ("a\tb", "a\\tb"),
+    ("a\nb\rc", "a\\nb\\rc"),
+    ("a\\b", "a\\\\b"),
+    ("\\N", "\\\\N"),
+    (True, "t"),
+    (False, "f"),
+    (0, "0"),
+    (1.5, "1.5"),
+    (datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.UTC),
+     "2024-01-02T03:04:05+00:00"),
+    (datetime.date(2024, 1, 2), "2024-01-02"),
+    ({"a": "b\tc"}, '{"a": "b\\\\tc"}'),
+    ([1, None], "[1, null]"),
+])
+def test_copy_value(value, expected):
+    assert _copy_value(value) == expected
+
+
+def test_copy_round_trip(engine):
+    rows = [[1, AWKWARD, {"label": AWKWARD, "values": [1, None]}, True,
+             datetime.datetime(2024, 1, 2, 3, 4, 5,
+                               tzinfo=datetime.UTC)],
+            [2, None, None, False, None],
+            [3, "", [], None, datetime.date(2024, 1, 2)]]
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        cursor.execute("CREATE TEMPORARY TABLE copied (id int, text text, "
+                       "data jsonb, flag boolean, time timestamptz) "
+                       "ON COMMIT DROP")
+        _copy(cursor, SimpleNamespace(schema="pg_temp", name="copied"),
+              ["id", "text", "data", "flag", "time"], rows)
+        # nothing to copy
+        _copy(cursor, SimpleNamespace(schema="pg_temp", name="copied"),
+              ["id"], [])
+        cursor.execute("SET LOCAL TIME ZONE 'UTC'")
+        cursor.execute("SELECT * FROM copied ORDER BY id")
+        copied = cursor.fetchall()
+    assert copied == [
+        (1, AWKWARD, {"label": AWKWARD, "values": [1, None]}, True,
+         datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.UTC)),
+        (2, None, None, False, None),
+        (3, "", [], None,
+         datetime.datetime(2024, 1, 2, tzinfo=datetime.UTC))]
+
+
+DAY = datetime.datetime(2024, 1, 2, tzinfo=datetime.UTC)
+LOOKUPS = (Host, Observer, ObservationType, ObservedProperty,
+           ObservingProcedure, ReportType, ReportIdentifier, Dataset)
+
+
+@pytest.fixture
+def observations(engine):
+    # wccdm.observation as initialise_wccdm sets it up, with one daily table
+    with engine.begin() as conn:
+        if conn.execute(text("SELECT 1 FROM pg_available_extensions "
+                             "WHERE name = 'postgis'")).first() is None:
+            pytest.skip("PostGIS not available")
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS postgis"))
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE wccdm.observation_20240102 (
+                CHECK (phenomenon_time_end >= '2024-01-02 00:00+0'
+                       AND phenomenon_time_end < '2024-01-03 00:00+0')
+            ) INHERITS (wccdm.observation)"""))
+        conn.execute(text("""
+            CREATE FUNCTION wccdm.observation_insert_trigger()
+            RETURNS TRIGGER AS $$
+            BEGIN
+            IF (NEW.phenomenon_time_end >= '2024-01-02 00:00+0'
+                AND NEW.phenomenon_time_end < '2024-01-03 00:00+0') THEN
+                INSERT INTO wccdm.observation_20240102 VALUES (NEW.*);
+            ELSE
+                RAISE EXCEPTION 'Date out of range';
+            END IF;
+            RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql"""))
+        conn.execute(text("""
+            CREATE TRIGGER insert_observation
+            BEFORE INSERT ON wccdm.observation
+            FOR EACH ROW EXECUTE PROCEDURE
+            wccdm.observation_insert_trigger()"""))
+        for table_class in LOOKUPS:
+            values = {"id": 1, "uri": f"urn:{table_class.__tablename__}"}
+            if "preferred_label" in table_class.__table__.columns:
+                values["preferred_label"] = table_class.__tablename__
+            conn.execute(table_class.__table__.insert().values(**values))
+    return engine
+
+
+def observation(n, **values):
+    observation = {
+        "location": "SRID=4326;POINT(10 50)", "host": 1,
+        "observation_type": 1, "observed_property": 1,
+        "observing_procedure": 1, "report_type": 1, "report_identifier": 1,
+        "is_member_of": 1, "phenomenon_time_start": DAY,
+        "phenomenon_time_end": DAY, "result_time": DAY, "result_value": n}
+    observation.update(values)
+    return observation
+
+
+def test_write_observations_to_daily_tables(observations):
+    with Session(observations) as session:
+        written = write_observations(session, [
+            observation(1, result_quality=[
+                {"scheme": "s", "flag": "f", "value": "good"}],
+                feature_of_interest=[
+                    {"uri": "urn:a", "label": "a", "relation": "host"}]),
+            observation(2, result_quality=[
+                QualityFlag(scheme="s", flag="f", value="bad")])])
+        session.commit()
+    assert written == 2
+    with observations.connect() as conn:
+        assert conn.execute(text(
+            "SELECT count(*) FROM ONLY wccdm.observation")).scalar() == 0
+        assert conn.execute(text(
+            "SELECT count(*) FROM wccdm.observation_20240102")).scalar() == 2
+        flags = conn.execute(text(
+            "SELECT o.result_value, q.value FROM wccdm.quality_flag q "
+            "JOIN wccdm.observation o ON o.id = q.observation_id "
+            "ORDER BY o.result_value")).all()
+        features = conn.execute(text(
+            "SELECT o.result_value, f.uri FROM wccdm.feature f "
+            "JOIN wccdm.observation o ON o.id = f.observation_id")).all()
+    assert [tuple(row) for row in flags] == [(1, "good"), (2, "bad")]
+    assert [tuple(row) for row in features] == [(1, "urn:a")]
+
+
+def test_orm_insert_to_daily_tables(observations):
+    with Session(observations) as session:
+        session.add(Observation(**observation(
+            3, result_quality=[QualityFlag(scheme="s", flag="f",
+                                           value="good")])))
+        session.commit()
+    with Session(observations) as session:
+        stored = session.scalars(select(Observation)).one()
+        assert [flag.value for flag in stored.result_quality] == ["good"]
@@ -0,0 +1,90 @@
+import fakeredis
+import redis
+from sqlalchemy.orm import Session
+
+from wccdm.schema import ReportIdentifier, Units
+from wccdm.utils import cache
+from wccdm.utils.cache import get_cache, URICache
+
+
+def test_lru():
+    uris = URICache("wccdm.units", size=2)
+    uris.set_many({"a": 1, "b": 2})
+    assert uris.get_many(["a"]) == {"a": 1}  # b is now least recently used
+    uris.set_many({"c": 3})
+    assert uris.get_many(["a", "b", "c"]) == {"a": 1, "c": 3}
+    assert uris.stats() == {"entries": 2, "hits": 3, "shared_hits": 0,
+                            "misses": 1, "errors": 0}
+
+
+def test_compact_keys():
+    uris = URICache("wccdm.report_identifier", compact=True,
+                    client=fakeredis.FakeRedis())
+    uri = "urn:x-wmo:report:" + "x" * 200
+    uris.set_many({uri: 1})
+    assert uris.get_many([uri, "other"]) == {uri: 1}
+    assert all(len(key) == 16 for key in uris._entries)
+    assert uris.client is None  # not shared
+
+
+def test_shared_between_processes():
+    client = fakeredis.FakeRedis()
+    first = URICache("wccdm.units", client=client, generation=1, ttl=60)
+    first.set_many({"a": 1, "b": 2})
+    assert 0 < client.ttl(first.key) <= 60
+    second = URICache("wccdm.units", client=client, generation=1)
+    assert second.get_many(["a", "c"]) == {"a": 1}
+    assert second.stats()["shared_hits"] == 1
+    assert second.get_many(["a"]) == {"a": 1}  # now from the LRU
+    assert second.stats()["shared_hits"] == 1
+    # a recreated table has a new generation and its own ids
+    third = URICache("wccdm.units", client=client, generation=2)
+    assert third.get_many(["a"]) == {}
+
+
+def test_shared_size_bound():
+    client = fakeredis.FakeRedis()
+    uris = URICache("wccdm.units", client=client, generation=1,
+                    shared_size=3)
+    uris.set_many({"a": 1, "b": 2, "c": 3})
+    assert client.hlen(uris.key) == 3
+    uris.set_many({"d": 4})
+    assert not client.exists(uris.key)
+    # still cached in the process
+    assert uris.get_many(["d"]) == {"d": 4}
+
+
+def test_redis_errors_are_not_retried_at_once(monkeypatch):
+    class Broken():
+        calls = 0
+
+        def hmget(self, key, uris):
+            Broken.calls += 1
+            raise redis.ConnectionError("down")
+
+    uris = URICache("wccdm.units", client=Broken(), generation=1)
+    assert uris.get_many(["a"]) == {}
+    assert uris.get_many(["a"]) == {}
+    uris.set_many({"a": 1})
+    assert Broken.calls == 1
+    assert uris.stats()["errors"] == 1
+    monkeypatch.setattr(cache, "URI_CACHE_RETRY", 0)
+    uris._retry = 0
+    assert uris.get_many(["b"]) == {}
+    assert Broken.calls == 2
+
+
+def test_get_cache_generation(engine, monkeypatch):
+    monkeypatch.setattr(cache, "_client", fakeredis.FakeRedis())
+    assert get_cache(Units.__table__).client is None  # no session
+    monkeypatch.setattr(cache, "_caches", {})
+    with Session(engine) as session:
+        units = get_cache(Units.__table__, session)
+        assert units.client is not None
+        assert get_cache(Units.__table__, session) is units
+        assert get_cache(ReportIdentifier.__table__, session).compact
+    Units.__table__.drop(engine)
+    Units.__table__.create(engine)
+    monkeypatch.setattr(cache, "_caches", {})
+    with Session(engine) as session:
+        assert get_cache(Units.__table__, session).key != units.key
@@ -0,0 +1,62 @@
+import pytest
+from sqlalchemy import select
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.orm import Session
+
+from wccdm.schema import Dataset, Host, Units
+from wccdm.utils import fetch_uri_id, fetch_uri_ids
+from wccdm.utils.cache import get_cache
+
+
+def rows(engine, table_class):
+    with engine.connect() as conn:
+        return {row.uri: row.id for row in conn.execute(
+            select(table_class.uri, table_class.id))}
+
+
+def test_adds_missing_uris(engine):
+    with Session(engine) as session:
+        ids = fetch_uri_ids(Units, ["K", "hPa", None, "K"], session)
+        assert sorted(ids) == ["K", "hPa"]
+        assert len(set(ids.values())) == 2
+        # already there
+        more = fetch_uri_ids(Units, ["hPa", "m"], session, use_cache=False)
+        assert more["hPa"] == ids["hPa"]
+        assert more["m"] not in ids.values()
+        assert fetch_uri_ids(Units, [], session) == {}
+        assert fetch_uri_ids(Units, [None], session) == {}
+        assert fetch_uri_id(Units, "K", session) == ids["K"]
+    assert rows(engine, Units) == dict(ids, m=more["m"])
+
+
+def test_finds_uris_added_elsewhere(engine):
+    with engine.begin() as conn:
+        conn.execute(Host.__table__.insert(), [{"uri": "a"}, {"uri": "b"}])
+    existing = rows(engine, Host)
+    with Session(engine) as session:
+        ids = fetch_uri_ids(Host, ["a", "b", "c"], session)
+    assert ids == rows(engine, Host)
+    assert {uri: ids[uri] for uri in ("a", "b")} == existing
+
+
+def test_cached_ids(engine):
+    with Session(engine) as session:
+        ids = fetch_uri_ids(Units, ["K", "hPa"], session)
+        stats = get_cache(Units.__table__).stats()
+        assert stats["misses"] == 2 and stats["entries"] == 2
+        # served from the cache, even once the rows are gone
+        with engine.begin() as conn:
+            conn.execute(Units.__table__.delete())
+        assert fetch_uri_ids(Units, ["K", "hPa"], session) == ids
+        assert get_cache(Units.__table__).stats()["hits"] == 2
+        # not without it
+        fresh = fetch_uri_ids(Units, ["K"], session, use_cache=False)
+        assert fresh["K"] != ids["K"]
+
+
+def test_failure_rolls_back(engine):
+    with Session(engine) as session:
+        with pytest.raises(ProgrammingError):
+            fetch_uri_ids(Dataset, ["ds"], session)  # no such table
+        # the session is still usable
+        assert fetch_uri_ids(Units, ["K"], session)
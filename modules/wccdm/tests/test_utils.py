@@ -0,0 +1,25 @@
+import wccdm.utils
+from wccdm.schema import Dataset, Host, Units
+from wccdm.utils import resolve_uris
+
+
+def test_resolve_uris(monkeypatch):
+    calls = []
+
+    def fetch_uri_ids(table_class, uris, session, use_cache=True):
+        calls.append((table_class, set(uris)))
+        return {uri: len(uri) for uri in uris}
+
+    monkeypatch.setattr(wccdm.utils, "fetch_uri_ids", fetch_uri_ids)
+    rows = [{"result_units": "K", "host": "UNKNOWN", "is_member_of": "ds",
+             "result_value": "text"},
+            {"result_units": "hPa", "host": 42, "observer": None,
+             "is_member_of": "ds"}]
+    assert resolve_uris(rows, None) is rows
+    assert rows == [{"result_units": 1, "host": 7, "is_member_of": 2,
+                     "result_value": "text"},
+                    {"result_units": 3, "host": 42, "observer": None,
+                     "is_member_of": 2}]
+    # one lookup per table, ids are left alone
+    assert sorted(calls, key=lambda call: call[0].__name__) == [
+        (Dataset, {"ds"}), (Host, {"UNKNOWN"}), (Units, {"K", "hPa"})]
@@ -48,9 +48,11 @@ class Observation(Base):
     result_code_table: Mapped[int] = mapped_column(ForeignKey("wccdm.code_table.id"), nullable=True)
     result_description: Mapped[str] = mapped_column(String, nullable=True)
     feature_of_interest: Mapped[List["Feature"]] = relationship(
+        primaryjoin="Observation.id == foreign(Feature.observation_id)",
         back_populates="observation", cascade="all, delete-orphan"
     )
     result_quality: Mapped[List["QualityFlag"]] = relationship(
+        primaryjoin="Observation.id == foreign(QualityFlag.observation_id)",
         back_populates="observation", cascade="all, delete-orphan"
     )
     __mapper_args__ = {"polymorphic_on": phenomenon_time_end}
@@ -64,8 +66,12 @@ class QualityFlag(Base):
     __tablename__ = "quality_flag"
     __table_args__ = {"schema": "wccdm"}
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
-    observation_id: Mapped[int] = mapped_column(ForeignKey("wccdm.observation.id"), nullable=False)
-    observation: Mapped["Observation"] = relationship(back_populates="result_quality")
+    # no foreign key, observations are stored in the daily tables inheriting
+    # from wccdm.observation and a constraint on the parent never matches them
+    observation_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
+    observation: Mapped["Observation"] = relationship(
+        primaryjoin="foreign(QualityFlag.observation_id) == Observation.id",
+        back_populates="result_quality")
     scheme: Mapped[str] = mapped_column(String, nullable=False)
     flag: Mapped[str] = mapped_column(String, nullable=False)
     value: Mapped[str] = mapped_column(String, nullable=False)
@@ -76,8 +82,12 @@ class Feature(Base):
     __tablename__ = "feature"
     __table_args__ = {"schema": "wccdm"}
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
-    observation_id: Mapped[int] = mapped_column(ForeignKey("wccdm.observation.id"), nullable=False)
-    observation: Mapped["Observation"] = relationship(back_populates="feature_of_interest")
+    # no foreign key, observations are stored in the daily tables inheriting
+    # from wccdm.observation and a constraint on the parent never matches them
+    observation_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
+    observation: Mapped["Observation"] = relationship(
+        primaryjoin="foreign(Feature.observation_id) == Observation.id",
+        back_populates="feature_of_interest")
     uri: Mapped[str] = mapped_column(String, nullable=False)
     label: Mapped[str] = mapped_column(String, nullable=False)
     relation: Mapped[str] = mapped_column(String, nullable=False)
@@ -1,11 +1,10 @@
 from dateutil import parser
-from psycopg2.errors import UniqueViolation
-from sqlalchemy import select, text
-from sqlalchemy.exc import IntegrityError, OperationalError
-import time
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
 
 
 from wccdm.schema import *
+from wccdm.utils.cache import get_cache
 
 from celery.utils.log import get_task_logger
 
@@ -17,93 +16,78 @@ from threading import Lock
 
 LOGGER = get_task_logger(__name__)
 
-_URIs = {}
-def fetch_uri_id(table_class, uri, session, use_cache = True):
+def fetch_uri_ids(table_class, uris, session, use_cache = True):
+    """
+    Ids of the given URIs in a lookup table, as a dict, adding the ones
+    not in it yet. Missing URIs are resolved in one round trip with
+    INSERT ... ON CONFLICT DO NOTHING RETURNING, URIs that already existed
+    (or were added concurrently) with one SELECT after it.
+    """
     table = table_class.__table__
-    schema = table.schema
-    tablename = table.name
-
-    if use_cache:  # first check if uri id cached
-        if table not in _URIs:
-            _URIs[table] = {}
-            uri_id = None
-        else:
-            uri_id = _URIs[table].get(uri)
-        if uri_id is not None:
-            return uri_id
-
-    # ID not cached, first check DB
-    query = select(table_class).where(table_class.uri == uri)
-    result = session.execute(query).fetchall()
-    if not isinstance(result, list):
-        result = [result]
-    assert len(result) <= 1
-
-    # we have result, return (and cache is specified)
-    if len(result) == 1:
-        if use_cache:
-            _URIs[table][uri] = (result[0][0]).id
-        return (result[0][0]).id
-
-
-    # if we have reached here we need to insert new item
-    # First try and acquire lock on DB table
-    max_retries = 10
-    retries = 0
-    while retries < max_retries:
-        try:
-            # get lock on table
-            session.begin_nested()
-            session.execute(text(
-                f"LOCK TABLE {schema}.{tablename} IN SHARE ROW EXCLUSIVE MODE"))
-            session.commit()
-        except OperationalError as e:
-            session.rollback()
-            time.sleep(0.01*retries)
-            retries += 1
-            if retries == max_retries:
-                raise e  # Reraise the exception if max retries reached
-            else:
-                continue  # Retry acquiring the lock
-        else:
-            break  # Lock acquired successfully, exit the loop
-    # check to make sure entry hasn't been created whilst waiting for lock
-    query = select(table_class).where(table_class.uri == uri)
-    result = session.execute(query).fetchall()
-    if not isinstance(result, list):
-        result = [result]
-    assert len(result) <= 1
-    # we have result, return (and cache is specified)
-    if len(result) == 1:
-        if use_cache:
-            _URIs[table][uri] = (result[0][0]).id
-        return (result[0][0]).id
-
-    # now add to table
+    uris = set(uris) - {None}
+    ids = {}
+    if use_cache:  # first check if uri ids cached
+        cache = get_cache(table, session)
+        ids = cache.get_many(list(uris))
+    missing = sorted(uris - set(ids))  # same order in every worker
+    if not missing:
+        return ids
+
+    query = insert(table).values([{"uri": uri} for uri in missing]) \
+        .on_conflict_do_nothing(index_elements=["uri"]) \
+        .returning(table.c.uri, table.c.id)
     try:
-        new_uri = table_class(uri=uri)
-        session.add_all([new_uri])
+        ids.update(session.execute(query).tuples().all())
+        existing = [uri for uri in missing if uri not in ids]
+        if existing:
+            query = select(table.c.uri, table.c.id).where(
+                table.c.uri.in_(existing))
+            ids.update(session.execute(query).tuples().all())
         session.commit()
-    except IntegrityError as e:
+    except Exception as e:
         session.rollback()
-
-        # try one last fetch, error suggests already in DB.
-        query = select(table_class).where(table_class.uri == uri)
-        result = session.execute(query).fetchall()
-        if not isinstance(result, list):
-            result = [result]
-        # we have result, return (and cache is specified)
-        if len(result) == 1:
-            if use_cache:
-                _URIs[table][uri] = (result[0][0]).id
-            return (result[0][0]).id
-        else:
-            LOGGER.error(e)
-            raise e
+        LOGGER.error(e)
+        raise e
 
     if use_cache:
-        _URIs[table][uri] = new_uri.id
-    return new_uri.id
+        cache.set_many({uri: ids[uri] for uri in missing if uri in ids})
+    return ids
+
+
+def fetch_uri_id(table_class, uri, session, use_cache = True):
+    return fetch_uri_ids(table_class, [uri], session, use_cache).get(uri)
+
+
+# observation columns holding the URI of a lookup table entry until the
+# observation is written
+URI_COLUMNS = {
+    "result_units": Units,
+    "result_code_table": CodeTable,
+    "observation_type": ObservationType,
+    "observing_procedure": ObservingProcedure,
+    "host": Host,
+    "observer": Observer,
+    "report_identifier": ReportIdentifier,
+    "is_member_of": Dataset
+}
+
+
+def resolve_uris(observations, session, use_cache = True):
+    """
+    Replaces the URIs in the URI_COLUMNS of the observations (dicts) by
+    their ids, one fetch_uri_ids call per lookup table. Values that are not
+    strings are taken to be ids already.
+    """
+    for column, table_class in URI_COLUMNS.items():
+        uris = {observation.get(column) for observation in observations
+                if isinstance(observation.get(column), str)}
+        if not uris:
+            continue
+        ids = fetch_uri_ids(table_class, uris, session, use_cache)
+        for observation in observations:
+            if isinstance(observation.get(column), str):
+                observation[column] = ids.get(observation[column])
+    return observations
 
 
 def time_parser(timestamp):
@@ -0,0 +1,110 @@
+import datetime
+from io import StringIO
+import json
+
+from celery.utils.log import get_task_logger
+
+from wccdm.schema import Feature, Observation, QualityFlag
+
+LOGGER = get_task_logger(__name__)
+
+# relationships, written to their own tables
+_CHILDREN = ("result_quality", "feature_of_interest")
+_OBSERVATION_COLUMNS = [column.name for column in Observation.__table__.columns]
+# scalar column defaults, applied by the ORM on insert
+_OBSERVATION_DEFAULTS = {column.name: column.default.arg
+                         for column in Observation.__table__.columns
+                         if column.default is not None and
+                         column.default.is_scalar}
+_QUALITY_FLAG_COLUMNS = ["observation_id", "scheme", "flag", "value"]
+_FEATURE_COLUMNS = ["observation_id", "uri", "label", "relation"]
+
+
+def _copy_value(value):
+    # PostgreSQL COPY text format
+    if value is None:
+        return "\\N"
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        value = value.isoformat()
+    elif isinstance(value, bool):
+        value = "t" if value else "f"
+    else:
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t") \
+        .replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _copy(cursor, table, columns, rows):
+    if not rows:
+        return
+    buffer = StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table.schema}.{table.name} "
+                       f"({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def _child(child, key):
+    # QualityFlag / Feature objects or dicts
+    if isinstance(child, dict):
+        return child.get(key)
+    return getattr(child, key)
+
+
+def write_observations(session, observations):
+    """
+    Writes observations, dicts of Observation columns plus result_quality
+    and feature_of_interest lists, with COPY in the session's transaction
+    and returns the number written. Observation ids are taken from the
+    table's sequence up front so that the quality flags and features can
+    be copied in bulk too. Inserts into wccdm.observation are still routed
+    to the daily tables by the insert trigger, quality_flag and feature
+    refer to them by id without a foreign key. The caller commits.
+    """
+    rows = []
+    for observation in observations:
+        unknown = set(observation) - set(_OBSERVATION_COLUMNS) - \
+            set(_CHILDREN)
+        if unknown:
+            LOGGER.error(f"Error appending observation, unknown columns "
+                         f"{sorted(unknown)}, skipping")
+            continue
+        rows.append(observation)
+    if not rows:
+        return 0
+
+    cursor = session.connection().connection.cursor()
+    cursor.execute(
+        "SELECT nextval(pg_get_serial_sequence('wccdm.observation', 'id')) "
+        "FROM generate_series(1, %s)", (len(rows),))
+    ids = [row[0] for row in cursor.fetchall()]
+
+    # columns used by any of the observations, in table order
+    used = set().union(*rows) | set(_OBSERVATION_DEFAULTS)
+    columns = [column for column in _OBSERVATION_COLUMNS
+               if column == "id" or column in used]
+    observation_rows = []
+    quality_flag_rows = []
+    feature_rows = []
+    for id, observation in zip(ids, rows):
+        observation_rows.append([id if column == "id" else
+                                 observation.get(
+                                     column,
+                                     _OBSERVATION_DEFAULTS.get(column))
+                                 for column in columns])
+        for flag in observation.get("result_quality") or []:
+            quality_flag_rows.append(
+                [id] + [_child(flag, key) for key in _QUALITY_FLAG_COLUMNS[1:]])
+        for foi in observation.get("feature_of_interest") or []:
+            feature_rows.append(
+                [id] + [_child(foi, key) for key in _FEATURE_COLUMNS[1:]])
+
+    _copy(cursor, Observation.__table__, columns, observation_rows)
+    _copy(cursor, QualityFlag.__table__, _QUALITY_FLAG_COLUMNS,
+          quality_flag_rows)
+    _copy(cursor, Feature.__table__, _FEATURE_COLUMNS, feature_rows)
+    return len(rows)
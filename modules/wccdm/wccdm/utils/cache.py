@@ -0,0 +1,195 @@
+from collections import OrderedDict
+import hashlib
+import os
+from threading import Lock
+import time
+
+from celery.utils.log import get_task_logger
+import redis
+from sqlalchemy import text
+
+LOGGER = get_task_logger(__name__)
+
+# ids cached per process and lookup table, least recently used dropped first
+URI_CACHE_SIZE = int(os.getenv("URI_CACHE_SIZE", 10000))
+# ids shared between processes in a Redis hash per table, unset to disable
+URI_CACHE_REDIS = os.getenv("URI_CACHE_REDIS")
+# the shared hashes expire this many seconds after their last update and are
+# emptied once they hold more than URI_CACHE_REDIS_SIZE ids
+URI_CACHE_TTL = int(os.getenv("URI_CACHE_TTL", 86400))
+URI_CACHE_REDIS_SIZE = int(os.getenv("URI_CACHE_REDIS_SIZE", 100000))
+# seconds to wait for Redis, and to leave it alone after an error
+URI_CACHE_TIMEOUT = float(os.getenv("URI_CACHE_TIMEOUT", 0.5))
+URI_CACHE_RETRY = float(os.getenv("URI_CACHE_RETRY", 30))
+# report identifiers are unique to a report, only the most recent are kept
+REPORT_ID_CACHE_SIZE = int(os.getenv("REPORT_ID_CACHE_SIZE", 4096))
+
+
+class URICache():
+    """
+    URI -> id cache for a lookup table. A bounded LRU in the process is
+    checked first, then (if `client` is given) the Redis hash shared by all
+    processes, whose hits are copied to the LRU. The hash is keyed by the
+    table's oid (`generation`), so ids of a dropped and recreated table are
+    never served, and is bounded in size and age. Redis is skipped for
+    URI_CACHE_RETRY seconds after an error. `compact` keys the LRU by a 16
+    byte digest of the URI rather than the URI itself, for tables such as
+    report_identifier with long, rarely repeated URIs; compact caches are
+    not shared.
+    """
+
+    def __init__(self, name, size: int = URI_CACHE_SIZE, client=None,
+                 compact: bool = False, generation=None,
+                 shared_size: int = URI_CACHE_REDIS_SIZE,
+                 ttl: int = URI_CACHE_TTL):
+        self.name = name
+        self.size = size
+        self.client = None if compact else client
+        self.compact = compact
+        self.generation = generation
+        self.shared_size = shared_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._retry = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def key(self):
+        return f"wccdm:uris:{self.name}:{self.generation}"
+
+    def _shared(self):
+        # the Redis client, None while it is being left alone
+        if self.client is None or time.monotonic() < self._retry:
+            return None
+        return self.client
+
+    def _failed(self, action, error):
+        self.errors += 1
+        self._retry = time.monotonic() + URI_CACHE_RETRY
+        LOGGER.warning(f"Unable to {action} URI cache {self.key}, not "
+                       f"using it for {URI_CACHE_RETRY}s: {error}")
+
+    def _key(self, uri):
+        if self.compact:
+            return hashlib.blake2b(uri.encode(), digest_size=16).digest()
+        return uri
+
+    def _put(self, uri, id):
+        # with the lock held
+        key = self._key(uri)
+        self._entries[key] = id
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def get_many(self, uris):
+        ids = {}
+        with self._lock:
+            for uri in uris:
+                key = self._key(uri)
+                id = self._entries.get(key)
+                if id is not None:
+                    self._entries.move_to_end(key)
+                    ids[uri] = id
+            self.hits += len(ids)
+        missing = [uri for uri in uris if uri not in ids]
+        client = self._shared()
+        if missing and client is not None:
+            try:
+                values = client.hmget(self.key, missing)
+            except redis.RedisError as e:
+                self._failed("read", e)
+                values = []
+            shared = {uri: int(value) for uri, value in zip(missing, values)
+                      if value is not None}
+            with self._lock:
+                for uri, id in shared.items():
+                    self._put(uri, id)
+                self.shared_hits += len(shared)
+            ids.update(shared)
+        with self._lock:
+            self.misses += len(uris) - len(ids)
+        return ids
+
+    def set_many(self, ids):
+        if not ids:
+            return
+        with self._lock:
+            for uri, id in ids.items():
+                self._put(uri, id)
+        client = self._shared()
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=False)
+                pipe.hset(self.key, mapping=ids)
+                pipe.expire(self.key, self.ttl)
+                pipe.hlen(self.key)
+                if pipe.execute()[-1] > self.shared_size:
+                    # start again rather than track what is least used
+                    client.delete(self.key)
+            except redis.RedisError as e:
+                self._failed("update", e)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits,
+                    "shared_hits": self.shared_hits, "misses": self.misses,
+                    "errors": self.errors}
+
+
+_caches = {}
+_caches_lock = Lock()
+_client = None
+
+
+def _redis():
+    global _client
+    if _client is None and URI_CACHE_REDIS:
+        _client = redis.Redis.from_url(
+            URI_CACHE_REDIS, socket_timeout=URI_CACHE_TIMEOUT,
+            socket_connect_timeout=URI_CACHE_TIMEOUT)
+    return _client
+
+
+def _generation(table, session):
+    # oid of the table, new whenever the database is initialised again
+    if session is None:
+        return None
+    try:
+        return session.execute(text("SELECT to_regclass(:name)::oid"), {
+            "name": f"{table.schema}.{table.name}"}).scalar()
+    except Exception as e:
+        session.rollback()
+        LOGGER.warning(f"Unable to look up {table.name}, its URI cache is "
+                       f"not shared: {e}")
+        return None
+
+
+def get_cache(table, session=None):
+    """
+    URICache for a lookup table (sqlalchemy Table), one per process. The
+    cache is only shared with other processes if `session` is given, to
+    look up the table's oid.
+    """
+    name = f"{table.schema}.{table.name}"
+    with _caches_lock:
+        if name not in _caches:
+            if table.name == "report_identifier":
+                _caches[name] = URICache(name, REPORT_ID_CACHE_SIZE,
+                                         compact=True)
+            else:
+                client = _redis()
+                generation = _generation(table, session) \
+                    if client is not None else None
+                _caches[name] = URICache(
+                    name, client=client if generation is not None else None,
+                    generation=generation)
+        return _caches[name]
+
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in _caches.items()}